@@ -1,4 +1,56 @@
-from . import files
-from . import scripts
-from . import medsmaker
-from . import util
+"""
+Submodules are imported on first access, so that code which only needs
+the file path helpers in nbrsim.files does not pay for importing the
+science stack
+
+Module level __getattr__ needs python 3.7 or later; on older versions
+the submodules are imported eagerly
+"""
+import sys
+import importlib
+
+_SUBMODULES = [
+    'files',
+    'scripts',
+    'medsmaker',
+    'util',
+    'stages',
+    'stageout',
+    'stars',
+    'moments',
+    'plotting',
+    'benchmarks',
+    'config',
+    'psfcache',
+    'psfgrid',
+    'cutouts',
+    'medsreader',
+    'catalog',
+    'aggregate',
+    'galsimdriver',
+    'reduce',
+    'pipeline',
+    'scratch',
+    'nodecache',
+    'planner',
+    'compression',
+    'verify',
+    'pack',
+]
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module('.' + name, __name__)
+
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def __dir__():
+    return sorted(list(globals().keys()) + _SUBMODULES)
+
+if sys.version_info < (3, 7):
+    for _name in _SUBMODULES:
+        try:
+            importlib.import_module('.' + _name, __name__)
+        except ImportError:
+            # the optional dependencies of this module are not installed
+            pass
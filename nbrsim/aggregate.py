@@ -0,0 +1,886 @@
+"""
+aggregate shear statistics over a run
+
+The match catalogs are processed one index at a time by a pool of
+workers.  Each produces a small accumulator holding the number of
+objects and the mean and co-moments of the measured ellipticity and the
+true shear, for each shear_index and bin of distance to the nearest
+neighbor.  Accumulators are merged with the pairwise update of Chan et
+al., so results can be combined in any order and memory use does not
+depend on the size of the run.
+"""
+from __future__ import print_function
+import os
+import numpy
+
+from . import files
+
+# edges of bins in the distance to the nearest neighbor, in pixels
+DEFAULT_DIST_BINS = [0.0, 5.0, 10.0, 20.0, 40.0, numpy.inf]
+
+# variables accumulated for each object
+VARIABLES = ['e1','e2','g1','g2']
+NVAR = len(VARIABLES)
+
+# columns read from the match catalogs
+MATCH_COLUMNS = [
+    'xwin_image',
+    'ywin_image',
+    'flags',
+    'shear_index',
+    'shear_true',
+    'vignet',
+]
+
+# number of objects whose neighbors are compared at once
+NBR_CHUNK_SIZE = 1000
+
+# per-index statistics are written in chunks of this many indices
+PARTIALS_CHUNK_SIZE = 1000
+
+# the resampling weights are made in batches of about this many bytes
+RESAMPLE_BATCH_BYTES = 64*1024*1024
+
+
+class ShearAccumulator(object):
+    """
+    mergeable statistics for each shear_index and neighbor distance bin
+
+    parameters
+    ----------
+    dist_bins: sequence, optional
+        Edges of the bins in neighbor distance, in pixels
+    nshear: int, optional
+        Initial number of shear indices; this grows as needed
+    """
+    def __init__(self, dist_bins=DEFAULT_DIST_BINS, nshear=0):
+        self.dist_bins = numpy.array(dist_bins, dtype='f8')
+        self.nbins = self.dist_bins.size-1
+
+        self.counts = numpy.zeros( (nshear, self.nbins), dtype='i8')
+        self.means = numpy.zeros( (nshear, self.nbins, NVAR) )
+        self.m2 = numpy.zeros( (nshear, self.nbins, NVAR, NVAR) )
+
+    @property
+    def nshear(self):
+        return self.counts.shape[0]
+
+    def add(self, shear_index, dist, values):
+        """
+        add a set of objects
+
+        parameters
+        ----------
+        shear_index: array
+            The shear index for each object
+        dist: array
+            Distance to the nearest neighbor for each object
+        values: array
+            Array of shape (n, 4) with e1, e2, g1, g2 for each object
+        """
+        shear_index = numpy.atleast_1d(shear_index).astype('i8')
+        values = numpy.atleast_2d(values)
+
+        ibin = numpy.searchsorted(self.dist_bins, dist, side='right') - 1
+        w, = numpy.where(
+            (shear_index >= 0) & (ibin >= 0) & (ibin < self.nbins)
+        )
+        if w.size == 0:
+            return
+
+        nshear = shear_index[w].max()+1
+        batch = ShearAccumulator(dist_bins=self.dist_bins, nshear=nshear)
+        batch._fill(shear_index[w], ibin[w], values[w])
+
+        self.merge(batch)
+
+    def merge(self, other):
+        """
+        merge the statistics from another accumulator into this one
+
+        returns
+        -------
+        this accumulator
+        """
+        if not numpy.all(other.dist_bins == self.dist_bins):
+            raise ValueError("cannot merge accumulators with different "
+                             "distance bins")
+
+        n = max(self.nshear, other.nshear)
+        self._grow(n)
+        other = other.copy()
+        other._grow(n)
+
+        na = self.counts[:, :, numpy.newaxis]
+        nb = other.counts[:, :, numpy.newaxis]
+        ntot = na + nb
+        nsafe = numpy.where(ntot > 0, ntot, 1)
+
+        delta = other.means - self.means
+        means = self.means + delta*nb/nsafe
+
+        fac = (na*nb/nsafe)[..., numpy.newaxis]
+        m2 = (
+            self.m2 + other.m2
+            + fac*delta[..., :, numpy.newaxis]*delta[..., numpy.newaxis, :]
+        )
+
+        self.counts = ntot[:, :, 0]
+        self.means = means
+        self.m2 = m2
+        return self
+
+    def copy(self):
+        new = ShearAccumulator(dist_bins=self.dist_bins)
+        new.counts = self.counts.copy()
+        new.means = self.means.copy()
+        new.m2 = self.m2.copy()
+        return new
+
+    def get_variances(self):
+        """
+        get the covariance matrices of the variables for each shear index
+        and distance bin, shape (nshear, nbins, 4, 4)
+        """
+        n = self.counts[:, :, numpy.newaxis, numpy.newaxis]
+        return self.m2/numpy.where(n > 1, n-1, 1)
+
+    def get_summary(self):
+        """
+        get the response and additive term for each distance bin and for
+        all distances together
+
+        The mean ellipticity for each shear index is fit as
+        <e> = R g + c, weighting each shear index by its number of
+        objects
+
+        returns
+        -------
+        array with fields dist_min, dist_max, nobj, R, c, each of R
+        and c holding the two components
+        """
+        dt = [
+            ('dist_min','f8'),
+            ('dist_max','f8'),
+            ('nobj','i8'),
+            ('R','f8',2),
+            ('c','f8',2),
+        ]
+        output = numpy.zeros(self.nbins+1, dtype=dt)
+
+        output['dist_min'][:-1] = self.dist_bins[:-1]
+        output['dist_max'][:-1] = self.dist_bins[1:]
+        output['dist_min'][-1] = self.dist_bins[0]
+        output['dist_max'][-1] = self.dist_bins[-1]
+
+        output['nobj'][:-1] = self.counts.sum(axis=0)
+        output['nobj'][-1] = self.counts.sum()
+
+        sums = self.means*self.counts[:, :, numpy.newaxis]
+        output['R'], output['c'] = fit_sums(self.counts, sums)
+
+        return output
+
+    def _fill(self, shear_index, ibin, values):
+        """
+        fill from a set of objects, with whole-array operations
+        """
+        key = shear_index*self.nbins + ibin
+        nkey = self.nshear*self.nbins
+
+        counts = numpy.bincount(key, minlength=nkey)
+        nsafe = numpy.where(counts > 0, counts, 1)
+
+        means = numpy.zeros( (nkey, NVAR) )
+        for i in range(NVAR):
+            means[:, i] = numpy.bincount(key, weights=values[:, i], minlength=nkey)/nsafe
+
+        diff = values - means[key]
+        m2 = numpy.zeros( (nkey, NVAR, NVAR) )
+        for i in range(NVAR):
+            for j in range(i, NVAR):
+                m2[:, i, j] = numpy.bincount(
+                    key, weights=diff[:, i]*diff[:, j], minlength=nkey,
+                )
+                m2[:, j, i] = m2[:, i, j]
+
+        self.counts = counts.reshape(self.nshear, self.nbins)
+        self.means = means.reshape(self.nshear, self.nbins, NVAR)
+        self.m2 = m2.reshape(self.nshear, self.nbins, NVAR, NVAR)
+
+    def _grow(self, nshear):
+        """
+        make room for more shear indices
+        """
+        nadd = nshear - self.nshear
+        if nadd <= 0:
+            return
+
+        self.counts = numpy.concatenate(
+            [self.counts, numpy.zeros( (nadd, self.nbins), dtype='i8')]
+        )
+        self.means = numpy.concatenate(
+            [self.means, numpy.zeros( (nadd, self.nbins, NVAR) )]
+        )
+        self.m2 = numpy.concatenate(
+            [self.m2, numpy.zeros( (nadd, self.nbins, NVAR, NVAR) )]
+        )
+
+
+def fit_sums(counts, sums):
+    """
+    fit the response and additive term from summed statistics, for each
+    distance bin and for all distances together
+
+    parameters
+    ----------
+    counts: array
+        Number of objects, shape (..., nshear, nbins)
+    sums: array
+        Sums of e1, e2, g1, g2, shape (..., nshear, nbins, 4)
+
+    returns
+    -------
+    R, c: arrays of shape (..., nbins+1, 2), the last bin for all
+    distances
+    """
+    counts = numpy.concatenate(
+        [counts, counts.sum(axis=-1)[..., numpy.newaxis]],
+        axis=-1,
+    )
+    sums = numpy.concatenate(
+        [sums, sums.sum(axis=-2)[..., numpy.newaxis, :]],
+        axis=-2,
+    )
+
+    nsafe = numpy.where(counts > 0, counts, 1)[..., numpy.newaxis]
+    means = sums/nsafe
+
+    shape = counts.shape[:-2] + counts.shape[-1:] + (2,)
+    R = numpy.zeros(shape)
+    c = numpy.zeros(shape)
+    for i in range(2):
+        R[..., i], c[..., i] = fit_response(
+            counts, means[..., i], means[..., i+2],
+        )
+
+    return R, c
+
+
+def fit_response(counts, e, g):
+    """
+    fit <e> = R g + c over shear indices, weighting by the number of
+    objects.  The fit is done separately for each column
+
+    parameters
+    ----------
+    counts: array
+        Number of objects, shape (..., nshear, nbins)
+    e: array
+        Mean ellipticity, shape (..., nshear, nbins)
+    g: array
+        Mean true shear, shape (..., nshear, nbins)
+
+    returns
+    -------
+    R, c: arrays of shape (..., nbins), nan where there were fewer than
+    two distinct shears
+    """
+    wt = counts.astype('f8')
+    wsum = wt.sum(axis=-2)
+    wsafe = numpy.where(wsum > 0, wsum, 1)
+
+    gmean = (wt*g).sum(axis=-2)/wsafe
+    emean = (wt*e).sum(axis=-2)/wsafe
+
+    dg = g - gmean[..., numpy.newaxis, :]
+    de = e - emean[..., numpy.newaxis, :]
+    gvar = (wt*dg**2).sum(axis=-2)
+    cov = (wt*dg*de).sum(axis=-2)
+
+    good = gvar > 0
+    R = numpy.where(good, cov/numpy.where(good, gvar, 1), numpy.nan)
+    c = numpy.where(good, emean - R*gmean, numpy.nan)
+
+    return R, c
+
+
+def get_max_dist(dist_bins):
+    """
+    the largest finite edge of the distance bins.  Any distance at least
+    this large falls in the same bin as the edge itself
+    """
+    dist_bins = numpy.array(dist_bins, dtype='f8')
+    return dist_bins[numpy.isfinite(dist_bins)].max()
+
+
+def get_neighbor_distance(x, y, max_dist):
+    """
+    distance from each object to its nearest neighbor, inf for a lone
+    object.  Distances of max_dist or more are returned as max_dist
+
+    The objects are put on a grid of cells max_dist on a side, so each is
+    compared only with those in its own and the eight surrounding cells
+
+    parameters
+    ----------
+    x, y: arrays
+        Positions of the objects
+    max_dist: float
+        Largest distance searched, e.g. from get_max_dist
+    """
+    x = numpy.atleast_1d(x).astype('f8')
+    y = numpy.atleast_1d(y).astype('f8')
+
+    if x.size < 2:
+        return numpy.zeros(x.size) + numpy.inf
+    if max_dist <= 0:
+        return numpy.zeros(x.size) + max_dist
+
+    # cell numbers, with a border of empty cells around the objects
+    ix = numpy.floor((x - x.min())/max_dist).astype('i8') + 1
+    iy = numpy.floor((y - y.min())/max_dist).astype('i8') + 1
+    nx = ix.max() + 2
+    cell = iy*nx + ix
+
+    s = cell.argsort()
+    scell = cell[s]
+
+    d2min = numpy.zeros(x.size) + numpy.inf
+
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            ncell = cell + dy*nx + dx
+            start = numpy.searchsorted(scell, ncell, side='left')
+            count = numpy.searchsorted(scell, ncell, side='right') - start
+
+            for beg in range(0, x.size, NBR_CHUNK_SIZE):
+                end = min(beg+NBR_CHUNK_SIZE, x.size)
+                c = count[beg:end]
+                npair = c.sum()
+                if npair == 0:
+                    continue
+
+                # each object paired with every object in the cell
+                obj = numpy.repeat(numpy.arange(beg, end), c)
+                first = numpy.repeat(start[beg:end], c)
+                offset = numpy.arange(npair) - numpy.repeat(c.cumsum() - c, c)
+                other = s[first + offset]
+
+                w, = numpy.where(obj != other)
+                obj, other = obj[w], other[w]
+
+                d2 = (x[obj] - x[other])**2 + (y[obj] - y[other])**2
+                numpy.minimum.at(d2min, obj, d2)
+
+    return numpy.sqrt(numpy.minimum(d2min, max_dist**2))
+
+
+def get_shapes(cat):
+    """
+    get e1, e2 for each object from the adaptive moments of the VIGNET
+    stamps, with a boolean array of objects that were measured
+    """
+    from .moments import get_vignet_moments
+
+    moms = get_vignet_moments(cat, weight_sigma=2.0)
+    good = moms['flags'] == 0
+    return moms['e1'], moms['e2'], good
+
+
+def measure_index(run, index, dist_bins=DEFAULT_DIST_BINS):
+    """
+    accumulate statistics for one index
+
+    All detections are used as neighbors, but only those matched to
+    the truth, with no sextractor flags and a good shape measurement
+    are accumulated
+
+    returns
+    -------
+    ShearAccumulator, or None if the match file is missing
+    """
+    import fitsio
+
+    fname = files.get_sxcat_match_file(run, index)
+    if not os.path.exists(fname):
+        print("skipping missing match file:",fname)
+        return None
+
+    cat = fitsio.read(fname, columns=MATCH_COLUMNS, lower=True)
+
+    dist = get_neighbor_distance(
+        cat['xwin_image'],
+        cat['ywin_image'],
+        get_max_dist(dist_bins),
+    )
+    e1, e2, good = get_shapes(cat)
+
+    w, = numpy.where(good & (cat['flags'] == 0) & (cat['shear_index'] >= 0))
+
+    values = numpy.zeros( (w.size, NVAR) )
+    values[:, 0] = e1[w]
+    values[:, 1] = e2[w]
+    values[:, 2] = cat['shear_true'][w, 0]
+    values[:, 3] = cat['shear_true'][w, 1]
+
+    acc = ShearAccumulator(dist_bins=dist_bins)
+    acc.add(cat['shear_index'][w], dist[w], values)
+    return acc
+
+
+def aggregate(run,
+              indices=None,
+              nproc=1,
+              dist_bins=DEFAULT_DIST_BINS,
+              partials_file=None):
+    """
+    accumulate statistics over the indices of a run
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    indices: sequence of ints, optional
+        The indices to process, default all in the run
+    nproc: int, optional
+        Number of worker processes
+    dist_bins: sequence, optional
+        Edges of the bins in neighbor distance
+    partials_file: string, optional
+        If sent, write the statistics for each index to this file as
+        they are made, for use in resampling error estimates
+
+    returns
+    -------
+    ShearAccumulator
+    """
+    if indices is None:
+        conf = files.read_config(run)
+        indices = list(range(conf['output']['nfiles']))
+
+    args = [(run, index, dist_bins) for index in indices]
+
+    reducer = TreeReducer()
+
+    writer = None
+    if partials_file is not None:
+        writer = PartialsWriter(partials_file, dist_bins)
+
+    def _add(res):
+        index, acc = res
+        if acc is None:
+            return
+        if writer is not None:
+            writer.add(index, acc)
+        reducer.add(acc)
+
+    try:
+        if nproc > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(nproc)
+            try:
+                for res in pool.imap_unordered(_measure_index_wrapper, args):
+                    _add(res)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for arg in args:
+                _add(_measure_index_wrapper(arg))
+    except:
+        if writer is not None:
+            writer.abort()
+        raise
+
+    if writer is not None:
+        writer.close()
+
+    result = reducer.get_result()
+    if result is None:
+        result = ShearAccumulator(dist_bins=dist_bins)
+
+    return result
+
+
+def get_index_sums(acc):
+    """
+    get the counts and sums of the variables from an accumulator.
+    Unlike the means these are additive, so subsets of indices can be
+    combined with a weighted sum
+    """
+    sums = acc.means*acc.counts[:, :, numpy.newaxis]
+    return acc.counts, sums
+
+
+class PartialsWriter(object):
+    """
+    write the per-index statistics as they are made, so they are not all
+    held in memory
+
+    The table has a row for each index and shear_index with objects,
+    holding the counts and sums for each distance bin.  Rows are appended
+    in chunks to a temporary file, which is renamed into place by close
+
+    parameters
+    ----------
+    fname: string
+        The output file
+    dist_bins: sequence
+        Edges of the distance bins
+    """
+    def __init__(self, fname, dist_bins):
+        import fitsio
+
+        self.fname = fname
+        self.tmpname = '%s.tmp%d' % (fname, os.getpid())
+        self.nbins = len(dist_bins)-1
+        self.dtype = get_partials_dtype(self.nbins)
+        self._rows = []
+
+        self.fits = fitsio.FITS(self.tmpname, 'rw', clobber=True)
+        _write_dist_bins(self.fits, dist_bins)
+        self.fits.create_table_hdu(dtype=self.dtype, extname='partials')
+
+    def add(self, index, acc):
+        """
+        add the statistics for an index
+        """
+        counts, sums = get_index_sums(acc)
+        w, = numpy.where(counts.sum(axis=1) > 0)
+        if w.size == 0:
+            return
+
+        rows = numpy.zeros(w.size, dtype=self.dtype)
+        rows['index'] = index
+        rows['shear_index'] = w
+        rows['counts'] = counts[w]
+        rows['sums'] = sums[w]
+
+        self._rows.append(rows)
+        if len(self._rows) >= PARTIALS_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if len(self._rows) > 0:
+            self.fits['partials'].append(numpy.concatenate(self._rows))
+            self._rows = []
+
+    def close(self):
+        """
+        write any remaining rows and rename the file into place
+        """
+        self.flush()
+        self.fits.close()
+
+        print("writing:",self.fname)
+        os.rename(self.tmpname, self.fname)
+
+    def abort(self):
+        """
+        remove the temporary file
+        """
+        self.fits.close()
+        if os.path.exists(self.tmpname):
+            os.remove(self.tmpname)
+
+
+def get_partials_dtype(nbins):
+    return [
+        ('index','i4'),
+        ('shear_index','i4'),
+        ('counts','i8',nbins),
+        ('sums','f8',(nbins, NVAR)),
+    ]
+
+
+def read_partials(fname):
+    """
+    read the per-index statistics
+
+    returns
+    -------
+    data, dist_bins, where data has one entry per index, sorted by
+    index, with fields index, counts of shape (nshear, nbins) and sums of
+    shape (nshear, nbins, 4)
+    """
+    import fitsio
+
+    print("reading:",fname)
+    with fitsio.FITS(fname) as fits:
+        rows = fits['partials'].read()
+        dist_bins = fits['dist_bins'].read()['dist_bins'][0]
+
+    nbins = len(dist_bins)-1
+    indices, iindex = numpy.unique(rows['index'], return_inverse=True)
+    nshear = rows['shear_index'].max()+1 if rows.size > 0 else 1
+
+    data = numpy.zeros(indices.size, dtype=[
+        ('index','i4'),
+        ('counts','i8',(nshear, nbins)),
+        ('sums','f8',(nshear, nbins, NVAR)),
+    ])
+    data['index'] = indices
+    data['counts'][iindex, rows['shear_index']] = rows['counts']
+    data['sums'][iindex, rows['shear_index']] = rows['sums']
+
+    return data, dist_bins
+
+
+def accumulator_from_partials(data, dist_bins):
+    """
+    combine the per-index statistics into a single accumulator
+
+    The partials hold only counts and sums, which is all the summary
+    needs; the co-moments of the result are set to nan
+    """
+    counts = data['counts'].sum(axis=0)
+    sums = data['sums'].sum(axis=0)
+
+    n = counts[:, :, numpy.newaxis]
+    means = sums/numpy.where(n > 0, n, 1)
+
+    acc = ShearAccumulator(dist_bins=dist_bins)
+    acc.counts = counts
+    acc.means = means
+    acc.m2 = numpy.zeros(means.shape + (NVAR,)) + numpy.nan
+    return acc
+
+
+def resample_fits(data, weights):
+    """
+    fit the response and additive term for many reweightings of the
+    indices at once
+
+    parameters
+    ----------
+    data: array
+        The per-index statistics, as read by read_partials
+    weights: array
+        Weights of shape (nresample, nindex)
+
+    returns
+    -------
+    R, c: arrays of shape (nresample, nbins+1, 2)
+    """
+    counts = numpy.tensordot(weights, data['counts'].astype('f8'), axes=(1, 0))
+    sums = numpy.tensordot(weights, data['sums'], axes=(1, 0))
+    return fit_sums(counts, sums)
+
+
+def get_resample_batch_size(nindex):
+    """
+    number of resamples whose weights are held at once
+    """
+    return max(1, RESAMPLE_BATCH_BYTES//(8*max(nindex, 1)))
+
+
+def iter_jackknife_weights(nindex, njack=100):
+    """
+    weights for a delete-block jackknife, in batches of shape
+    (nresample, nindex); the indices are split into njack contiguous
+    blocks and each resample leaves out one block
+    """
+    njack = min(njack, nindex)
+    block = numpy.arange(nindex)*njack//nindex
+    batch_size = get_resample_batch_size(nindex)
+
+    for beg in range(0, njack, batch_size):
+        end = min(beg+batch_size, njack)
+
+        weights = numpy.ones( (end-beg, nindex) )
+        w, = numpy.where( (block >= beg) & (block < end) )
+        weights[block[w]-beg, w] = 0.0
+        yield weights
+
+
+def iter_bootstrap_weights(nindex, nboot=1000, seed=None):
+    """
+    weights for a bootstrap over indices, in batches of shape
+    (nresample, nindex); each weight is the number of times the index
+    was drawn
+    """
+    rng = numpy.random.RandomState(seed)
+    pvals = numpy.ones(nindex)/nindex
+    batch_size = get_resample_batch_size(nindex)
+
+    for beg in range(0, nboot, batch_size):
+        end = min(beg+batch_size, nboot)
+        yield rng.multinomial(nindex, pvals, size=end-beg).astype('f8')
+
+
+def get_errors(data, method='jackknife', njack=100, nboot=1000, seed=None):
+    """
+    get errors on the response and additive term by resampling the
+    indices, using only the per-index statistics
+
+    parameters
+    ----------
+    data: array
+        The per-index statistics, as read by read_partials
+    method: string, optional
+        'jackknife' or 'bootstrap'
+    njack: int, optional
+        Number of jackknife blocks
+    nboot: int, optional
+        Number of bootstrap resamples
+    seed: int, optional
+        Seed for the bootstrap
+
+    returns
+    -------
+    R_err, c_err: arrays of shape (nbins+1, 2)
+    """
+    nindex = data.size
+
+    if method == 'jackknife':
+        batches = iter_jackknife_weights(nindex, njack=njack)
+    elif method == 'bootstrap':
+        batches = iter_bootstrap_weights(nindex, nboot=nboot, seed=seed)
+    else:
+        raise ValueError("bad error method: '%s'" % method)
+
+    Rlist, clist = [], []
+    for weights in batches:
+        R, c = resample_fits(data, weights)
+        Rlist.append(R)
+        clist.append(c)
+
+    R = numpy.concatenate(Rlist)
+    c = numpy.concatenate(clist)
+
+    if method == 'jackknife':
+        n = R.shape[0]
+        fac = (n-1.0)/n
+        R_err = numpy.sqrt(fac*((R - R.mean(axis=0))**2).sum(axis=0))
+        c_err = numpy.sqrt(fac*((c - c.mean(axis=0))**2).sum(axis=0))
+    else:
+        R_err = R.std(axis=0)
+        c_err = c.std(axis=0)
+
+    return R_err, c_err
+
+
+class TreeReducer(object):
+    """
+    merge accumulators pairwise as they arrive, like a binary counter,
+    so that only about log2(n) partial results are held at a time
+    """
+    def __init__(self):
+        self.levels = []
+
+    def add(self, acc):
+        if acc is None:
+            return
+
+        level = 0
+        while level < len(self.levels) and self.levels[level] is not None:
+            acc = self.levels[level].merge(acc)
+            self.levels[level] = None
+            level += 1
+
+        if level == len(self.levels):
+            self.levels.append(acc)
+        else:
+            self.levels[level] = acc
+
+    def get_result(self):
+        result = None
+        for acc in self.levels:
+            if acc is None:
+                continue
+            if result is None:
+                result = acc
+            else:
+                result = acc.merge(result)
+
+        return result
+
+
+def add_errors(summary, R_err, c_err):
+    """
+    add errors from get_errors to a summary
+    """
+    dt = summary.dtype.descr + [('R_err','f8',2), ('c_err','f8',2)]
+    output = numpy.zeros(summary.size, dtype=dt)
+    for name in summary.dtype.names:
+        output[name] = summary[name]
+
+    output['R_err'] = R_err
+    output['c_err'] = c_err
+    return output
+
+
+def print_summary(summary):
+    has_err = 'R_err' in summary.dtype.names
+
+    print("%8s %8s %10s %10s %10s %10s %10s" % (
+        'dmin','dmax','nobj','R1','R2','c1','c2',
+    ))
+    for s in summary:
+        print("%8.1f %8.1f %10d %10.4f %10.4f %10.2e %10.2e" % (
+            s['dist_min'], s['dist_max'], s['nobj'],
+            s['R'][0], s['R'][1], s['c'][0], s['c'][1],
+        ))
+        if has_err:
+            print("%8s %8s %10s %10.4f %10.4f %10.2e %10.2e" % (
+                '', '', '+/-',
+                s['R_err'][0], s['R_err'][1], s['c_err'][0], s['c_err'][1],
+            ))
+
+
+def write_summary(fname, acc, summary=None):
+    """
+    write the summary and the accumulated statistics
+
+    parameters
+    ----------
+    fname: string
+        The output file
+    acc: ShearAccumulator
+        The statistics for the run
+    summary: array, optional
+        The summary to write, default acc.get_summary().  Send this to
+        include errors
+    """
+    import fitsio
+
+    if summary is None:
+        summary = acc.get_summary()
+
+    print("writing:",fname)
+    with fitsio.FITS(fname, 'rw', clobber=True) as fits:
+        fits.write(summary, extname='summary')
+        _write_dist_bins(fits, acc.dist_bins)
+
+        if acc.nshear > 0:
+            # the co-moments are not known when made from the partials
+            has_m2 = numpy.all(numpy.isfinite(acc.m2))
+
+            dt = [
+                ('counts','i8',acc.counts.shape),
+                ('means','f8',acc.means.shape),
+            ]
+            if has_m2:
+                dt += [('m2','f8',acc.m2.shape)]
+
+            stats = numpy.zeros(1, dtype=dt)
+            stats['counts'][0] = acc.counts
+            stats['means'][0] = acc.means
+            if has_m2:
+                stats['m2'][0] = acc.m2
+            fits.write(stats, extname='stats')
+
+
+def _write_dist_bins(fits, dist_bins):
+    """
+    the bins are written as a table, because infinite values in an
+    image are read back as nan
+    """
+    data = numpy.zeros(1, dtype=[('dist_bins','f8',len(dist_bins))])
+    data['dist_bins'][0] = dist_bins
+    fits.write(data, extname='dist_bins')
+
+
+def _measure_index_wrapper(arg):
+    return arg[1], measure_index(*arg)
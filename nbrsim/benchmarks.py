@@ -0,0 +1,379 @@
+"""
+benchmarks for parts of the framework
+"""
+from __future__ import print_function
+import os
+import sys
+import subprocess
+
+# modules timed by default in the import benchmark
+IMPORT_MODULES = [
+    'nbrsim',
+    'nbrsim.files',
+    'nbrsim.scripts',
+    'nbrsim.util',
+    'nbrsim.stars',
+    'nbrsim.medsmaker',
+]
+
+_IMPORT_CODE = """
+import time
+tm0 = time.time()
+%s
+print(time.time() - tm0)
+"""
+
+
+def time_import(module, nrepeat=5, python=None):
+    """
+    time the import of a module, each time in a fresh interpreter
+
+    parameters
+    ----------
+    module: string
+        The module to import, e.g. nbrsim.files
+    nrepeat: int, optional
+        Number of times to repeat; the minimum time is returned
+    python: string, optional
+        The python executable, default sys.executable
+
+    returns
+    -------
+    The minimum time in seconds, or None if the import failed
+    """
+    if python is None:
+        python = sys.executable
+
+    code = _IMPORT_CODE % ('import %s' % module)
+
+    times = []
+    for i in range(nrepeat):
+        try:
+            output = subprocess.check_output(
+                [python, '-c', code],
+                stderr=subprocess.STDOUT,
+            )
+        except subprocess.CalledProcessError:
+            return None
+
+        times.append(float(output.decode().split()[-1]))
+
+    return min(times)
+
+
+def run_import_benchmark(modules=None, nrepeat=5):
+    """
+    time imports of the specified modules and print a table
+
+    parameters
+    ----------
+    modules: list of strings, optional
+        Modules to import, default IMPORT_MODULES
+    nrepeat: int, optional
+        Number of times to repeat each import
+
+    returns
+    -------
+    dict keyed by module name with the import time in seconds, None for
+    modules that failed to import.  The stdlib os module is included for
+    reference.
+    """
+    if modules is None:
+        modules = IMPORT_MODULES
+
+    results = {}
+    for module in ['os'] + list(modules):
+        tm = time_import(module, nrepeat=nrepeat)
+        results[module] = tm
+
+        if tm is None:
+            print("%-25s  import failed" % module)
+        else:
+            print("%-25s  %8.1f ms" % (module, tm*1000))
+
+    return results
+
+
+# settings compared by default in the compression benchmark, for each
+# product.  MEDS cutouts are stored as one dimensional arrays
+COMPRESSION_TILES = {
+    'image': [[10240,1], [64,64], [128,128], [256,256]],
+    'seg': [[10240,1], [64,64], [128,128], [256,256]],
+    'meds': [[10240,1], [4096,1], [1024,1]],
+}
+COMPRESSION_QUANTIZE = [4.0, 8.0, 16.0]
+
+# the winner is the fastest for cutout reads among settings with a
+# compressed size within this fraction of the smallest
+COMPRESSION_SIZE_TOLERANCE = 0.1
+
+# settings that add more error than this, relative to the pixel noise,
+# are not considered.  Quantizing at q=4 adds 1/(4 sqrt(12)) = 0.072
+COMPRESSION_MAX_REL_ERR = 0.08
+
+
+def run_compression_benchmark(fnames,
+                              product=None,
+                              tiles=None,
+                              quantize=None,
+                              types=('rice',),
+                              ncutouts=1000,
+                              box_size=48,
+                              seed=None,
+                              max_rel_err=COMPRESSION_MAX_REL_ERR):
+    """
+    compare fpack settings on sample products, measuring the compressed
+    size, the compression time and the time to read random cutouts
+
+    parameters
+    ----------
+    fnames: list of strings
+        Sample files, compressed or not
+    product: string, optional
+        'image', 'seg' or 'meds'.  Default is to guess from each file name
+    tiles: list of [n1, n2], optional
+        Tile shapes to try, default COMPRESSION_TILES for the product
+    quantize: list of floats, optional
+        Quantization levels to try, default COMPRESSION_QUANTIZE.  Not
+        used for seg maps, which are integer
+    types: list of strings, optional
+        Compression algorithms to try
+    ncutouts: int, optional
+        Number of random cutouts to read
+    box_size: int, optional
+        Size of cutouts read from images and seg maps
+    seed: int, optional
+        Seed for choosing the cutouts
+    max_rel_err: float, optional
+        Largest quantization error, relative to the pixel noise, allowed
+        for a winning setting
+
+    returns
+    -------
+    list of result dicts, and a dict of the winning profile for each
+    product
+    """
+    import numpy
+    from .scratch import Scratch
+    from . import compression
+
+    rng = numpy.random.RandomState(seed)
+
+    results = []
+    for fname in fnames:
+        prod = product if product is not None else compression.get_product(fname)
+
+        ptiles = tiles if tiles is not None else COMPRESSION_TILES[prod]
+        pquant = quantize if quantize is not None else COMPRESSION_QUANTIZE
+        if prod == 'seg':
+            pquant = [None]
+
+        # the uncompressed copy and one compressed version at a time
+        nbytes = os.path.getsize(fname)*(10 if fname.endswith('.fz') else 2)
+        with Scratch('benchmark', nbytes=nbytes) as tmpdir:
+            ucfile = _get_uncompressed(fname, tmpdir)
+            ucsize = os.path.getsize(ucfile)
+            original = _read_reference_data(ucfile)
+
+            for ctype in types:
+                for tile in ptiles:
+                    for q in pquant:
+                        profile = {'type': ctype, 'tile': list(tile)}
+                        if q is not None:
+                            profile.update({'quantize': q, 'preserve_zero': True})
+
+                        res = _run_compression_setting(
+                            ucfile, prod, profile, original,
+                            ncutouts, box_size, rng,
+                        )
+                        res['file'] = fname
+                        res['ratio'] = res['size']/float(ucsize)
+                        results.append(res)
+                        _print_compression_result(res)
+
+    winners = get_compression_winners(results, max_rel_err=max_rel_err)
+    return results, winners
+
+
+def get_compression_winners(results, max_rel_err=COMPRESSION_MAX_REL_ERR):
+    """
+    choose the settings for each product with the fastest cutout reads
+    among those with a compressed size near the smallest.  Settings with
+    a quantization error above max_rel_err in any file are not
+    considered, and a product with none left gets no winner
+    """
+    winners = {}
+    products = sorted(set(r['product'] for r in results))
+    for prod in products:
+        presults = [r for r in results if r['product'] == prod]
+
+        # average over files for each setting
+        settings = {}
+        for r in presults:
+            key = _profile_key(r['profile'])
+            settings.setdefault(key, []).append(r)
+
+        summary = []
+        for key, rlist in settings.items():
+            summary.append({
+                'profile': rlist[0]['profile'],
+                'ratio': sum(r['ratio'] for r in rlist)/len(rlist),
+                'read_ms': sum(r['read_ms'] for r in rlist)/len(rlist),
+                'rel_err': max(r['rel_err'] for r in rlist),
+            })
+
+        summary = [s for s in summary if s['rel_err'] <= max_rel_err]
+        if len(summary) == 0:
+            print("no %s settings with rel_err <= %g" % (prod, max_rel_err))
+            continue
+
+        min_ratio = min(s['ratio'] for s in summary)
+        ok = [
+            s for s in summary
+            if s['ratio'] <= min_ratio*(1 + COMPRESSION_SIZE_TOLERANCE)
+        ]
+        best = min(ok, key=lambda s: s['read_ms'])
+        winners[prod] = best['profile']
+
+    return winners
+
+
+def _run_compression_setting(ucfile, product, profile, original,
+                             ncutouts, box_size, rng):
+    import time
+    import numpy
+    from . import compression
+
+    fzfile = ucfile + '.fz'
+    if os.path.exists(fzfile):
+        os.remove(fzfile)
+
+    cmd = compression.make_fpack_command(profile, fname=ucfile)
+
+    tm0 = time.time()
+    subprocess.check_call(cmd, shell=True)
+    compress_time = time.time() - tm0
+
+    if product == 'meds':
+        read_time = _time_meds_reads(fzfile, ncutouts, rng)
+    else:
+        read_time = _time_image_reads(fzfile, ncutouts, box_size, rng)
+
+    # error introduced by quantization, relative to the pixel noise
+    rel_err = 0.0
+    if original is not None and original.dtype.kind == 'f':
+        decompressed = _read_reference_data(fzfile)
+        diff = decompressed.astype('f8') - original
+        noise = 1.4826*numpy.median(numpy.abs(original - numpy.median(original)))
+        if noise > 0:
+            rel_err = diff.std()/noise
+
+    res = {
+        'product': product,
+        'profile': profile,
+        'command': cmd,
+        'size': os.path.getsize(fzfile),
+        'compress_s': compress_time,
+        'read_ms': read_time*1000/ncutouts,
+        'rel_err': rel_err,
+    }
+
+    os.remove(fzfile)
+    return res
+
+
+def _time_image_reads(fname, ncutouts, box_size, rng):
+    """
+    time reading random cutouts from the first image extension
+    """
+    import time
+    import fitsio
+
+    with fitsio.FITS(fname) as fits:
+        hdu = _get_first_image_hdu(fits)
+        nrows, ncols = hdu.get_dims()
+        box_size = min(box_size, nrows, ncols)
+
+        rows = rng.randint(0, nrows - box_size + 1, size=ncutouts)
+        cols = rng.randint(0, ncols - box_size + 1, size=ncutouts)
+
+        tm0 = time.time()
+        for row, col in zip(rows, cols):
+            hdu[row:row+box_size, col:col+box_size]
+        return time.time() - tm0
+
+
+def _time_meds_reads(fname, ncutouts, rng):
+    """
+    time reading the coadd cutouts of random objects
+    """
+    import time
+    import fitsio
+
+    with fitsio.FITS(fname) as fits:
+        obj_data = fits['object_data'].read(columns=['start_row', 'box_size'])
+        w, = (obj_data['box_size'] > 0).nonzero()
+        ind = rng.choice(w, size=ncutouts)
+
+        start = obj_data['start_row'][ind, 0]
+        npix = obj_data['box_size'][ind].astype('i8')**2
+
+        hdu = fits['image_cutouts']
+        tm0 = time.time()
+        for s, n in zip(start, npix):
+            hdu[s:s+n]
+        return time.time() - tm0
+
+
+def _get_uncompressed(fname, dir):
+    """
+    copy or funpack the sample file into the directory
+    """
+    import shutil
+
+    bname = os.path.basename(fname)
+    if fname.endswith('.fz'):
+        ucfile = os.path.join(dir, bname[:-3])
+        cmd = 'funpack -O %s %s' % (ucfile, fname)
+        print(cmd)
+        subprocess.check_call(cmd, shell=True)
+    else:
+        ucfile = os.path.join(dir, bname)
+        shutil.copy(fname, ucfile)
+
+    return ucfile
+
+
+def _get_first_image_hdu(fits):
+    for hdu in fits:
+        if hdu.get_exttype() == 'IMAGE_HDU' and hdu.has_data():
+            return hdu
+    raise ValueError("no image data found")
+
+
+def _read_reference_data(fname):
+    """
+    read the data used to measure the quantization error: the first image
+    with data, or the one dimensional image cutouts for MEDS files
+    """
+    import fitsio
+
+    with fitsio.FITS(fname) as fits:
+        if 'object_data' in fits:
+            return fits['image_cutouts'].read()
+        return _get_first_image_hdu(fits).read()
+
+
+def _profile_key(profile):
+    return tuple(sorted((k, str(v)) for k, v in profile.items()))
+
+
+def _print_compression_result(res):
+    print("%-6s %-40s ratio %.3f  compress %7.2f s  read %7.3f ms  err %.4f" % (
+        res['product'],
+        res['command'].split(' ', 1)[1].rsplit(' ', 1)[0],
+        res['ratio'],
+        res['compress_s'],
+        res['read_ms'],
+        res['rel_err'],
+    ))
@@ -0,0 +1,452 @@
+"""
+run-level columnar catalog
+
+The match catalogs for all indices of a run are consolidated into one
+store, so a column can be scanned over the full run without opening a
+file per index.  Each column is a flat binary file that can be memory
+mapped.  A schema file records the column types, and an append-only
+offsets file has a line for each append with the index, its first row,
+its number of rows and the modification time of the match file.
+
+Indices are appended as they complete.  Appends are serialized with a
+lock file, and the offsets line is written after the column data, so
+readers only ever see complete indices.  An index that is added again,
+e.g. after its job was resubmitted, is appended anew; the later entry
+supersedes the earlier one, whose rows are no longer read.
+"""
+from __future__ import print_function
+import os
+import json
+import numpy
+
+from . import files
+
+# fields not copied into the catalog
+SKIP_COLUMNS = ['vignet']
+
+SCHEMA_VERSION = 1
+
+
+class Catalog(object):
+    """
+    a run-level columnar catalog
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+
+    example
+    -------
+    cat = Catalog(run)
+    flux = cat['flux_auto']
+    data = cat.read(columns=['index','flux_auto','shear_index'])
+    rows = cat.read_index(35)
+    """
+    def __init__(self, run):
+        self.run = run
+        self.dir = files.get_catalog_dir(run)
+        self.reload()
+
+    def reload(self):
+        """
+        read the schema again, to see indices added since the catalog
+        was opened
+        """
+        self.schema = read_schema(self.run)
+
+        entries = read_offsets(self.run)
+        self._offsets = {}
+        self._indices = []
+        for index, start, nrows, mtime in entries:
+            if index in self._offsets:
+                self._indices.remove(index)
+            self._offsets[index] = (start, nrows)
+            self._indices.append(index)
+
+        self._raw_nrows = get_total_rows(entries)
+
+        # rows of superseded entries are skipped
+        nlive = sum(nrows for start, nrows in self._offsets.values())
+        if nlive == self._raw_nrows:
+            self._live = None
+        else:
+            ranges = sorted(self._offsets.values())
+            self._live = numpy.concatenate([
+                numpy.arange(start, start+nrows) for start, nrows in ranges
+            ])
+
+    @property
+    def nrows(self):
+        if self._live is None:
+            return self._raw_nrows
+        return self._live.size
+
+    @property
+    def columns(self):
+        return [c['name'] for c in self.schema['columns']]
+
+    @property
+    def indices(self):
+        """
+        the indices in the catalog, in the order they were added
+        """
+        return list(self._indices)
+
+    def has_index(self, index):
+        return index in self._offsets
+
+    def get_range(self, index):
+        """
+        get the (start, nrows) of the rows for the index in the column
+        files
+        """
+        if index not in self._offsets:
+            raise KeyError("index %d not in catalog for run %s" % (index, self.run))
+
+        return self._offsets[index]
+
+    def get_column(self, name):
+        """
+        get a read-only memory map of the column.  If indices were added
+        more than once, this is a copy of the current rows instead
+        """
+        data = self._get_raw_column(name)
+        if self._live is not None:
+            data = data[self._live]
+        return data
+
+    def __getitem__(self, name):
+        return self.get_column(name)
+
+    def read(self, columns=None, rows=None):
+        """
+        read columns into a structured array
+
+        parameters
+        ----------
+        columns: sequence of strings, optional
+            Columns to read, default all
+        rows: slice or array, optional
+            Rows to read, default all
+        """
+        return self._read(self.get_column, columns, rows)
+
+    def read_index(self, index, columns=None):
+        """
+        read the rows for a single index
+        """
+        start, nrows = self.get_range(index)
+        return self._read(
+            self._get_raw_column, columns, slice(start, start+nrows),
+        )
+
+    def _read(self, get_column, columns, rows):
+        if columns is None:
+            columns = self.columns
+
+        dt = []
+        for name in columns:
+            col = self._get_column_info(name)
+            dt.append( (name, col['dtype'], tuple(col['shape'])) )
+
+        if rows is None:
+            rows = slice(None)
+
+        first = get_column(columns[0])[rows]
+        output = numpy.zeros(len(first), dtype=dt)
+        output[columns[0]] = first
+        for name in columns[1:]:
+            output[name] = get_column(name)[rows]
+
+        return output
+
+    def _get_raw_column(self, name):
+        """
+        memory map of all rows in the column file, including those of
+        superseded entries
+        """
+        col = self._get_column_info(name)
+        fname = get_column_file(self.run, name)
+        shape = (self._raw_nrows,) + tuple(col['shape'])
+
+        if self._raw_nrows == 0:
+            return numpy.zeros(shape, dtype=col['dtype'])
+
+        return numpy.memmap(fname, dtype=col['dtype'], mode='r', shape=shape)
+
+    def _get_column_info(self, name):
+        for col in self.schema['columns']:
+            if col['name'] == name:
+                return col
+
+        raise KeyError("no column '%s' in catalog for run %s" % (name, self.run))
+
+
+def add_index(run, index, data=None):
+    """
+    append the match catalog for an index to the run catalog
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    index: int
+        The index to add
+    data: array, optional
+        The match catalog.  If not sent it is read from the match file
+
+    If the index is already in the catalog, the new rows supersede the
+    old ones.  The modification time of the match file is recorded, if
+    it exists, so build_catalog does not add the index again
+    """
+    fname = files.get_sxcat_match_file(run, index)
+
+    mtime = 0.0
+    if os.path.exists(fname):
+        mtime = os.path.getmtime(fname)
+
+    if data is None:
+        import fitsio
+        print("reading:",fname)
+        data = fitsio.read(fname, lower=True)
+
+    with CatalogLock(run):
+        schema = read_schema(run)
+        entries = read_offsets(run)
+        if any(i == index for i, start, nrows, t in entries):
+            print("replacing index %d in catalog" % index)
+
+        if len(schema['columns']) == 0:
+            schema['columns'] = get_columns(data)
+            write_schema(run, schema)
+        else:
+            _check_columns(schema['columns'], data)
+
+        nrows = get_total_rows(entries)
+        for col in schema['columns']:
+            name = col['name']
+            if name == 'index':
+                coldata = numpy.zeros(data.size, dtype=col['dtype']) + index
+            else:
+                coldata = numpy.ascontiguousarray(data[name], dtype=col['dtype'])
+
+            _append_column(run, col, nrows, coldata)
+
+        _append_offsets(run, index, nrows, data.size, mtime)
+
+
+def build_catalog(run, indices=None):
+    """
+    add the match catalogs for all completed indices that are not yet in
+    the catalog, or whose match file changed since it was added
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    indices: sequence of ints, optional
+        The indices to consider, default all in the run
+
+    returns
+    -------
+    list of indices that were added
+    """
+    if indices is None:
+        conf = files.read_config(run)
+        indices = list(range(conf['output']['nfiles']))
+
+    mtimes = dict(
+        (index, mtime) for index, start, nrows, mtime in read_offsets(run)
+    )
+
+    added = []
+    for index in indices:
+        fname = files.get_sxcat_match_file(run, index)
+        if not os.path.exists(fname):
+            continue
+
+        if index in mtimes and mtimes[index] == os.path.getmtime(fname):
+            continue
+
+        add_index(run, index)
+        added.append(index)
+
+    print("added %d indices to catalog" % len(added))
+    return added
+
+
+def get_columns(data):
+    """
+    get the column descriptions for a match catalog, with the index
+    column first and without the skipped columns
+    """
+    columns = [{'name':'index', 'dtype':'<i4', 'shape':[]}]
+
+    for name in data.dtype.names:
+        if name in SKIP_COLUMNS or name == 'index':
+            continue
+
+        dt, shape = data.dtype.fields[name][0], []
+        if dt.subdtype is not None:
+            dt, shape = dt.subdtype[0], list(dt.subdtype[1])
+
+        columns.append({
+            'name': name,
+            'dtype': dt.newbyteorder('<').str if dt.kind != 'S' else dt.str,
+            'shape': shape,
+        })
+
+    return columns
+
+
+def read_schema(run):
+    """
+    read the schema for the catalog, which is empty if the catalog has
+    not been started
+    """
+    fname = files.get_catalog_schema_file(run)
+    if not os.path.exists(fname):
+        return {
+            'version': SCHEMA_VERSION,
+            'columns': [],
+        }
+
+    with open(fname) as fobj:
+        return json.load(fobj)
+
+
+def read_offsets(run):
+    """
+    read the entries in the offsets file
+
+    returns
+    -------
+    list of (index, start, nrows, mtime), in the order they were added.
+    A later entry for an index supersedes earlier ones
+    """
+    return _read_offsets(run)[0]
+
+
+def get_total_rows(entries):
+    """
+    number of rows in the column files, including superseded entries
+    """
+    if len(entries) == 0:
+        return 0
+    return max(start + nrows for index, start, nrows, mtime in entries)
+
+
+def write_schema(run, schema):
+    """
+    write the schema to a temporary file and rename it into place
+    """
+    fname = files.get_catalog_schema_file(run)
+    tmpname = '%s.tmp%d' % (fname, os.getpid())
+
+    with open(tmpname, 'w') as fobj:
+        json.dump(schema, fobj)
+        fobj.flush()
+        os.fsync(fobj.fileno())
+
+    os.rename(tmpname, fname)
+
+
+def get_column_file(run, name):
+    return os.path.join(files.get_catalog_dir(run), '%s.dat' % name)
+
+
+class CatalogLock(object):
+    """
+    exclusive lock on the catalog for appends
+    """
+    def __init__(self, run):
+        self.run = run
+
+    def __enter__(self):
+        import fcntl
+
+        dir = files.get_catalog_dir(self.run)
+        if not os.path.exists(dir):
+            try:
+                os.makedirs(dir)
+            except OSError:
+                if not os.path.exists(dir):
+                    raise
+
+        self.fobj = open(files.get_catalog_lock_file(self.run), 'a')
+        fcntl.flock(self.fobj.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        import fcntl
+        fcntl.flock(self.fobj.fileno(), fcntl.LOCK_UN)
+        self.fobj.close()
+
+
+def _append_column(run, col, nrows, coldata):
+    """
+    append data to a column file.  Anything past the rows recorded in
+    the offsets file is left over from a failed append and is discarded
+    """
+    fname = get_column_file(run, col['name'])
+    itemsize = numpy.dtype(col['dtype']).itemsize*int(numpy.prod(col['shape']))
+
+    with open(fname, 'ab') as fobj:
+        fobj.truncate(nrows*itemsize)
+        fobj.seek(nrows*itemsize)
+        fobj.write(coldata.tobytes())
+        fobj.flush()
+        os.fsync(fobj.fileno())
+
+
+def _read_offsets(run):
+    """
+    read the offsets file, returning the entries and the number of bytes
+    of complete lines
+    """
+    fname = files.get_catalog_offsets_file(run)
+    if not os.path.exists(fname):
+        return [], 0
+
+    entries = []
+    nbytes = 0
+    with open(fname, 'rb') as fobj:
+        for line in fobj:
+            # a line being written by another process, or left by a
+            # failed append
+            if not line.endswith(b'\n'):
+                break
+            nbytes += len(line)
+
+            index, start, nrows, mtime = line.split()
+            entries.append( (int(index), int(start), int(nrows), float(mtime)) )
+
+    return entries, nbytes
+
+
+def _append_offsets(run, index, start, nrows, mtime):
+    """
+    append an entry to the offsets file, discarding any partial line
+    left by a failed append
+    """
+    fname = files.get_catalog_offsets_file(run)
+    entries, nbytes = _read_offsets(run)
+
+    with open(fname, 'ab') as fobj:
+        fobj.truncate(nbytes)
+        fobj.seek(nbytes)
+        line = '%d %d %d %r\n' % (index, start, nrows, mtime)
+        fobj.write(line.encode('ascii'))
+        fobj.flush()
+        os.fsync(fobj.fileno())
+
+
+def _check_columns(columns, data):
+    names = data.dtype.names
+    missing = [
+        c['name'] for c in columns
+        if c['name'] != 'index' and c['name'] not in names
+    ]
+    if len(missing) > 0:
+        raise ValueError("match catalog is missing columns: %s" % missing)
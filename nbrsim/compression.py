@@ -0,0 +1,115 @@
+"""
+fpack settings for each product type
+
+The settings are read from compression.yaml in the share directory, with
+one profile per product: image, seg and meds.
+"""
+from __future__ import print_function
+import os
+
+from . import files
+
+PRODUCTS = ['image', 'seg', 'meds']
+
+# tiles by row, as fpack does when no tile is given
+DEFAULT_TILE = [10240, 1]
+
+ALGORITHM_FLAGS = {
+    'rice': '-r',
+    'gzip': '-g',
+    'gzip2': '-g2',
+    'hcompress': '-h',
+    'plio': '-p',
+}
+
+
+def read_profiles():
+    """
+    read the compression profiles for all products
+    """
+    return files.read_yaml(files.get_compression_config())
+
+
+def get_profile(product):
+    """
+    get the compression profile for a product
+
+    parameters
+    ----------
+    product: string
+        'image', 'seg' or 'meds'
+    """
+    profiles = read_profiles()
+    if product not in profiles:
+        raise ValueError("no compression profile for product '%s', "
+                         "expected one of %s" % (product, list(profiles.keys())))
+
+    return profiles[product]
+
+
+def get_fpack_command(product, fname=None):
+    """
+    get the fpack command for a product
+
+    parameters
+    ----------
+    product: string
+        'image', 'seg' or 'meds'
+    fname: string, optional
+        The file to compress.  If not sent, the command has a {fname}
+        field to be filled in with format()
+    """
+    return make_fpack_command(get_profile(product), fname=fname)
+
+
+def make_fpack_command(profile, fname=None):
+    """
+    make the fpack command for a compression profile
+
+    parameters
+    ----------
+    profile: dict
+        With entries type, quantize, preserve_zero and tile, all optional
+    fname: string, optional
+        The file to compress.  If not sent, the command has a {fname}
+        field to be filled in with format()
+    """
+    args = ['fpack']
+
+    ctype = profile.get('type', 'rice')
+    if ctype not in ALGORITHM_FLAGS:
+        raise ValueError("bad compression type '%s', expected one "
+                         "of %s" % (ctype, list(ALGORITHM_FLAGS.keys())))
+    args.append(ALGORITHM_FLAGS[ctype])
+
+    quantize = profile.get('quantize', None)
+    if quantize is not None:
+        if quantize == 0:
+            args += ['-q', '0']
+        elif profile.get('preserve_zero', True):
+            args += ['-qz', '%g' % quantize]
+        else:
+            args += ['-q', '%g' % quantize]
+
+    tile = profile.get('tile', None)
+    if tile is not None:
+        args += ['-t', ','.join('%d' % t for t in tile)]
+
+    if fname is None:
+        fname = '{fname}'
+    args.append(fname)
+
+    return ' '.join(args)
+
+
+def get_product(fname):
+    """
+    guess the product type from a file name
+    """
+    bname = os.path.basename(fname)
+    if '-meds' in bname:
+        return 'meds'
+    elif '-seg' in bname:
+        return 'seg'
+    else:
+        return 'image'
@@ -0,0 +1,150 @@
+"""
+cached reading of yaml configuration files
+
+Parsed configs are kept in memory for the life of the process, keyed by
+the file path and validated against the modification time, size and
+content hash of the file.  Optionally a pre-parsed copy is also stored
+on disk, so other processes can skip parsing entirely.
+"""
+from __future__ import print_function
+import os
+import copy
+import pickle
+import hashlib
+
+# in-memory cache, keyed by real path
+_cache = {}
+
+
+def read_yaml(fname, cache_file=None):
+    """
+    read a yaml file, using the cache when possible
+
+    parameters
+    ----------
+    fname: string
+        The yaml file
+    cache_file: string, optional
+        Location of a pre-parsed copy on disk.  It is read if valid,
+        and written after parsing otherwise.
+
+    returns
+    -------
+    A copy of the parsed data, which the caller may modify
+    """
+    path = os.path.realpath(fname)
+    st = os.stat(path)
+
+    entry = _cache.get(path)
+    if entry is not None and _stat_matches(entry, st):
+        return copy.deepcopy(entry['data'])
+
+    if entry is None and cache_file is not None:
+        entry = _read_cache_file(cache_file, path)
+        if entry is not None and _stat_matches(entry, st):
+            _cache[path] = entry
+            return copy.deepcopy(entry['data'])
+
+    print("reading:",fname)
+    with open(path, 'rb') as fobj:
+        text = fobj.read()
+
+    digest = hashlib.sha1(text).hexdigest()
+
+    if entry is not None and entry['digest'] == digest:
+        # touched but not changed
+        data = entry['data']
+    else:
+        data = parse_yaml(text)
+
+    entry = {
+        'path': path,
+        'mtime': st.st_mtime,
+        'size': st.st_size,
+        'digest': digest,
+        'data': data,
+    }
+    _cache[path] = entry
+
+    if cache_file is not None:
+        _write_cache_file(cache_file, entry)
+
+    return copy.deepcopy(data)
+
+
+def parse_yaml(text):
+    """
+    parse yaml text, using the C loader if it is available
+    """
+    import yaml
+
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return yaml.load(text, Loader=loader)
+
+
+def get_config_digest(conf):
+    """
+    get a hash of a config or part of a config, independent of the
+    order of dictionary keys
+
+    parameters
+    ----------
+    conf: dict or other yaml-representable data
+
+    returns
+    -------
+    hex digest string
+    """
+    import json
+
+    text = json.dumps(conf, sort_keys=True)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def clear_cache():
+    """
+    clear the in-memory cache
+    """
+    _cache.clear()
+
+
+def _stat_matches(entry, st):
+    return entry['mtime'] == st.st_mtime and entry['size'] == st.st_size
+
+
+def _read_cache_file(cache_file, path):
+    """
+    read the pre-parsed config, returning None if it is missing,
+    unreadable or for a different file
+    """
+    if not os.path.exists(cache_file):
+        return None
+
+    try:
+        with open(cache_file, 'rb') as fobj:
+            entry = pickle.load(fobj)
+    except Exception as err:
+        print("could not read config cache %s: %s" % (cache_file, err))
+        return None
+
+    if not isinstance(entry, dict) or entry.get('path') != path:
+        return None
+
+    return entry
+
+
+def _write_cache_file(cache_file, entry):
+    """
+    write the pre-parsed config to a temporary file and rename it into
+    place, so readers never see a partial file.  Failure to write is not
+    an error
+    """
+    tmpname = '%s.tmp%d' % (cache_file, os.getpid())
+    try:
+        with open(tmpname, 'wb') as fobj:
+            pickle.dump(entry, fobj, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmpname, cache_file)
+    except (IOError, OSError) as err:
+        print("could not write config cache %s: %s" % (cache_file, err))
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
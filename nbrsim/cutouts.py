@@ -0,0 +1,112 @@
+"""
+memory-mapped image sources for the MEDS writer
+
+Images are stored fpacked, and reading a full extension into memory for
+each cutout type makes the peak memory grow with the image size.  An
+ImageSource instead decompresses the image once, a block of rows at a
+time, into a memory-mapped scratch file.  Only the pages holding the
+cutouts being extracted are resident, so memory stays flat no matter
+how big the image is.
+"""
+from __future__ import print_function
+import os
+import tempfile
+import numpy
+
+# rows decompressed at a time when filling the scratch file
+DEFAULT_CHUNK_ROWS = 1024
+
+
+class ImageSource(object):
+    """
+    a memory-mapped, decompressed copy of an image extension
+
+    parameters
+    ----------
+    fname: string
+        The fits file, possibly tile compressed
+    ext: int or string
+        The extension to read
+    tmpdir: string, optional
+        Directory for the scratch file, default the system temporary
+        directory
+    chunk_rows: int, optional
+        Number of rows to decompress at a time
+
+    The scratch file is removed as soon as it is mapped, so it is cleaned
+    up by the system when the source is closed or the process exits.
+    The array is mapped read-write.  Pages modified in place, e.g. by
+    scaling or background subtraction, stay backed by the scratch file
+    and can be evicted, rather than becoming private memory as they would
+    with a copy-on-write map.  The input file is never changed.
+
+    example
+    -------
+    with ImageSource(image_file, 1) as source:
+        stamp = source.array[row:row+box_size, col:col+box_size]
+    """
+    def __init__(self, fname, ext, tmpdir=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+        self.fname = fname
+        self.ext = ext
+        self.tmpdir = tmpdir
+        self.chunk_rows = chunk_rows
+
+        self.array = self._load()
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    def close(self):
+        """
+        release the mapping
+        """
+        self.array = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def _load(self):
+        """
+        decompress the image into the scratch file, one block of rows at
+        a time, and map it
+        """
+        import fitsio
+
+        with fitsio.FITS(self.fname) as fits:
+            hdu = fits[self.ext]
+            nrow, ncol = hdu.get_dims()
+
+            # the type after any scaling is applied
+            first = hdu[0:1, :]
+            dtype = first.dtype
+
+            fd, scratch = tempfile.mkstemp(
+                prefix='nbrsim-image-',
+                suffix='.dat',
+                dir=self.tmpdir,
+            )
+            os.close(fd)
+
+            try:
+                print("decompressing %s[%s] to %s" % (self.fname, self.ext, scratch))
+                mm = numpy.memmap(scratch, dtype=dtype, mode='w+', shape=(nrow, ncol))
+
+                for row in range(0, nrow, self.chunk_rows):
+                    end = min(row + self.chunk_rows, nrow)
+                    mm[row:end, :] = hdu[row:end, :]
+
+                mm.flush()
+            finally:
+                # the mapping keeps the data alive
+                os.remove(scratch)
+
+        return mm
+
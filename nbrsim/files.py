@@ -97,6 +97,15 @@ def get_meds_script_file(run, index):
     basename = get_generic_basename(run, index=index, type='meds', ext='sh')
     return os.path.join(dir, basename)
 
+def get_pipeline_script_file(run, index):
+    """
+    get the script file path for the fused pipeline
+    """
+
+    dir=get_script_dir(run, index)
+    basename = get_generic_basename(run, index=index, type='pipeline', ext='sh')
+    return os.path.join(dir, basename)
+
 
 def get_wq_dir(run):
     """
@@ -136,6 +145,14 @@ def get_meds_wq_file(run, index):
     basename = get_generic_basename(run, index=index, type='meds', ext='yaml')
     return os.path.join(dir, basename)
 
+def get_pipeline_wq_file(run, index):
+    """
+    get the script file path
+    """
+    dir=get_wq_dir(run)
+    basename = get_generic_basename(run, index=index, type='pipeline', ext='yaml')
+    return os.path.join(dir, basename)
+
 def get_galsim_lsf_file(run, index):
     """
     get the script file path
@@ -160,6 +177,14 @@ def get_meds_lsf_file(run, index):
     basename = get_generic_basename(run, index=index, type='meds', ext='lsf')
     return os.path.join(dir, basename)
 
+def get_pipeline_lsf_file(run, index):
+    """
+    get the script file path
+    """
+    dir=get_lsf_dir(run)
+    basename = get_generic_basename(run, index=index, type='pipeline', ext='lsf')
+    return os.path.join(dir, basename)
+
 
 
 
@@ -177,6 +202,40 @@ def get_image_file(run, index, ext='fits.fz'):
 
     return os.path.join(dir, basename)
 
+def parse_image_file(fname):
+    """
+    get the run and index from the name of an image file
+
+    returns
+    -------
+    (run, index), or (None, None) if the name is not recognized
+    """
+    import re
+
+    pattern = r'^%s-(.+)-(\d+)-image\.fits(\.fz)?$' % FILE_FRONT
+    m = re.match(pattern, os.path.basename(fname))
+    if m is None:
+        return None, None
+
+    return m.group(1), int(m.group(2))
+
+def parse_file_name(fname):
+    """
+    get the run, index and type from the name of a per-index file
+
+    returns
+    -------
+    (run, index, type), or (None, None, None) if the name is not recognized
+    """
+    import re
+
+    pattern = r'^%s-(.+)-(\d+)-([^.]+)\..+$' % FILE_FRONT
+    m = re.match(pattern, os.path.basename(fname))
+    if m is None:
+        return None, None, None
+
+    return m.group(1), int(m.group(2)), m.group(3)
+
 def get_seg_file(run, index, ext='fits.fz'):
     """
     get the path to a image file
@@ -220,6 +279,50 @@ def get_sxcat_match_file(run, index):
     return os.path.join(dir, basename)
 
 
+def get_psf_diag_file(run, index):
+    """
+    get the path to the star/psf model moments comparison file
+    """
+    dir=get_output_dir(run, index)
+    basename = get_generic_basename(
+        run,
+        index=index,
+        type='psfdiag',
+        ext='fits',
+    )
+
+    return os.path.join(dir, basename)
+
+
+def get_sizemag_file(run, index):
+    """
+    get the path to the size-magnitude data used for plotting
+    """
+    dir=get_output_dir(run, index)
+    basename = get_generic_basename(
+        run,
+        index=index,
+        type='sizemag',
+        ext='fits',
+    )
+
+    return os.path.join(dir, basename)
+
+def get_sizemag_plot_file(run, index):
+    """
+    get the path to the size-magnitude plot
+    """
+    dir=get_output_dir(run, index)
+    basename = get_generic_basename(
+        run,
+        index=index,
+        type='sizemag',
+        ext='eps',
+    )
+
+    return os.path.join(dir, basename)
+
+
 def get_meds_file(run, index, ext='fits.fz'):
     """
     get the path to a image file
@@ -290,6 +393,66 @@ def get_meds_log_file(run, index):
 
     return os.path.join(dir, basename)
 
+def get_pipeline_log_file(run, index):
+    """
+    location of the log file
+    """
+
+    dir=get_output_dir(run, index)
+    basename = get_generic_basename(run, index=index, type='pipeline', ext='log')
+
+    return os.path.join(dir, basename)
+
+#
+# run-level catalog
+#
+
+def get_catalog_dir(run):
+    """
+    directory holding the run-level columnar catalog
+    """
+    return os.path.join(get_rundir(run), 'catalog')
+
+def get_catalog_schema_file(run):
+    """
+    the schema for the catalog, with the column types
+    """
+    return os.path.join(get_catalog_dir(run), 'schema.json')
+
+def get_catalog_offsets_file(run):
+    """
+    the row offsets of each index in the catalog, one line per append
+    """
+    return os.path.join(get_catalog_dir(run), 'offsets.txt')
+
+def get_catalog_lock_file(run):
+    """
+    lock file used when appending to the catalog
+    """
+    return os.path.join(get_catalog_dir(run), 'lock')
+
+def get_aggregate_file(run):
+    """
+    shear statistics aggregated over the run by nbrsim-aggregate
+    """
+    basename = get_generic_basename(run, type='aggregate', ext='fits')
+    return os.path.join(get_rundir(run), basename)
+
+def get_aggregate_partials_file(run):
+    """
+    per-index shear statistics written by nbrsim-aggregate, used for
+    resampling errors
+    """
+    basename = get_generic_basename(run, type='aggregate-partials', ext='fits')
+    return os.path.join(get_rundir(run), basename)
+
+def read_catalog(run):
+    """
+    open the run-level catalog, whose columns are memory mapped
+    """
+    from .catalog import Catalog
+    return Catalog(run)
+
 
 #
 # configuration files
@@ -304,33 +467,252 @@ def get_config_dir():
 
     return os.environ[CONFIG_DIR_KEY]
 
-def get_config_file(run):
+def get_config_file(run, cached=True):
     """
     the path to the config file
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    cached: bool, optional
+        If True, get the node cached copy when there is one
     """
 
     cdir=get_config_dir()
     basename = get_generic_basename(run, ext='yaml')
-    return os.path.join(cdir, basename)
+    fname = os.path.join(cdir, basename)
+    if cached:
+        fname = resolve_cached(fname)
+    return fname
+
+
+def get_cache_manifest_file(run):
+    """
+    the manifest of files for the node cache, kept in the run directory
+    """
+    rdir=get_rundir(run)
+    basename = get_generic_basename(run, type='cache-manifest', ext='json')
+    return os.path.join(rdir, basename)
+
+def resolve_cached(path):
+    """
+    get the node cached copy of a shared file, if the node cache was
+    activated for the run, otherwise the path itself
+    """
+    from . import nodecache
+    return nodecache.resolve(path)
+
+def get_plan_file(run):
+    """
+    the resource estimates made by nbrsim-plan, kept in the run directory
+    """
+    rdir=get_rundir(run)
+    basename = get_generic_basename(run, type='plan', ext='yaml')
+    return os.path.join(rdir, basename)
+
+def get_verify_file(run):
+    """
+    results of nbrsim-verify, kept in the run directory
+    """
+    rdir=get_rundir(run)
+    basename = get_generic_basename(run, type='verify', ext='json')
+    return os.path.join(rdir, basename)
+
+def get_pack_dir(run):
+    """
+    directory holding the packed small files for the run
+    """
+    return os.path.join(get_rundir(run), 'pack')
+
+def get_pack_data_file(run, shard):
+    """
+    the data for a shard of the packed files
+    """
+    basename = get_generic_basename(run, type='pack-%03d' % shard, ext='dat')
+    return os.path.join(get_pack_dir(run), basename)
+
+def get_pack_index_file(run, shard):
+    """
+    the index for a shard of the packed files
+    """
+    basename = get_generic_basename(run, type='pack-%03d' % shard, ext='idx')
+    return os.path.join(get_pack_dir(run), basename)
+
+def get_pack_lock_file(run, shard):
+    """
+    lock file used when appending to a shard of the packed files
+    """
+    basename = get_generic_basename(run, type='pack-%03d' % shard, ext='lock')
+    return os.path.join(get_pack_dir(run), basename)
+
+def is_packed(run):
+    """
+    check if the small per-index files of the run are packed
+    """
+    from . import pack
+    return pack.is_enabled(run)
+
+def open_file(fname, mode='r'):
+    """
+    open a per-index file from the paths above
+
+    For packed runs, small files are read from the pack and a read only
+    file-like object is returned.  Otherwise, and for files that exist
+    on disk, this is the same as open
+
+    parameters
+    ----------
+    fname: string
+        The path, e.g. from get_reduce_log_file
+    mode: string, optional
+        The mode, default 'r'
+    """
+    from . import pack
 
+    run = _get_packed_run(fname)
+    if run is not None and mode in ('r', 'rb') and not os.path.exists(fname):
+        if pack.exists(run, os.path.basename(fname)):
+            return pack.open_file(run, os.path.basename(fname), mode=mode)
+
+    return open(fname, mode)
+
+def file_exists(fname):
+    """
+    check if a per-index file exists, on disk or in the pack
+    """
+    from . import pack
+
+    if os.path.exists(fname):
+        return True
+
+    run = _get_packed_run(fname)
+    if run is None:
+        return False
+    return pack.exists(run, os.path.basename(fname))
+
+def write_file(fname, data):
+    """
+    write a per-index file, into the pack for small files of packed runs
+
+    parameters
+    ----------
+    fname: string
+        The path, e.g. from get_reduce_script_file
+    data: string or bytes
+        The contents
+    """
+    from . import pack
+
+    run = _get_packed_run(fname)
+    if run is not None:
+        pack.add(run, os.path.basename(fname), data)
+        return
+
+    mode = 'wb' if isinstance(data, bytes) else 'w'
+    with open(fname, mode) as fobj:
+        fobj.write(data)
+
+def store_file(local_file, fname, remove=False):
+    """
+    put a small file made in a work directory into the pack, for packed
+    runs
+
+    parameters
+    ----------
+    local_file: string
+        The file to store
+    fname: string
+        The final path, whose name is used in the pack
+    remove: bool, optional
+        If True, remove the local file once stored
+
+    returns
+    -------
+    True if the file was stored.  If False, the run is not packed or the
+    file is not of a packed type, and the caller should copy it as usual
+    """
+    from . import pack
+
+    run = _get_packed_run(fname)
+    if run is None:
+        return False
+
+    pack.add_file(run, local_file, name=os.path.basename(fname), remove=remove)
+    return True
+
+def _get_packed_run(fname):
+    """
+    the run for a file that belongs in the pack, or None
+    """
+    from . import pack
+
+    if not pack.is_packable(fname):
+        return None
+
+    run, index, type = parse_file_name(fname)
+    if run is None or not is_packed(run):
+        return None
+
+    return run
+
+def get_config_cache_file(run):
+    """
+    the path to the pre-parsed copy of the config file, kept
+    in the run directory
+    """
+    rdir=get_rundir(run)
+    basename = get_generic_basename(run, type='config', ext='pkl')
+    return os.path.join(rdir, basename)
+
+def get_psf_cache_dir(run):
+    """
+    directory holding rendered psf images for the run
+    """
+    rdir=get_rundir(run)
+    return os.path.join(rdir, 'psf-cache')
+
+def get_psf_cache_file(run, key):
+    """
+    the path to a rendered psf image
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    key: string
+        hash of the psf and wcs config
+    """
+    dir=get_psf_cache_dir(run)
+    basename = get_generic_basename(run, type='psf-%s' % key, ext='fits')
+    return os.path.join(dir, basename)
 
 def read_config(run):
     """
     read the yaml config file
+
+    The parsed config is cached in memory and in the run directory
     """
     fname = get_config_file(run)
-    return read_yaml(fname)
 
-def read_yaml(fname):
+    cache_file = get_config_cache_file(run)
+    if fname != get_config_file(run, cached=False):
+        # keep the pre-parsed copy next to the node cached config
+        cache_file = os.path.join(os.path.dirname(fname), os.path.basename(cache_file))
+    elif not os.path.exists(os.path.dirname(cache_file)):
+        cache_file = None
+
+    return read_yaml(fname, cache_file=cache_file)
+
+def read_yaml(fname, cache_file=None):
     """
     wrapper to read yaml files
-    """
-    import yaml
-    print("reading:",fname)
-    with open(fname) as fobj:
-        data=yaml.load( fobj )
 
-    return data
+    The parsed data are cached in memory, and optionally in the
+    specified cache file
+    """
+    from . import config
+    return config.read_yaml(fname, cache_file=cache_file)
 
 
 
@@ -361,39 +743,43 @@ def get_share_dir():
 # config files
 def get_sx_config():
     d=get_share_dir()
-    return os.path.join(d, 'sx.conf')
+    return resolve_cached(os.path.join(d, 'sx.conf'))
 
 def get_sx_params():
     d=get_share_dir()
-    return os.path.join(d, 'sx.param')
+    return resolve_cached(os.path.join(d, 'sx.param'))
 
 def get_sx_filter():
     d=get_share_dir()
-    return os.path.join(d, 'sx.conv')
+    return resolve_cached(os.path.join(d, 'sx.conv'))
 
 def get_sx_nnw():
     d=get_share_dir()
-    return os.path.join(d, 'sx.nnw')
+    return resolve_cached(os.path.join(d, 'sx.nnw'))
 
 
 
 def get_psfex_config():
     d=get_share_dir()
-    return os.path.join(d, 'psfex.conf')
+    return resolve_cached(os.path.join(d, 'psfex.conf'))
 
 def get_wl_config():
     d=get_share_dir()
-    return os.path.join(d, 'wl.config')
+    return resolve_cached(os.path.join(d, 'wl.config'))
 
 def get_findstars_config():
     d=get_share_dir()
-    return os.path.join(d, 'findstars.config')
+    return resolve_cached(os.path.join(d, 'findstars.config'))
 
 def get_piff_config():
     d=get_share_dir()
-    return os.path.join(d, 'piff.yaml')
+    return resolve_cached(os.path.join(d, 'piff.yaml'))
 
 
 def get_meds_config():
     d=get_share_dir()
-    return os.path.join(d, 'meds.yaml')
+    return resolve_cached(os.path.join(d, 'meds.yaml'))
+
+def get_compression_config():
+    d=get_share_dir()
+    return resolve_cached(os.path.join(d, 'compression.yaml'))
@@ -0,0 +1,219 @@
+"""
+render the images for many indices in one process
+
+Running the galsim executable once per index means every image pays for
+starting python, importing galsim and processing the config.  Here the
+config is read and processed once, and each index is built from it with
+the galsim config API, so processed inputs and galsim's profile caches
+are reused from one image to the next.  The image for each index is
+compressed and staged out, along with its truth catalog, as soon as it
+is written.
+"""
+from __future__ import print_function
+import os
+import subprocess
+
+from . import files
+from . import nodecache
+from . import compression
+from .stageout import StageOut
+from .scratch import Scratch, estimate_footprint, get_image_shape
+
+
+class GalsimDriver(object):
+    """
+    render images for a run
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    work_dir: string, optional
+        Directory in which galsim writes.  Default is a scratch directory
+        made for the duration of go()
+    stage_out: bool, optional
+        If True, compress each image and stage it and the truth catalog
+        out to the output directory for the index
+    """
+    def __init__(self, run, work_dir=None, stage_out=True):
+        self.run = run
+        self.work_dir = work_dir
+        self.stage_out = stage_out
+
+        self.config = self._load_config()
+
+    def go(self, indices):
+        """
+        render the images for the specified indices
+        """
+        indices = list(indices)
+
+        scratch = None
+        if self.work_dir is None:
+            # room for the image being written while the previous one
+            # is staged out.  Without stage out the images are left in
+            # the directory
+            nbytes = estimate_footprint('galsim', get_image_shape(self.run))
+            if nbytes is not None:
+                nbytes *= 2 if self.stage_out else len(indices)
+            scratch = Scratch('galsim', nbytes=nbytes, keep=not self.stage_out)
+            self.work_dir = scratch.create()
+
+        stager = StageOut() if self.stage_out else None
+        try:
+            for index in indices:
+                self.render(index, stager=stager)
+        finally:
+            if stager is not None:
+                stager.close()
+
+            if scratch is not None:
+                scratch.release()
+                self.work_dir = None
+
+    def render(self, index, stager=None):
+        """
+        render the image for a single index, and optionally compress it
+        and stage it out
+
+        parameters
+        ----------
+        index: int
+            The index, which is the galsim file number
+        stager: StageOut, optional
+            If sent, compress the image and stage it and the truth
+            catalog out
+
+        returns
+        -------
+        The path to the uncompressed image in the work directory
+        """
+        import galsim
+
+        image_file = os.path.basename(
+            files.get_image_file(self.run, index, ext='fits'),
+        )
+
+        # same overrides as on the galsim command line; these must come
+        # after the config is read
+        self.config['output']['dir'] = self.work_dir
+        self.config['output']['file_name'] = image_file
+
+        print("rendering index %d: %s" % (index, image_file))
+        galsim.config.BuildFiles(1, self.config, file_num=index)
+
+        image_path = os.path.join(self.work_dir, image_file)
+        if stager is not None:
+            odir = files.get_output_dir(self.run, index)
+
+            compressed = compress_image(image_path)
+            stager.put(compressed, odir, remove=True)
+
+            truth_file = self.get_truth_file(index)
+            if truth_file is not None:
+                stager.put(truth_file, odir, remove=True)
+
+        return image_path
+
+    def get_truth_file(self, index):
+        """
+        get the path to the truth catalog galsim wrote for the index, or
+        None if the config has no truth output
+
+        The name is evaluated from output.truth in the config for this
+        file number, as galsim does when writing it, so a file left from
+        another index is never picked up
+        """
+        import galsim
+
+        truth = self.config['output'].get('truth')
+        if truth is None or 'file_name' not in truth:
+            return None
+
+        config = self.config
+        galsim.config.SetupConfigFileNum(
+            config,
+            index,
+            config.get('image_num', 0),
+            config.get('obj_num', 0),
+        )
+
+        galsim.config.SetDefaultExt(truth, '.fits')
+        fname = galsim.config.ParseValue(truth, 'file_name', config, str)[0]
+        if 'dir' in truth:
+            dir = galsim.config.ParseValue(truth, 'dir', config, str)[0]
+        else:
+            dir = self.work_dir
+        fname = os.path.join(dir, fname)
+
+        if not os.path.exists(fname):
+            raise RuntimeError("truth catalog for index %d "
+                               "not written: '%s'" % (index, fname))
+        return fname
+
+    def _load_config(self):
+        """
+        read the galsim config and do the processing that the galsim
+        executable does before building files
+        """
+        import galsim
+
+        nodecache.activate(self.run)
+
+        fname = files.get_config_file(self.run)
+        print("reading galsim config:",fname)
+        config = galsim.config.ReadConfig(fname)[0]
+
+        galsim.config.ImportModules(config)
+        if 'output' not in config:
+            config['output'] = {}
+
+        return config
+
+
+def compress_image(fname, remove=True):
+    """
+    fpack the image
+
+    parameters
+    ----------
+    fname: string
+        The uncompressed image
+    remove: bool, optional
+        If True, remove the uncompressed image
+
+    returns
+    -------
+    The path to the compressed file
+    """
+    cmd = compression.get_fpack_command('image', fname)
+    print(cmd)
+    subprocess.check_call(cmd, shell=True)
+
+    compressed = fname + '.fz'
+    if not os.path.exists(compressed):
+        raise RuntimeError("failed to compress image: '%s'" % fname)
+
+    if remove:
+        os.remove(fname)
+    return compressed
+
+
+def render_files(run, indices, work_dir=None, stage_out=True):
+    """
+    render the images for the specified indices in this process
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    indices: sequence of ints
+        The indices to render
+    work_dir: string, optional
+        Directory in which galsim writes, default a scratch directory
+    stage_out: bool, optional
+        If True, compress each image and stage it and the truth catalog
+        out to the output directory for the index
+    """
+    driver = GalsimDriver(run, work_dir=work_dir, stage_out=stage_out)
+    driver.go(indices)
@@ -3,23 +3,49 @@ import os
 import numpy
 import yaml
 
-import esutil as eu
 import meds
 import desmeds
 import fitsio
 
 from . import files
+from . import psfcache
+from . import psfgrid
+from . import nodecache
+from . import compression
+from .cutouts import ImageSource
+from .scratch import Scratch, estimate_footprint, get_image_shape_from_file
+from .moments import get_moments
 
+# fwhm = FWHM_FAC*sigma for a gaussian
+FWHM_FAC = 2*numpy.sqrt(2*numpy.log(2))
 
 class NbrSimMEDSMaker(desmeds.DESMEDSMakerDESDM):
-    def __init__(self, run, index):
+    def __init__(self, run, index, file_dict=None, cat=None):
         """
         load the config, catalog, and image info
+
+        parameters
+        ----------
+        run: string
+            The run identifier
+        index: int
+            The index to process
+        file_dict: dict, optional
+            Paths to use instead of those in the output directory, with
+            any of the keys set in _load_file_config
+        cat: array, optional
+            The matched catalog, rather than reading it from the
+            match file
         """
 
         self['run'] = run
         self['index'] = index
 
+        self._file_dict_override = file_dict
+        self._cat = cat
+
+        nodecache.activate(run)
+
         self._load_config()
         self._set_extra_config()
         self._load_file_config()
@@ -60,6 +86,18 @@ class NbrSimMEDSMaker(desmeds.DESMEDSMakerDESDM):
 
         return res
 
+    def _build_object_data(self):
+        """
+        make the object data, including box sizes and the sim-specific
+        fields, with whole-array operations
+        """
+        print('building object data')
+        self.obj_data = build_obj_data(
+            self.coadd_cat,
+            self,
+            extra_fields=self['extra_obj_data_fields'],
+        )
+
     def _read_coadd_cat(self):
         """
         we already read the catalog
@@ -72,8 +110,12 @@ class NbrSimMEDSMaker(desmeds.DESMEDSMakerDESDM):
         should already be the case)
         """
 
+        if self._cat is not None:
+            self.sxcat = self._cat
+            return
+
         #fname = files.get_sxcat_file(self['run'],self['index'])
-        fname = files.get_sxcat_match_file(self['run'],self['index'])
+        fname = self.file_dict['coadd_cat_url']
 
         print('reading coadd cat:',fname)
         cat = fitsio.read(
@@ -82,14 +124,6 @@ class NbrSimMEDSMaker(desmeds.DESMEDSMakerDESDM):
             lower=True,
         )
 
-        add_dt=[
-            ('ra','f8'),
-            ('dec','f8'),
-        ]
-        cat = eu.numpy_util.add_fields(cat, add_dt)
-        cat['ra'] = cat[self['ra_name']]
-        cat['dec'] = cat[self['dec_name']]
-
         self.sxcat = cat
 
 
@@ -107,10 +141,10 @@ class NbrSimMEDSMaker(desmeds.DESMEDSMakerDESDM):
             ('shear_true','f8',2),
         ]
 
-        # -qz 4.0 instead of -q 4.0
-        # this means preserve zero pixels
-        self['fpack_command'] = \
-            'fpack -qz 4.0 -t %d,%d {fname}' % tuple(self['fpack_dims'])
+        # settings are in the meds profile of compression.yaml
+        profile = compression.get_profile('meds')
+        self['fpack_dims'] = list(profile.get('tile', compression.DEFAULT_TILE))
+        self['fpack_command'] = compression.make_fpack_command(profile)
 
 
     def _load_config(self):
@@ -118,50 +152,58 @@ class NbrSimMEDSMaker(desmeds.DESMEDSMakerDESDM):
         load the config and the galsim config
         """
 
+        # send the parsed config so it goes through our cache
         fname = files.get_meds_config()
-        super(NbrSimMEDSMaker,self)._load_config(fname)
+        medsconf = files.read_yaml(fname)
+        super(NbrSimMEDSMaker,self)._load_config(medsconf)
 
         # also pull in the galsim config to get the psf
         self.galsim_conf = files.read_config(self['run'])
 
     def _set_psfs(self):
         """
-        set the list of psfs as galsim objects
-        """
-        import galsim
-        pconf = self.galsim_conf['psf']
-        wcsconf = self.galsim_conf['image']['wcs']
+        set the list of psfs.
 
-        type=pconf['type']
-        if type == 'Moffat':
-            psf = galsim.Moffat(
-                beta=pconf['beta'],
-                fwhm=pconf['fwhm'],
-            )
-        elif type == 'Gaussian':
-            psf = galsim.Moffat(
-                fwhm=pconf['fwhm'],
+        For psf_model 'galsim' the psf is constant and shared by all
+        indices in the run, so it comes from the psf cache.  For 'psfex'
+        or 'piff' we use the model fit by nbrsim-reduce, evaluated on a
+        grid across the image
+        """
+        psf_model = self.get('psf_model','galsim')
+
+        if psf_model == 'galsim':
+            psf = psfcache.get_psf(self['run'], self.galsim_conf)
+            psf_data = PSFMaker(psf['image'], cen=psf['cen'], sigma=psf['sigma'])
+
+        elif psf_model in ['psfex','piff']:
+            fname = self.file_dict['psf_url']
+            if psf_model == 'psfex':
+                draw_func = psfgrid.get_psfex_draw_func(fname)
+            else:
+                draw_func = psfgrid.get_piff_draw_func(
+                    fname,
+                    stamp_size=self.get('psf_stamp_size',25),
+                )
+
+            psf_data = psfgrid.PSFGrid(
+                draw_func,
+                self._get_image_shape(),
+                grid_shape=self.get('psf_grid', psfgrid.DEFAULT_GRID_SHAPE),
+                interp=self.get('psf_interp','bilinear'),
             )
         else:
-            raise ValueError("bad psf type: '%s'" % type)
+            raise ValueError("bad psf_model: '%s'" % psf_model)
 
-        if 'ellip' in pconf:
-            psf = psf.shear(
-                g1=pconf['ellip']['g1'],
-                g2=pconf['ellip']['g2'],
-            )
-
-        print("psf:",psf)
+        self.psf_data = [psf_data]
 
-        wcs = galsim.JacobianWCS(
-            dudx = wcsconf['dudx'],
-            dudy = wcsconf['dudy'],
-            dvdx = wcsconf['dvdx'],
-            dvdy = wcsconf['dvdy'],
-        )
-        self.psf_data = [PSFMaker(psf, wcs)]
+    def _get_image_shape(self):
+        """
+        get the shape of the image from the file
+        """
+        fname = self.file_dict['coadd_image_url']
+        with fitsio.FITS(fname) as fits:
+            return fits[self['coadd_image_ext']].get_dims()
 
-        
     def _load_srclist(self):
         """
         there are currently no single epoch images
@@ -191,11 +233,19 @@ class NbrSimMEDSMaker(desmeds.DESMEDSMakerDESDM):
         fd['coadd_magzp'] = 32.2
 
 
+        fd['psf_url'] = files.get_psfex_file(
+            self['run'],
+            self['index'],
+        )
+
         fd['meds_url'] = files.get_meds_file(
             self['run'],
             self['index'],
         )
 
+        if self._file_dict_override is not None:
+            fd.update(self._file_dict_override)
+
         self.file_dict=fd
 
     def _write_meds_file(self):
@@ -204,60 +254,278 @@ class NbrSimMEDSMaker(desmeds.DESMEDSMakerDESDM):
         """
         from desmeds.files import StagedOutFile
 
-        maker=meds.MEDSMaker(
-            self.obj_data,
-            self.image_info,
-            config=self,
-            psf_data=self.psf_data,
-            meta_data=self.meta_data,
-        )
+        # the scratch directory holds the memory-mapped images and the
+        # uncompressed file
+        shape = get_image_shape_from_file(self.file_dict['coadd_image_url'])
+        nbytes = estimate_footprint('meds', shape)
+
+        with Scratch('meds', nbytes=nbytes) as tmpdir:
+
+            maker=MEDSWriter(
+                self.obj_data,
+                self.image_info,
+                config=self,
+                psf_data=self.psf_data,
+                meta_data=self.meta_data,
+                tmpdir=tmpdir,
+            )
+
+            fname=self.file_dict['meds_url']
+
+            print("writing MEDS file:",fname)
+
+            with StagedOutFile(fname,tmpdir=tmpdir) as sf:
+
+                ucfile = os.path.basename(sf.path)
+                ucfile = ucfile.replace('.fits.fz','.fits')
+                ucfile = os.path.join(tmpdir, ucfile)
+
+                maker.write(ucfile)
+
+                cmd = self['fpack_command'].format(fname=ucfile)
+                print("compressing")
+                print(cmd)
+                ret=os.system(cmd)
+
+                if ret != 0:
+                    raise RuntimeError("failed to compress file")
+
+                if not os.path.exists(sf.path):
+                    raise RuntimeError("failed to make compressed meds "
+                                       "file: '%s'" % sf.path)
+
+                os.remove(ucfile)
+
+class MEDSWriter(meds.MEDSMaker):
+    """
+    MEDS writer that reads images through memory-mapped sources
+
+    Each image is decompressed once into a scratch file and mapped,
+    rather than read fully into memory for each cutout type, so memory
+    use does not grow with the image size.
+
+    parameters
+    ----------
+    tmpdir: string, optional
+        Directory for the scratch files
+
+    Other parameters are the same as meds.MEDSMaker
+    """
+    def __init__(self, *args, **kw):
+        self.tmpdir = kw.pop('tmpdir', None)
+        super(MEDSWriter,self).__init__(*args, **kw)
+
+    def _read_one_image(self, path, ext):
+        """
+        get the image as a memory-mapped array.  Scaling and background
+        subtraction are still done by meds.MEDSMaker._read_image
+        """
+        path = _to_str(path)
+        if isinstance(ext, (bytes, str)):
+            ext = _to_str(ext)
+
+        source = ImageSource(path, ext, tmpdir=self.tmpdir)
+        return source.array
+
+    def _write_psf_cutouts_array(self, fits):
+        """
+        write the psf cutouts, taking the images for all cutouts of each
+        psf source as one block from get_recs
+        """
+        print('writing psf cutouts')
+        cutout_hdu = self._get_cutout_hdu(fits, 'psf')
+        write_psf_cutouts(cutout_hdu, self.psf_data, self.obj_data)
+
+def write_psf_cutouts(cutout_hdu, psf_data, obj_data):
+    """
+    write the psf images for all cutouts into the psf cutout extension
+
+    The images for each psf source come from its get_recs method as a
+    single (n, psf_nrow, psf_ncol) block.  When the start rows of the
+    cutouts are contiguous, as they are for psfs of one size, the block is
+    written in one operation
+
+    parameters
+    ----------
+    cutout_hdu: fitsio HDU
+        The psf cutout extension
+    psf_data: list
+        The psf sources, indexed by file_id, with a get_recs method
+    obj_data: array
+        The MEDS object data, with the psf layout set
+    """
+    ncutout = obj_data['ncutout']
+    file_id = obj_data['file_id'].reshape(obj_data.size, -1)
+    ncutmax = file_id.shape[1]
+
+    iobj, icut = numpy.where(numpy.arange(ncutmax)[numpy.newaxis, :] < ncutout[:, numpy.newaxis])
+    if iobj.size == 0:
+        return
+
+    file_ids = file_id[iobj, icut]
+    rows = obj_data['orig_row'].reshape(obj_data.size, -1)[iobj, icut]
+    cols = obj_data['orig_col'].reshape(obj_data.size, -1)[iobj, icut]
+    start_rows = obj_data['psf_start_row'].reshape(obj_data.size, -1)[iobj, icut]
+
+    for fid in numpy.unique(file_ids):
+        w, = numpy.where(file_ids == fid)
+        recs = psf_data[fid].get_recs(rows[w], cols[w])
+        npix = recs.shape[1]*recs.shape[2]
+
+        order = numpy.argsort(start_rows[w], kind='stable')
+        starts = start_rows[w][order]
+
+        if numpy.all(numpy.diff(starts) == npix):
+            if numpy.any(order != numpy.arange(order.size)):
+                recs = recs[order]
+            block = numpy.ascontiguousarray(recs, dtype='f4').reshape(-1)
+            cutout_hdu.write(block, start=starts[0])
+        else:
+            for i in order:
+                cutout_hdu.write(recs[i].reshape(-1), start=start_rows[w[i]])
+
+def _to_str(val):
+    if isinstance(val, bytes):
+        val = val.decode()
+    return val.strip()
+
+def build_obj_data(cat, conf, extra_fields=None):
+    """
+    build the object data input for the MEDS writer
+
+    Only the inputs are set here.  The cutout offsets, start_row,
+    orig_row, orig_col, orig_start_row, orig_start_col, cutout_row and
+    cutout_col, are filled in by meds.MEDSMaker from the image info.
+
+    parameters
+    ----------
+    cat: array with fields
+        The sextractor catalog, matched to the truth, with lower case names
+    conf: dict
+        The MEDS config, with entries ra_name, dec_name, row_name,
+        col_name, position_offset and those needed by get_box_sizes
+    extra_fields: list, optional
+        Extra fields for the object data.  Those we know about are filled
+        in: number, input_row, input_col, shear_index, shear_true
+
+    returns
+    -------
+    obj_data: array
+    """
 
-        fname=self.file_dict['meds_url']
+    obj_data = meds.util.get_meds_input_struct(
+        cat.size,
+        extra_fields=extra_fields,
+    )
+    names = obj_data.dtype.names
 
-        print("writing MEDS file:",fname)
+    # there is no coadd object id for the sim
+    obj_data['id'] = 1 + numpy.arange(cat.size)
 
-        tmpdir = desmeds.files.get_temp_dir()
+    obj_data['ra'] = cat[conf['ra_name']]
+    obj_data['dec'] = cat[conf['dec_name']]
+    obj_data['box_size'] = get_box_sizes(cat, conf)
 
-        #maker.write(fname)
-        with StagedOutFile(fname,tmpdir=tmpdir) as sf:
-        #if True:
+    if 'number' in names:
+        obj_data['number'] = cat['number']
+
+    offset = conf['position_offset']
+    if 'input_row' in names:
+        obj_data['input_row'] = cat[conf['row_name']] - offset
+    if 'input_col' in names:
+        obj_data['input_col'] = cat[conf['col_name']] - offset
+
+    for name in ['shear_index','shear_true']:
+        if name in names:
+            obj_data[name] = cat[name]
+
+    return obj_data
+
+def get_box_sizes(cat, conf):
+    """
+    get box sizes that are either FFT friendly or are an integer multiple
+    of the size as measured by sextractor
+
+    The box is the larger of sigma_fac times the object size, increased
+    for elliptical objects, and the extent of the object's pixels.  It is
+    clipped to [min_box_size, max_box_size] and rounded up to the next of
+    the allowed_box_sizes.
+
+    parameters
+    ----------
+    cat: array with fields
+        The sextractor catalog, with lower case names
+    conf: dict
+        The config, with entries sigma_fac, min_box_size, max_box_size and
+        allowed_box_sizes
+
+    returns
+    -------
+    box_sizes: array
+    """
 
-            ucfile = os.path.basename(sf.path)
-            ucfile = ucfile.replace('.fits.fz','.fits')
-            ucfile = os.path.join(tmpdir, ucfile)
+    min_size = conf['min_box_size']
+    max_size = conf['max_box_size']
 
-            maker.write(ucfile)
+    # flux radius is the half light radius, 2*flux_radius ~ fwhm
+    sigma = cat['flux_radius']*2.0/FWHM_FAC
 
-            cmd = self['fpack_command'].format(fname=ucfile)
-            print("compressing")
-            print(cmd)
-            ret=os.system(cmd)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        ellipticity = 1.0 - cat['b_world']/cat['a_world']
+    ellipticity = numpy.where(numpy.isfinite(ellipticity), ellipticity, 0.0)
 
-            if ret != 0:
-                raise RuntimeError("failed to compress file")
-            
-            if not os.path.exists(sf.path):
-                raise RuntimeError("failed to make compressed meds "
-                                   "file: '%s'" % sf.path)
+    drad = numpy.ceil(sigma*conf['sigma_fac']*(1.0 + ellipticity))
+    sigma_size = 2*drad.astype('i4')
 
-            os.remove(ucfile)
+    # the extent as desmeds computes it, without adding one
+    row_size = cat['ymax_image'] - cat['ymin_image']
+    col_size = cat['xmax_image'] - cat['xmin_image']
+
+    box_size = numpy.maximum(sigma_size, numpy.maximum(row_size, col_size))
+    box_size = box_size.clip(min=min_size, max=max_size)
+
+    allowed = numpy.array(sorted(conf['allowed_box_sizes']))
+    allowed = allowed[(allowed >= min_size) & (allowed <= max_size)]
+    if allowed.size == 0 or allowed[-1] != max_size:
+        allowed = numpy.append(allowed, max_size)
+
+    ind = numpy.searchsorted(allowed, box_size, side='left')
+    return allowed[ind].astype('i4')
 
 class PSFMaker(object):
-    def __init__(self, psfobj, wcs):
-        self.psfobj = psfobj
-        self.wcs = wcs
+    """
+    provide the psf image to the MEDS writer
+
+    The psf is constant, so the same read-only image and centroid are
+    returned for every object rather than copies.  get_recs gives the
+    images for all objects as one block, used by write_psf_cutouts.
+
+    parameters
+    ----------
+    psfim: array
+        The psf image
+    cen: array, optional
+        The [row, col] centroid.  If not sent, it is measured
+    sigma: float, optional
+        The psf size sqrt(T/2).  If not sent, it is measured
+    """
+    def __init__(self, psfim, cen=None, sigma=None):
 
         # assume constant for now
-        self.psfim = psfobj.drawImage(
-            wcs = wcs,
-        ).array
+        self.psfim = numpy.array(psfim)
+        self.psfim.flags.writeable = False
 
-        self.moms = moments(self.psfim)
+        if cen is None or sigma is None:
+            self.moms = moments(self.psfim)
+            cen = self.moms['cen']
+            sigma = numpy.sqrt(self.moms['T']/2.0)
 
-        self.sigma = numpy.sqrt(self.moms['T']/2.0)
+        self.cen = numpy.array(cen)
+        self.cen.flags.writeable = False
+        self.sigma = sigma
 
     def get_cen(self, *args, **kw):
-        return self.moms['cen'].copy()
+        return self.cen
 
     def get_sigma(self, *args, **kw):
         return self.sigma
@@ -266,37 +534,195 @@ class PSFMaker(object):
         return self.psfim.shape
 
     def get_rec(self, *args, **kw):
-        return self.psfim.copy()
+        return self.psfim
+
+    def get_recs(self, rows, cols):
+        """
+        get the psf images for many objects as a single read-only
+        (n, psf_nrow, psf_ncol) block, which is a broadcast view of the
+        one image and uses no extra memory
+        """
+        n = numpy.size(rows)
+        return numpy.broadcast_to(self.psfim, (n,) + self.psfim.shape)
+
+    def get_cens(self, rows, cols):
+        """
+        get the psf centroids for many objects as a read-only (n, 2) block
+        """
+        n = numpy.size(rows)
+        return numpy.broadcast_to(self.cen, (n, 2))
+
+    def get_sigmas(self, rows, cols):
+        """
+        get the psf sizes for many objects
+        """
+        return numpy.zeros(numpy.size(rows)) + self.sigma
 
 def moments(image):
     """
     Measure the unweighted centroid and second moments of an image.
     """
 
-    # ogrid is so useful
-    row,col=numpy.ogrid[0:image.shape[0], 0:image.shape[1]]
+    mom = get_moments(image)[0]
 
-    Isum = image.sum()
+    return {
+        'cen':mom['cen'].copy(),
+        'T':mom['T'],
+        'e1':mom['e1'],
+        'e2':mom['e2'],
+    }
 
-    rowcen = (image*row).sum()/Isum
-    colcen = (image*col).sum()/Isum
-    cen = numpy.array( [rowcen,colcen] )
+def preload_run(run):
+    """
+    load the data shared by all indices in the run: the MEDS and galsim
+    configs and, for a constant psf, the rendered psf.  These go into
+    the in-process caches, so forked workers inherit them
+    """
+    nodecache.activate(run)
 
-    rm = row - cen[0]
-    cm = col - cen[1]
+    medsconf = files.read_yaml(files.get_meds_config())
+    galsim_conf = files.read_config(run)
 
-    Irr = (image*rm**2).sum()/Isum
-    Irc = (image*rm*cm).sum()/Isum
-    Icc = (image*cm**2).sum()/Isum
+    if medsconf.get('psf_model','galsim') == 'galsim':
+        psfcache.get_psf(run, galsim_conf)
 
-    T=Irr+Icc
-    e1=(Icc-Irr)/T
-    e2=2.*Irc/T
+def make_meds_files(run, indices, nproc=1):
+    """
+    make the MEDS files for many indices in one process tree
+
+    The shared configs and psf are loaded once in the parent, and the
+    indices are processed by forked workers that inherit them.  The
+    output for each index goes to its usual MEDS log file.
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    indices: sequence of ints
+        The indices to process
+    nproc: int, optional
+        Number of worker processes
+
+    returns
+    -------
+    list of results for each index, dicts with entries index, nobj, time
+    and error, which is None on success
+    """
+    import time
+    import multiprocessing
+
+    preload_run(run)
+
+    args = [(run, index) for index in indices]
+
+    tm0 = time.time()
+    if nproc > 1:
+        ctx = multiprocessing.get_context('fork')
+        pool = ctx.Pool(nproc)
+        try:
+            results = []
+            for res in pool.imap_unordered(_make_meds_file_wrapper, args):
+                _print_result(res)
+                results.append(res)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = []
+        for arg in args:
+            res = _make_meds_file_wrapper(arg)
+            _print_result(res)
+            results.append(res)
+
+    tm = time.time() - tm0
+
+    results.sort(key=lambda r: r['index'])
+
+    nobj = sum(r['nobj'] for r in results if r['error'] is None)
+    nfail = sum(1 for r in results if r['error'] is not None)
+    print("made %d/%d MEDS files, %d objects in %.1f s, "
+          "%.1f objects/s" % (len(results)-nfail, len(results), nobj, tm,
+                              nobj/tm if tm > 0 else 0.0))
+
+    return results
+
+def make_meds_file(run, index):
+    """
+    make the MEDS file for one index, returning the number of objects
+    """
+    maker = NbrSimMEDSMaker(run, index)
+    maker.go()
+    return maker.obj_data.size
 
-    return {
-        'cen':cen,
-        'T':Irr + Icc,
-        'e1':e1,
-        'e2':e2,
-    }
+def _make_meds_file_wrapper(arg):
+    """
+    make a MEDS file with output going to the log file, catching errors
+    so other indices can proceed
+    """
+    import time
+    import traceback
+
+    import tempfile
+
+    run, index = arg
+    logfile = files.get_meds_log_file(run, index)
+
+    # for packed runs the log is written locally and then packed
+    local_logfile = logfile
+    if files.is_packed(run):
+        local_logfile = os.path.join(
+            tempfile.gettempdir(),
+            '%s.%d' % (os.path.basename(logfile), os.getpid()),
+        )
+
+    res = {'index':index, 'nobj':0, 'time':0.0, 'error':None}
 
+    tm0 = time.time()
+    with _redirect_output(local_logfile):
+        try:
+            res['nobj'] = make_meds_file(run, index)
+        except Exception as err:
+            traceback.print_exc()
+            res['error'] = '%s: %s' % (err.__class__.__name__, err)
+
+    if local_logfile != logfile:
+        files.store_file(local_logfile, logfile, remove=True)
+
+    res['time'] = time.time() - tm0
+    return res
+
+def _print_result(res):
+    if res['error'] is None:
+        print("index %d: %d objects in %.1f s" % (res['index'],res['nobj'],res['time']))
+    else:
+        print("index %d: failed: %s" % (res['index'],res['error']))
+
+class _redirect_output(object):
+    """
+    send stdout and stderr, including from child processes such as
+    fpack, to the specified file
+    """
+    def __init__(self, fname):
+        self.fname = fname
+
+    def __enter__(self):
+        import sys
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        self.saved = (os.dup(1), os.dup(2))
+        self.fobj = open(self.fname, 'w')
+        os.dup2(self.fobj.fileno(), 1)
+        os.dup2(self.fobj.fileno(), 2)
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        import sys
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+        os.dup2(self.saved[0], 1)
+        os.dup2(self.saved[1], 2)
+        for fd in self.saved:
+            os.close(fd)
+        self.fobj.close()
@@ -0,0 +1,253 @@
+"""
+streaming reader for the MEDS files of a run
+
+The cutouts are read in large sequential blocks, one block for a batch
+of objects, rather than one stamp at a time.  Reading happens on a
+background thread that runs ahead of the consumer, so the next batch,
+and the next file, are usually ready when they are needed.
+"""
+from __future__ import print_function
+import os
+import threading
+import numpy
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import files
+
+DEFAULT_BATCH_SIZE = 1000
+
+# maximum number of pixels read in a single block
+MAX_BLOCK_PIXELS = 64*1024*1024
+
+
+class RunReader(object):
+    """
+    iterate over the cutouts in the MEDS files of a run
+
+    Iteration yields (index, obj_data, cutout_type, stamps) for batches of
+    objects, where index is the file index, obj_data holds the object
+    data for the batch and stamps is a list of the coadd cutouts for each
+    object, each of shape (box_size, box_size).  For each batch there is
+    one entry per cutout type.
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    indices: sequence of ints, optional
+        The indices to read, default all in the run.  Missing files are
+        skipped
+    cutout_types: sequence of strings, optional
+        Types of cutout to read, default ['image']
+    batch_size: int, optional
+        Number of objects in a batch
+    shear_index: int or sequence of ints, optional
+        Only read objects with these shear indices
+    select: callable, optional
+        Called as select(obj_data) for each file, returning a boolean
+        array of objects to read.  Use this to select on neighbor
+        columns
+    prefetch: int, optional
+        Number of batches to read ahead
+
+    example
+    -------
+    reader = RunReader(run, shear_index=3, cutout_types=['image','weight'])
+    for index, obj_data, cutout_type, stamps in reader:
+        ...
+    """
+    def __init__(self,
+                 run,
+                 indices=None,
+                 cutout_types=('image',),
+                 batch_size=DEFAULT_BATCH_SIZE,
+                 shear_index=None,
+                 select=None,
+                 prefetch=2):
+
+        self.run = run
+
+        if indices is None:
+            conf = files.read_config(run)
+            indices = list(range(conf['output']['nfiles']))
+
+        self.indices = list(indices)
+        self.cutout_types = list(cutout_types)
+        self.batch_size = batch_size
+        self.select = select
+        self.prefetch = prefetch
+
+        if shear_index is not None:
+            shear_index = numpy.atleast_1d(shear_index)
+        self.shear_index = shear_index
+
+    def __iter__(self):
+        """
+        read batches on a background thread, passing them through a
+        bounded queue
+        """
+        batches = queue.Queue(maxsize=max(self.prefetch, 1))
+        stop = threading.Event()
+
+        thread = threading.Thread(
+            target=self._produce,
+            args=(batches, stop),
+        )
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                item = batches.get()
+                if item is None:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+
+                yield item
+        finally:
+            # if the consumer stops early, release the reader
+            stop.set()
+            while thread.is_alive():
+                try:
+                    batches.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+    def _produce(self, batches, stop):
+        try:
+            for index in self.indices:
+                for item in self.iter_file(index):
+                    if stop.is_set():
+                        return
+                    batches.put(item)
+        except Exception as err:
+            batches.put(err)
+        else:
+            batches.put(None)
+
+    def iter_file(self, index):
+        """
+        iterate over the batches for a single file, in the calling thread
+        """
+        import fitsio
+
+        fname = files.get_meds_file(self.run, index)
+        if not os.path.exists(fname):
+            print("skipping missing MEDS file:",fname)
+            return
+
+        with fitsio.FITS(fname) as fits:
+            obj_data = fits['object_data'].read()
+
+            w = self.get_selection(obj_data)
+
+            for ind in get_blocks(obj_data, w, self.batch_size):
+                bdata = obj_data[ind]
+                for cutout_type in self.cutout_types:
+                    stamps = read_stamps(fits, bdata, cutout_type)
+                    yield index, bdata, cutout_type, stamps
+
+    def get_selection(self, obj_data):
+        """
+        get indices of the objects to read
+        """
+        keep = obj_data['ncutout'] > 0
+
+        if self.shear_index is not None:
+            keep &= numpy.isin(obj_data['shear_index'], self.shear_index)
+
+        if self.select is not None:
+            keep &= self.select(obj_data)
+
+        w, = numpy.where(keep)
+        return w
+
+
+def iter_run(run, **kw):
+    """
+    iterate over the cutouts in the MEDS files of a run
+
+    This is a convenience function; see RunReader for the parameters
+    """
+    return iter(RunReader(run, **kw))
+
+
+def get_blocks(obj_data, w, batch_size):
+    """
+    split the selected objects into batches.  A batch is also split if
+    reading it would take more than MAX_BLOCK_PIXELS, which can happen
+    when few objects are selected
+
+    parameters
+    ----------
+    obj_data: array
+        The MEDS object data
+    w: array
+        Indices of the selected objects, in file order
+    batch_size: int
+        Maximum objects in a batch
+
+    returns
+    -------
+    list of index arrays
+    """
+    if w.size == 0:
+        return []
+
+    start = obj_data['start_row'][w, 0]
+    end = start + obj_data['box_size'][w].astype('i8')**2
+
+    blocks = []
+    beg = 0
+    for i in range(1, w.size + 1):
+        if i == w.size:
+            blocks.append(w[beg:i])
+            break
+
+        npix = end[i] - start[beg]
+        if i - beg >= batch_size or npix > MAX_BLOCK_PIXELS:
+            blocks.append(w[beg:i])
+            beg = i
+
+    return blocks
+
+
+def read_stamps(fits, obj_data, cutout_type):
+    """
+    read the coadd cutouts for a set of objects with a single read of
+    the cutout extension
+
+    parameters
+    ----------
+    fits: fitsio.FITS
+        The opened MEDS file
+    obj_data: array
+        Object data for the objects to read, in file order
+    cutout_type: string
+        e.g. 'image' or 'weight'
+
+    returns
+    -------
+    list of arrays of shape (box_size, box_size)
+    """
+    box_size = obj_data['box_size'].astype('i8')
+    start = obj_data['start_row'][:, 0].astype('i8')
+    npix = box_size**2
+
+    beg = start.min()
+    end = (start + npix).max()
+
+    ext = '%s_cutouts' % cutout_type
+    data = fits[ext][beg:end]
+
+    stamps = []
+    for s, n, bsize in zip(start-beg, npix, box_size):
+        stamps.append(data[s:s+n].reshape(bsize, bsize))
+
+    return stamps
@@ -0,0 +1,322 @@
+"""
+centroids and second moments for stacks of stamps
+
+All stamps in a stack are measured with whole-array operations, so this
+is fast for large numbers of small stamps such as the sextractor VIGNET
+cube or cutouts from a MEDS file.
+"""
+from __future__ import print_function
+import numpy
+
+# sextractor fills VIGNET pixels outside of the image with this value
+VIGNET_BADVAL = -1.0e29
+
+# flags
+NONPOS_FLUX = 2**0
+NONPOS_SIZE = 2**1
+MAXITER = 2**2
+
+DEFAULT_MAXITER = 100
+DEFAULT_TOL = 1.0e-6
+
+MOMENTS_DTYPE = [
+    ('flags','i4'),
+    ('numiter','i4'),
+    ('flux','f8'),
+    ('cen','f8',2),
+    ('irr','f8'),
+    ('irc','f8'),
+    ('icc','f8'),
+    ('T','f8'),
+    ('e1','f8'),
+    ('e2','f8'),
+]
+
+
+def get_moments(stamps, mask=None, weight_sigma=None,
+                maxiter=DEFAULT_MAXITER, tol=DEFAULT_TOL):
+    """
+    measure the centroid and second moments of a stack of stamps
+
+    parameters
+    ----------
+    stamps: array
+        Array with shape (nstamp, nrow, ncol), or a single (nrow, ncol)
+        image
+    mask: array, optional
+        Boolean array the same shape as stamps, True for good pixels
+    weight_sigma: float, optional
+        If sent, measure adaptive moments using an elliptical gaussian
+        weight, starting with a round weight of this size.  Otherwise
+        unweighted moments are measured.
+    maxiter: int, optional
+        Maximum number of iterations for adaptive moments
+    tol: float, optional
+        Tolerance for adaptive moments, in the change of the centroid and
+        second moments relative to the size of the weight
+
+    returns
+    -------
+    An array with fields flags, numiter, flux, cen, irr, irc, icc, T, e1,
+    e2.  For adaptive moments, the second moments are those of the
+    converged weight, which match the object for a gaussian.
+    """
+
+    stamps = numpy.array(stamps, dtype='f8', ndmin=2, copy=True)
+    if stamps.ndim == 2:
+        stamps = stamps[numpy.newaxis, :, :]
+
+    if mask is not None:
+        mask = numpy.array(mask, dtype=bool, ndmin=2)
+        if mask.ndim == 2:
+            mask = mask[numpy.newaxis, :, :]
+        stamps[~mask] = 0.0
+
+    nstamp, nrow, ncol = stamps.shape
+    res = numpy.zeros(nstamp, dtype=MOMENTS_DTYPE)
+
+    row, col = numpy.ogrid[0:nrow, 0:ncol]
+    row = row[numpy.newaxis, :, :]
+    col = col[numpy.newaxis, :, :]
+
+    if weight_sigma is None:
+        _fill_moments(res, stamps, row, col)
+    else:
+        _fill_adaptive_moments(
+            res, stamps, row, col, weight_sigma, maxiter, tol,
+        )
+
+    return res
+
+
+def get_vignet_moments(cat, name='vignet', **kw):
+    """
+    measure moments of the sextractor VIGNET stamps in a catalog,
+    ignoring pixels that fall off the image
+
+    parameters
+    ----------
+    cat: array with fields
+        The sextractor catalog
+    name: string, optional
+        The name of the vignet column
+    **kw:
+        Extra keywords for get_moments
+
+    returns
+    -------
+    moments array from get_moments
+    """
+    if name not in cat.dtype.names:
+        name = name.upper()
+
+    stamps = cat[name]
+    mask = stamps > VIGNET_BADVAL
+    return get_moments(stamps, mask=mask, **kw)
+
+
+def compare_moments(star_moms, model_moms):
+    """
+    compare moments of stars and of PSF models evaluated at the star
+    locations
+
+    parameters
+    ----------
+    star_moms: array
+        moments of the stars from get_moments
+    model_moms: array
+        moments of the PSF models from get_moments
+
+    returns
+    -------
+    resid: array
+        Array with fields flags, T, dT_frac = (T_star-T_model)/T_star,
+        de1 = e1_star-e1_model, de2 = e2_star-e2_model
+    stats: dict
+        The mean and error on the mean of dT_frac, de1, de2, along with
+        the number of stars used
+    """
+    if star_moms.size != model_moms.size:
+        raise ValueError("star and model moments have different "
+                         "sizes: %d %d" % (star_moms.size, model_moms.size))
+
+    dt = [
+        ('flags','i4'),
+        ('T','f8'),
+        ('dT_frac','f8'),
+        ('de1','f8'),
+        ('de2','f8'),
+    ]
+    resid = numpy.zeros(star_moms.size, dtype=dt)
+    resid['flags'] = star_moms['flags'] | model_moms['flags']
+    resid['T'] = star_moms['T']
+
+    w, = numpy.where(resid['flags'] == 0)
+    resid['dT_frac'][w] = \
+        (star_moms['T'][w] - model_moms['T'][w])/star_moms['T'][w]
+    resid['de1'][w] = star_moms['e1'][w] - model_moms['e1'][w]
+    resid['de2'][w] = star_moms['e2'][w] - model_moms['e2'][w]
+
+    stats = {'nuse': w.size}
+    for name in ['dT_frac','de1','de2']:
+        if w.size > 0:
+            vals = resid[name][w]
+            stats[name] = vals.mean()
+            stats[name+'_err'] = vals.std()/numpy.sqrt(w.size)
+        else:
+            stats[name] = -9999.0
+            stats[name+'_err'] = 9999.0
+
+    return resid, stats
+
+
+def _fill_moments(res, stamps, row, col):
+    """
+    unweighted moments
+    """
+    flux = stamps.sum(axis=(1,2))
+    res['flux'] = flux
+
+    bad = flux <= 0
+    res['flags'][bad] |= NONPOS_FLUX
+    flux = numpy.where(bad, 1.0, flux)
+
+    rowcen = (stamps*row).sum(axis=(1,2))/flux
+    colcen = (stamps*col).sum(axis=(1,2))/flux
+
+    _fill_second_moments(res, stamps, row, col, rowcen, colcen, flux)
+
+
+def _fill_adaptive_moments(res, stamps, row, col, weight_sigma, maxiter, tol):
+    """
+    adaptive moments, iterating the weight to match the object
+
+    For a gaussian object with covariance C and weight with covariance W,
+    the weighted covariance is M = (C^-1 + W^-1)^-1, so at the fixed
+    point W=C we have W = 2 M
+    """
+
+    nstamp, nrow, ncol = stamps.shape
+
+    # start at the stamp center with a round weight
+    rowcen = numpy.zeros(nstamp) + (nrow-1)/2.0
+    colcen = numpy.zeros(nstamp) + (ncol-1)/2.0
+    wrr = numpy.zeros(nstamp) + weight_sigma**2
+    wrc = numpy.zeros(nstamp)
+    wcc = numpy.zeros(nstamp) + weight_sigma**2
+
+    active = numpy.ones(nstamp, dtype=bool)
+
+    for i in range(maxiter):
+        w, = numpy.where(active)
+        if w.size == 0:
+            break
+
+        res['numiter'][w] = i+1
+
+        tres = _get_weighted_moments(
+            stamps[w], row, col,
+            rowcen[w], colcen[w], wrr[w], wrc[w], wcc[w],
+        )
+        bad = tres['flags'] != 0
+
+        old = numpy.array([rowcen[w], colcen[w], wrr[w], wrc[w], wcc[w]])
+
+        rowcen[w] = tres['cen'][:,0]
+        colcen[w] = tres['cen'][:,1]
+        wrr[w] = 2*tres['irr']
+        wrc[w] = 2*tres['irc']
+        wcc[w] = 2*tres['icc']
+
+        new = numpy.array([rowcen[w], colcen[w], wrr[w], wrc[w], wcc[w]])
+
+        # changes relative to the size of the weight
+        scale = numpy.sqrt(numpy.abs(old[2] + old[4])/2)
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            dcen = numpy.abs(new[0:2] - old[0:2]).max(axis=0)/scale
+            dmom = numpy.abs(new[2:] - old[2:]).max(axis=0)/scale**2
+            converged = (dcen < tol) & (dmom < tol)
+
+        res['flags'][w[bad]] |= tres['flags'][bad]
+        res['flux'][w] = tres['flux']
+
+        active[w[bad | converged]] = False
+
+    res['flags'][active] |= MAXITER
+
+    res['cen'][:,0] = rowcen
+    res['cen'][:,1] = colcen
+    res['irr'] = wrr
+    res['irc'] = wrc
+    res['icc'] = wcc
+    _fill_shape(res)
+
+
+def _get_weighted_moments(stamps, row, col, rowcen, colcen, wrr, wrc, wcc):
+    """
+    measure moments of the stamps multiplied by the weight
+    """
+
+    tres = numpy.zeros(stamps.shape[0], dtype=MOMENTS_DTYPE)
+
+    det = wrr*wcc - wrc**2
+    bad = det <= 0
+    tres['flags'][bad] |= NONPOS_SIZE
+    det = numpy.where(bad, 1.0, det)
+
+    # inverse of the weight covariance
+    irr = (wcc/det)[:, numpy.newaxis, numpy.newaxis]
+    irc = (-wrc/det)[:, numpy.newaxis, numpy.newaxis]
+    icc = (wrr/det)[:, numpy.newaxis, numpy.newaxis]
+
+    rm = row - rowcen[:, numpy.newaxis, numpy.newaxis]
+    cm = col - colcen[:, numpy.newaxis, numpy.newaxis]
+
+    chi2 = irr*rm**2 + 2*irc*rm*cm + icc*cm**2
+    wstamps = stamps*numpy.exp(-0.5*chi2)
+
+    flux = wstamps.sum(axis=(1,2))
+    tres['flux'] = flux
+
+    fbad = flux <= 0
+    tres['flags'][fbad] |= NONPOS_FLUX
+    flux = numpy.where(fbad, 1.0, flux)
+
+    newrowcen = (wstamps*row).sum(axis=(1,2))/flux
+    newcolcen = (wstamps*col).sum(axis=(1,2))/flux
+
+    _fill_second_moments(tres, wstamps, row, col, newrowcen, newcolcen, flux)
+
+    return tres
+
+
+def _fill_second_moments(res, stamps, row, col, rowcen, colcen, flux):
+    """
+    fill in the centroid and second moments
+    """
+    res['cen'][:,0] = rowcen
+    res['cen'][:,1] = colcen
+
+    rm = row - rowcen[:, numpy.newaxis, numpy.newaxis]
+    cm = col - colcen[:, numpy.newaxis, numpy.newaxis]
+
+    res['irr'] = (stamps*rm**2).sum(axis=(1,2))/flux
+    res['irc'] = (stamps*rm*cm).sum(axis=(1,2))/flux
+    res['icc'] = (stamps*cm**2).sum(axis=(1,2))/flux
+
+    _fill_shape(res)
+
+
+def _fill_shape(res):
+    """
+    fill in T and the ellipticity
+    """
+    T = res['irr'] + res['icc']
+    res['T'] = T
+
+    bad = T <= 0
+    res['flags'][bad] |= NONPOS_SIZE
+    T = numpy.where(bad, 1.0, T)
+
+    res['e1'] = (res['icc'] - res['irr'])/T
+    res['e2'] = 2*res['irc']/T
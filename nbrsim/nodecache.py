@@ -0,0 +1,238 @@
+"""
+node-level cache of the config and calibration files shared by all jobs
+
+Every job reads the same small files: the sextractor, psfex and
+findstars configs, the MEDS config and the run config.  With many
+concurrent jobs these reads load the metadata servers of the shared
+file system.  nbrsim-make-scripts writes a manifest of the files and
+their content hashes to the run directory, and the first job on a node
+copies them into a directory named for the hash of the manifest, under
+$NBRSIM_NODE_CACHE.  Later jobs on the node find the directory and read
+the local copies.
+
+The directory is filled under a temporary name and renamed into place,
+so concurrent jobs never see a partial cache; if two jobs fill it at the
+same time, one copy wins and the other is discarded.
+
+Entry points call activate(run), after which the path accessors in
+nbrsim.files resolve to the cached copies.  When NBRSIM_NODE_CACHE is
+not set, or the run has no manifest, the original paths are used.
+"""
+from __future__ import print_function
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+from . import files
+
+NODE_CACHE_KEY = 'NBRSIM_NODE_CACHE'
+
+MANIFEST_VERSION = 1
+
+# files from the share directory used by the reduction and MEDS making
+SHARE_FILES = [
+    'sx.conf',
+    'sx.param',
+    'sx.conv',
+    'sx.nnw',
+    'psfex.conf',
+    'wl.config',
+    'findstars.config',
+    'piff.yaml',
+    'meds.yaml',
+    'compression.yaml',
+]
+
+# original absolute path -> cached path, for the activated runs
+_resolved = {}
+_activated = set()
+
+
+def is_enabled():
+    """
+    the node cache is used when NBRSIM_NODE_CACHE is set
+    """
+    return os.environ.get(NODE_CACHE_KEY, '') != ''
+
+
+def get_cache_base():
+    return os.environ[NODE_CACHE_KEY]
+
+
+def resolve(path):
+    """
+    get the cached copy of a file, if the file is in the cache for an
+    activated run, otherwise the path itself
+    """
+    if not _resolved:
+        return path
+
+    # no realpath here, it would stat the shared file system
+    return _resolved.get(os.path.abspath(path), path)
+
+
+def activate(run):
+    """
+    fill the node cache for the run if needed, and resolve paths in it
+    from now on in this process
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+
+    returns
+    -------
+    The cache directory, or None if the cache is not used
+    """
+    if not is_enabled():
+        return None
+
+    manifest = read_manifest(run)
+    if manifest is None:
+        print("no node cache manifest for run %s" % run)
+        return None
+
+    cache_dir = os.path.join(get_cache_base(), manifest['hash'])
+    if run in _activated:
+        return cache_dir
+
+    if not os.path.exists(cache_dir):
+        populate(manifest, cache_dir)
+
+    for entry in manifest['files']:
+        fname = os.path.join(cache_dir, entry['name'])
+        if os.path.exists(fname):
+            _resolved[entry['path']] = fname
+
+    _activated.add(run)
+    return cache_dir
+
+
+def populate(manifest, cache_dir):
+    """
+    copy the files in the manifest into the cache directory
+
+    Files are copied into a temporary directory and verified against the
+    hashes in the manifest; a file that changed since the manifest was
+    written is left out, so the original is used for it.  The directory
+    is then renamed into place.
+    """
+    base = os.path.dirname(cache_dir)
+    if not os.path.exists(base):
+        try:
+            os.makedirs(base)
+        except OSError:
+            if not os.path.exists(base):
+                raise
+
+    tmpdir = tempfile.mkdtemp(prefix='.tmp-', dir=base)
+    try:
+        for entry in manifest['files']:
+            fname = os.path.join(tmpdir, entry['name'])
+            shutil.copy2(entry['path'], fname)
+
+            if get_digest(fname) != entry['sha1']:
+                print("file changed since the manifest was "
+                      "written, not caching: %s" % entry['path'])
+                os.remove(fname)
+
+        os.chmod(tmpdir, 0o755)
+        try:
+            os.rename(tmpdir, cache_dir)
+            print("filled node cache:",cache_dir)
+        except OSError:
+            # another job filled it first
+            if not os.path.exists(cache_dir):
+                raise
+    finally:
+        if os.path.exists(tmpdir):
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def get_cached_files(run):
+    """
+    get the files to cache for a run: the share directory files that
+    exist and the run config
+    """
+    share_dir = files.get_share_dir()
+    fnames = [os.path.join(share_dir, name) for name in SHARE_FILES]
+    fnames = [f for f in fnames if os.path.exists(f)]
+
+    fnames.append(files.get_config_file(run, cached=False))
+    return fnames
+
+
+def make_manifest(run):
+    """
+    make the manifest for the run, with the hash of each file and a hash
+    of the whole set that names the cache directory
+    """
+    entries = []
+    for fname in get_cached_files(run):
+        entries.append({
+            'name': os.path.basename(fname),
+            'path': os.path.abspath(fname),
+            'sha1': get_digest(fname),
+        })
+
+    names = [e['name'] for e in entries]
+    if len(set(names)) != len(names):
+        raise ValueError("duplicate file names in node cache: %s" % names)
+
+    h = hashlib.sha1()
+    for e in entries:
+        h.update(('%s %s\n' % (e['name'], e['sha1'])).encode('utf-8'))
+
+    return {
+        'version': MANIFEST_VERSION,
+        'hash': h.hexdigest(),
+        'files': entries,
+    }
+
+
+def write_manifest(run):
+    """
+    write the manifest for the run to the run directory
+    """
+    manifest = make_manifest(run)
+
+    fname = files.get_cache_manifest_file(run)
+    tmpname = '%s.tmp%d' % (fname, os.getpid())
+
+    print("writing:",fname)
+    with open(tmpname, 'w') as fobj:
+        json.dump(manifest, fobj, indent=1)
+    os.rename(tmpname, fname)
+
+    return manifest
+
+
+def read_manifest(run):
+    """
+    read the manifest for the run, or None if there is none
+    """
+    fname = files.get_cache_manifest_file(run)
+    if not os.path.exists(fname):
+        return None
+
+    with open(fname) as fobj:
+        return json.load(fobj)
+
+
+def get_digest(fname):
+    h = hashlib.sha1()
+    with open(fname, 'rb') as fobj:
+        for chunk in iter(lambda: fobj.read(1024*1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def clear():
+    """
+    forget the activated runs in this process
+    """
+    _resolved.clear()
+    _activated.clear()
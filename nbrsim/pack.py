@@ -0,0 +1,394 @@
+"""
+packed storage for the small per-index files of a run
+
+Each index directory holds a number of small files: the job scripts,
+the logs and the size-magnitude plot.  With many indices these are
+millions of inodes on the shared file system, which makes directory
+walks and quota checks slow.
+
+When the run config sets packed: true in the output section, these files
+are appended instead to a set of container files in the run directory.
+The indices are spread over a number of shards, output.pack_shards,
+default NSHARDS, so concurrent jobs rarely contend for a shard.  Each
+shard is a data file, holding the file contents one after another, and
+an index file with a JSON line for each entry giving the name, offset,
+size and crc32.
+
+Writers take an exclusive lock on the shard, append the data and sync
+it, then append the index line.  An entry is only visible once its index
+line is complete, so readers never need the lock and never see partial
+data.  Storing a name again adds a new entry that supersedes the old
+one; compact() removes the superseded data.
+
+Large FITS products are never packed.  nbrsim.files.open_file and
+file_exists read from the pack transparently.
+"""
+from __future__ import print_function
+import os
+import io
+import json
+import zlib
+import time
+import fcntl
+
+from . import files
+
+NSHARDS = 64
+
+# file types kept in the pack, by extension
+PACKED_EXTS = ['sh', 'log', 'eps', 'xml']
+
+# never pack files larger than this
+MAX_PACKED_SIZE = 16*1024*1024
+
+# (run, shard) -> (index file inode, size read so far, {name: entry})
+_indices = {}
+
+
+def is_enabled(run):
+    """
+    the run is packed if output.packed is set in the config
+    """
+    conf = files.read_config(run)
+    return bool(conf['output'].get('packed', False))
+
+
+def get_nshards(run):
+    conf = files.read_config(run)
+    return int(conf['output'].get('pack_shards', NSHARDS))
+
+
+def is_packable(fname):
+    """
+    check if a file is of a type kept in the pack
+    """
+    basename = os.path.basename(fname)
+    ext = basename.split('.')[-1]
+    if ext in PACKED_EXTS:
+        return True
+
+    # the star reserve lists from nbrsim-reduce
+    return '-reserve' in basename or '_reserve' in basename
+
+
+def get_shard(run, index):
+    return index % get_nshards(run)
+
+
+def add(run, name, data):
+    """
+    store data under the specified name
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    name: string
+        Name of the file, e.g. the basename from the nbrsim.files
+        accessor.  The index is taken from the name
+    data: bytes or string
+        The contents
+    """
+    if not isinstance(data, bytes):
+        data = data.encode('utf-8')
+
+    if len(data) > MAX_PACKED_SIZE:
+        raise ValueError("%s is too large to pack: %d bytes" % (name, len(data)))
+
+    shard = _get_shard_for_name(run, name)
+    _makedir(files.get_pack_dir(run))
+
+    with _ShardLock(run, shard):
+        data_file = files.get_pack_data_file(run, shard)
+        with open(data_file, 'ab') as fobj:
+            offset = fobj.tell()
+            fobj.write(data)
+            fobj.flush()
+            os.fsync(fobj.fileno())
+
+        entry = {
+            'name': name,
+            'offset': offset,
+            'size': len(data),
+            'crc32': zlib.crc32(data) & 0xffffffff,
+            'time': time.time(),
+        }
+        index_file = files.get_pack_index_file(run, shard)
+        with open(index_file, 'a') as fobj:
+            fobj.write(json.dumps(entry) + '\n')
+            fobj.flush()
+            os.fsync(fobj.fileno())
+
+
+def add_file(run, fname, name=None, remove=False):
+    """
+    store the contents of a file, by default under its basename
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    fname: string
+        The file to store
+    name: string, optional
+        Name in the pack, default the basename of fname
+    remove: bool, optional
+        If True, remove the file once it is stored
+    """
+    if name is None:
+        name = os.path.basename(fname)
+
+    with open(fname, 'rb') as fobj:
+        data = fobj.read()
+
+    add(run, name, data)
+    if remove:
+        os.remove(fname)
+
+
+def read(run, name):
+    """
+    read the contents stored under the name
+
+    returns
+    -------
+    the data as bytes
+    """
+    shard = _get_shard_for_name(run, name)
+    data_file = files.get_pack_data_file(run, shard)
+
+    for attempt in range(2):
+        entry = get_entry(run, name)
+        if entry is None:
+            raise IOError("no file %s in the pack for run %s" % (name, run))
+
+        with open(data_file, 'rb') as fobj:
+            fobj.seek(entry['offset'])
+            data = fobj.read(entry['size'])
+
+        if len(data) == entry['size'] and (zlib.crc32(data) & 0xffffffff) == entry['crc32']:
+            return data
+
+        # the shard may have been compacted since the index was read
+        _indices.pop((run, shard), None)
+
+    raise IOError("corrupt entry %s in %s" % (name, data_file))
+
+
+def open_file(run, name, mode='r'):
+    """
+    get a read only file-like object for the contents stored under the
+    name
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    name: string
+        Name in the pack
+    mode: string, optional
+        'r' for text or 'rb' for bytes
+    """
+    if mode not in ('r', 'rb'):
+        raise ValueError("packed files can only be opened for reading, got mode '%s'" % mode)
+
+    fobj = io.BytesIO(read(run, name))
+    if mode == 'r':
+        fobj = io.TextIOWrapper(fobj, encoding='utf-8')
+    return fobj
+
+
+def exists(run, name):
+    return get_entry(run, name) is not None
+
+
+def get_entry(run, name):
+    """
+    get the index entry for a name, or None if it is not in the pack
+    """
+    shard = _get_shard_for_name(run, name)
+    return _read_index(run, shard).get(name)
+
+
+def get_names(run, index=None):
+    """
+    get the names in the pack, optionally only those for an index
+    """
+    if index is not None:
+        shards = [get_shard(run, index)]
+    else:
+        shards = range(get_nshards(run))
+
+    names = []
+    for shard in shards:
+        for name in _read_index(run, shard):
+            if index is None or files.parse_file_name(name)[1] == index:
+                names.append(name)
+
+    return sorted(names)
+
+
+def extract(run, name, dir):
+    """
+    write the contents stored under the name to a file in the directory
+
+    returns
+    -------
+    the path to the file
+    """
+    fname = os.path.join(dir, name)
+    with open(fname, 'wb') as fobj:
+        fobj.write(read(run, name))
+    return fname
+
+
+def pack_index(run, index, remove=True):
+    """
+    move the small files in the output directory for an index into the
+    pack
+
+    returns
+    -------
+    the number of files packed
+    """
+    dir = files.get_output_dir(run, index)
+    if not os.path.exists(dir):
+        return 0
+
+    npacked = 0
+    for basename in sorted(os.listdir(dir)):
+        fname = os.path.join(dir, basename)
+        if not is_packable(fname) or not os.path.isfile(fname):
+            continue
+        if os.path.getsize(fname) > MAX_PACKED_SIZE:
+            continue
+
+        add_file(run, fname, remove=remove)
+        npacked += 1
+
+    return npacked
+
+
+def compact(run):
+    """
+    rewrite each shard without the data of superseded entries
+
+    The new data and index are written under temporary names and renamed
+    into place while holding the lock, data file first.  Readers holding
+    the old index find the checksum does not match and read the index
+    again
+    """
+    nbytes_before = 0
+    nbytes_after = 0
+
+    for shard in range(get_nshards(run)):
+        data_file = files.get_pack_data_file(run, shard)
+        if not os.path.exists(data_file):
+            continue
+
+        with _ShardLock(run, shard):
+            _indices.pop((run, shard), None)
+            entries = _read_index(run, shard)
+
+            tmp_data = '%s.tmp%d' % (data_file, os.getpid())
+            index_file = files.get_pack_index_file(run, shard)
+            tmp_index = '%s.tmp%d' % (index_file, os.getpid())
+
+            with open(data_file, 'rb') as fin, \
+                    open(tmp_data, 'wb') as fdata, \
+                    open(tmp_index, 'w') as findex:
+                for name in sorted(entries, key=lambda n: entries[n]['offset']):
+                    entry = dict(entries[name])
+                    fin.seek(entry['offset'])
+                    data = fin.read(entry['size'])
+
+                    entry['offset'] = fdata.tell()
+                    fdata.write(data)
+                    findex.write(json.dumps(entry) + '\n')
+
+            nbytes_before += os.path.getsize(data_file)
+            nbytes_after += os.path.getsize(tmp_data)
+
+            os.rename(tmp_data, data_file)
+            os.rename(tmp_index, index_file)
+            _indices.pop((run, shard), None)
+
+    print("compacted pack: %d -> %d bytes" % (nbytes_before, nbytes_after))
+
+
+def clear():
+    """
+    forget the cached indices in this process
+    """
+    _indices.clear()
+
+
+def _read_index(run, shard):
+    """
+    read the index for a shard, reading only the lines added since the
+    last call
+    """
+    key = (run, shard)
+    ino, pos, entries = _indices.get(key, (None, 0, {}))
+
+    index_file = files.get_pack_index_file(run, shard)
+    try:
+        st = os.stat(index_file)
+    except OSError:
+        return entries
+    size = st.st_size
+
+    if st.st_ino != ino or size < pos:
+        # a new file renamed into place by compact, which may already
+        # have grown past the position read in the old one
+        ino, pos, entries = st.st_ino, 0, {}
+
+    if size > pos:
+        with open(index_file, 'rb') as fobj:
+            fobj.seek(pos)
+            for line in fobj:
+                # a line being written by another process
+                if not line.endswith(b'\n'):
+                    break
+                pos += len(line)
+
+                entry = json.loads(line.decode('utf-8'))
+                entries[entry['name']] = entry
+
+        _indices[key] = (ino, pos, entries)
+
+    return entries
+
+
+def _get_shard_for_name(run, name):
+    frun, index, ftype = files.parse_file_name(name)
+    if index is None:
+        raise ValueError("cannot get the index from file name %s" % name)
+    return get_shard(run, index)
+
+
+def _makedir(dir):
+    if not os.path.exists(dir):
+        try:
+            os.makedirs(dir)
+        except OSError:
+            if not os.path.exists(dir):
+                raise
+
+
+class _ShardLock(object):
+    """
+    exclusive lock on a shard, held on a separate lock file whose inode
+    does not change when the shard is compacted
+    """
+    def __init__(self, run, shard):
+        self.fname = files.get_pack_lock_file(run, shard)
+
+    def __enter__(self):
+        self.fobj = open(self.fname, 'a')
+        fcntl.flock(self.fobj.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        fcntl.flock(self.fobj.fileno(), fcntl.LOCK_UN)
+        self.fobj.close()
@@ -0,0 +1,144 @@
+"""
+fused per-index pipeline: simulate, detect, match and make the MEDS file
+
+The separate galsim, reduce and meds jobs communicate through the shared
+file system: the image is compressed and copied out, then copied back
+and uncompressed, and the catalogs are written out and read back.  Here
+all stages for an index run in one job in a local work directory.  The
+image and catalogs are handed directly from one stage to the next, and
+only the final products are copied to the output directory.
+"""
+from __future__ import print_function
+import os
+import traceback
+
+from . import files
+from . import nodecache
+from . import reduce
+from .galsimdriver import GalsimDriver, compress_image
+from .stageout import StageOut
+from .scratch import Scratch, estimate_footprint, get_image_shape
+
+
+def run_index(run, index,
+              work=None,
+              reduce_argv=None,
+              keep_intermediate=False,
+              rm_files=True):
+    """
+    run all stages for an index
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    index: int
+        The index to process
+    work: string, optional
+        Local directory for intermediate files.  Default is chosen from
+        the scratch directories by space
+    reduce_argv: list of strings, optional
+        Extra options for the reduction, as for nbrsim-reduce, e.g.
+        ['--nproc', '2']
+    keep_intermediate: bool, optional
+        If True, also copy the sextractor catalog, seg map and findstars
+        output to the output directory
+    rm_files: bool, optional
+        If True, remove the work directory when finished
+    """
+    from .medsmaker import NbrSimMEDSMaker
+
+    nodecache.activate(run)
+
+    dirs = None
+    if work is not None:
+        dirs = [reduce.get_work_dir(work)]
+
+    # room for the image, catalogs and psf of all stages; the MEDS maker
+    # makes its own scratch directory
+    scratch = Scratch(
+        'pipeline',
+        nbytes=estimate_footprint('pipeline', get_image_shape(run)),
+        dirs=dirs,
+        keep=not rm_files,
+    )
+    wdir = scratch.create()
+
+    odir = files.get_output_dir(run, index)
+    if not os.path.exists(odir):
+        os.makedirs(odir)
+
+    print('wdir = ',wdir)
+    print('odir = ',odir)
+
+    if reduce_argv is None:
+        reduce_argv = []
+    args = reduce.parse_args(
+        list(reduce_argv) + [files.get_image_file(run, index)]
+    )
+
+    stager = StageOut()
+    succeeded = False
+    try:
+        # simulate; the uncompressed image is used by sextractor, and
+        # the compressed one by the MEDS maker
+        driver = GalsimDriver(run, work_dir=wdir, stage_out=False)
+        img_file = driver.render(index)
+        truth_file = driver.get_truth_file(index)
+        if truth_file is None:
+            raise RuntimeError("the galsim config for run %s has "
+                               "no output.truth" % run)
+
+        fz_img_file = compress_image(img_file, remove=False)
+        stager.put(fz_img_file, odir)
+        stager.put(truth_file, odir)
+
+        # detect, select stars, fit the psf and match to the truth
+        res = reduce.process_image(
+            args,
+            img_file,
+            wdir,
+            odir,
+            stager,
+            truth_file=truth_file,
+            stage_intermediate=keep_intermediate,
+        )
+        if res['match'] is None:
+            raise RuntimeError("reduction failed for index %d, "
+                               "flag %d" % (index, res['flag']))
+
+        # the image is no longer needed uncompressed
+        os.remove(img_file)
+
+        # the MEDS maker reads the local files and uses the matched
+        # catalog directly
+        file_dict = {
+            'coadd_image_url': fz_img_file,
+            'coadd_seg_url': res['seg_file'],
+            'coadd_cat_url': res['match_file'],
+            'psf_url': res['psf_file'],
+        }
+        maker = NbrSimMEDSMaker(
+            run,
+            index,
+            file_dict=file_dict,
+            cat=res['match'],
+        )
+        maker.go()
+        succeeded = True
+
+    finally:
+        # all copies must be finished before we remove the work dir.  A
+        # failed copy is only raised if it would not hide the exception
+        # that stopped the job
+        try:
+            stager.close()
+        except Exception as e:
+            print('Caught exception during stage out: ',e)
+            traceback.print_exc()
+            if succeeded:
+                raise
+
+        scratch.release()
+
+    print('done')
@@ -0,0 +1,411 @@
+"""
+estimate the resources needed by a run
+
+The cost of each stage is measured by running the stage commands, as the
+jobs do, on small images made from the run config with the image size
+and number of objects scaled down.  Two sample sizes are run, and the
+wall time, cpu time, peak memory and output size of each stage are
+extrapolated linearly in the number of pixels to the full image.
+Scratch space is estimated from the image size as for the jobs.
+
+The plan is written to the run directory, and nbrsim-make-scripts uses
+it for the time, memory and scratch requests of the batch jobs.
+"""
+from __future__ import print_function
+import os
+import sys
+import copy
+import time
+import subprocess
+
+from . import files
+from .scratch import Scratch, estimate_footprint
+
+STAGES = ['galsim', 'reduce', 'meds']
+
+# fractions of the image side used for the two samples
+DEFAULT_SCALES = [0.1, 0.2]
+
+# requests are the estimates times this factor
+SAFETY_FACTOR = 2.0
+
+# never request less than this
+MIN_WALL_SECONDS = 10*60
+MIN_MEM_BYTES = 1024**3
+MIN_SCRATCH_BYTES = 1024**3
+
+PLAN_VERSION = 1
+
+
+def make_plan(run, scales=None, benchmark=True, keep=False):
+    """
+    estimate the resources for each stage of the run
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    scales: list of two floats, optional
+        Fractions of the image side for the samples, default DEFAULT_SCALES
+    benchmark: bool, optional
+        If False, only make the analytic estimates of scratch space and
+        output size, without timings
+    keep: bool, optional
+        If True, keep the sample files
+
+    returns
+    -------
+    the plan dict
+    """
+    if scales is None:
+        scales = DEFAULT_SCALES
+
+    conf = files.read_config(run)
+    shape = get_image_shape(conf)
+    nobjects = get_nobjects(conf)
+    nfiles = conf['output']['nfiles']
+
+    plan = {
+        'version': PLAN_VERSION,
+        'run': run,
+        'nfiles': nfiles,
+        'shape': list(shape) if shape is not None else None,
+        'nobjects': nobjects,
+        'scales': list(scales),
+        'stages': {},
+    }
+
+    for stage in STAGES:
+        plan['stages'][stage] = {
+            'scratch_bytes': estimate_footprint(stage, shape),
+        }
+
+    if benchmark:
+        if shape is None:
+            raise ValueError("image.xsize and image.ysize must be set in "
+                             "the config to benchmark run %s" % run)
+
+        samples = [
+            run_sample(run, conf, scale, keep=keep) for scale in scales
+        ]
+        npix = [s['npix'] for s in samples]
+
+        full_npix = shape[0]*shape[1]
+        for stage in STAGES:
+            for key in ['wall_seconds', 'cpu_seconds', 'max_rss_bytes', 'output_bytes']:
+                vals = [s['stages'][stage][key] for s in samples]
+                plan['stages'][stage][key] = extrapolate(npix, vals, full_npix)
+
+    plan['stages']['pipeline'] = combine_stages(plan['stages'])
+    plan['total'] = get_totals(plan)
+    return plan
+
+
+def run_sample(run, conf, scale, keep=False):
+    """
+    run the stages on a sample made from the run config with the image
+    side scaled by the specified factor
+
+    The sample is a separate run in a scratch directory, with its own
+    NBRSIM_DIR and NBRSIM_CONFIG_DIR
+
+    returns
+    -------
+    dict with npix and the measurements for each stage
+    """
+    import yaml
+    from .scripts import REDUCE_NPROC
+
+    sconf = scale_config(conf, scale)
+    shape = get_image_shape(sconf)
+    npix = shape[0]*shape[1]
+
+    nbytes = sum(
+        estimate_footprint(stage, shape) for stage in STAGES
+    )*4
+
+    srun = '%s-plan' % run
+    print("running sample with shape %s" % (shape,))
+
+    with Scratch('plan', nbytes=nbytes, keep=keep) as sdir:
+        env = dict(os.environ)
+        env['NBRSIM_DIR'] = os.path.join(sdir, 'data')
+        env['NBRSIM_CONFIG_DIR'] = os.path.join(sdir, 'config')
+        env.pop('NBRSIM_NODE_CACHE', None)
+        for d in [env['NBRSIM_DIR'], env['NBRSIM_CONFIG_DIR']]:
+            os.makedirs(d)
+
+        config_file = os.path.join(
+            env['NBRSIM_CONFIG_DIR'],
+            files.get_generic_basename(srun, ext='yaml'),
+        )
+        with open(config_file, 'w') as fobj:
+            yaml.safe_dump(sconf, fobj, default_flow_style=False)
+
+        results = {}
+        for stage in STAGES:
+            if stage == 'galsim':
+                cmd = ['nbrsim-galsim', srun, '--indices', '0:1']
+            elif stage == 'reduce':
+                cmd = [
+                    'nbrsim-reduce',
+                    '--nproc', str(REDUCE_NPROC),
+                    _get_sample_image(env, srun),
+                ]
+            else:
+                cmd = ['nbrsim-make-meds', srun, '0']
+
+            before = get_dir_size(env['NBRSIM_DIR'])
+            results[stage] = time_command(cmd, env=env)
+            results[stage]['output_bytes'] = get_dir_size(env['NBRSIM_DIR']) - before
+
+            print("    %-8s %8.1f s  %8.1f MB" % (
+                stage,
+                results[stage]['wall_seconds'],
+                results[stage]['max_rss_bytes']/1024.0**2,
+            ))
+
+    return {'npix': npix, 'stages': results}
+
+
+def _get_sample_image(env, srun):
+    """
+    path of the image for the sample run, found with the sample
+    environment
+    """
+    code = 'import nbrsim; print(nbrsim.files.get_image_file(%r, 0))' % srun
+    output = subprocess.check_output([sys.executable, '-c', code], env=env)
+    return output.decode().split()[-1]
+
+
+def time_command(cmd, env=None):
+    """
+    run a command, measuring its wall time, cpu time and peak memory
+
+    returns
+    -------
+    dict with wall_seconds, cpu_seconds and max_rss_bytes
+    """
+    print(' '.join(cmd))
+
+    tm0 = time.time()
+    proc = subprocess.Popen(cmd, env=env)
+
+    # wait4 gives the resource usage of this child only
+    pid, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = status
+    wall = time.time() - tm0
+
+    if status != 0:
+        raise RuntimeError("command failed: %s" % ' '.join(cmd))
+
+    # ru_maxrss is in kilobytes on linux
+    return {
+        'wall_seconds': wall,
+        'cpu_seconds': usage.ru_utime + usage.ru_stime,
+        'max_rss_bytes': usage.ru_maxrss*1024,
+    }
+
+
+def scale_config(conf, scale):
+    """
+    make a copy of the config for a single file, with the image side
+    scaled by the specified factor and the number of objects by its
+    square, so the density is kept
+    """
+    conf = copy.deepcopy(conf)
+
+    image = conf['image']
+    image['xsize'] = max(int(image['xsize']*scale), 64)
+    image['ysize'] = max(int(image['ysize']*scale), 64)
+
+    nobjects = image.get('nobjects', None)
+    if isinstance(nobjects, int):
+        image['nobjects'] = max(int(nobjects*scale**2), 1)
+
+    conf['output']['nfiles'] = 1
+    conf['output'].pop('dir', None)
+    return conf
+
+
+def extrapolate(x, y, xnew):
+    """
+    linear extrapolation from two points, never below the larger of them
+    """
+    (x1, x2), (y1, y2) = x, y
+    if x2 == x1:
+        return max(y1, y2)
+
+    slope = (y2 - y1)/float(x2 - x1)
+    ynew = y2 + slope*(xnew - x2)
+    return max(ynew, y1, y2)
+
+
+def combine_stages(stages):
+    """
+    resources for the fused pipeline, which runs the stages in sequence
+    """
+    out = {}
+    for key, combine in [('wall_seconds', sum),
+                         ('cpu_seconds', sum),
+                         ('max_rss_bytes', max),
+                         ('output_bytes', sum),
+                         ('scratch_bytes', max)]:
+        vals = [stages[s].get(key) for s in STAGES]
+        if any(v is None for v in vals):
+            continue
+        out[key] = combine(vals)
+
+    return out
+
+
+def get_totals(plan):
+    """
+    totals over the run
+    """
+    total = {}
+    pipeline = plan['stages']['pipeline']
+    if 'cpu_seconds' in pipeline:
+        total['cpu_hours'] = pipeline['cpu_seconds']*plan['nfiles']/3600.0
+        total['wall_hours'] = pipeline['wall_seconds']*plan['nfiles']/3600.0
+    if 'output_bytes' in pipeline:
+        total['output_bytes'] = pipeline['output_bytes']*plan['nfiles']
+    return total
+
+
+def get_requests(plan, stage, nper=1):
+    """
+    get the batch requests for a stage from the plan
+
+    parameters
+    ----------
+    plan: dict
+        The plan
+    stage: string
+        'galsim', 'reduce', 'meds' or 'pipeline'
+    nper: int, optional
+        Number of indices processed by each job
+
+    returns
+    -------
+    dict with wall_seconds, mem_bytes and scratch_bytes, each None if
+    not estimated
+    """
+    est = plan['stages'].get(stage, {})
+
+    wall = est.get('wall_seconds')
+    if wall is not None:
+        wall = max(wall*nper*SAFETY_FACTOR, MIN_WALL_SECONDS)
+
+    mem = est.get('max_rss_bytes')
+    if mem is not None:
+        mem = max(mem*SAFETY_FACTOR, MIN_MEM_BYTES)
+
+    scratch = est.get('scratch_bytes')
+    if scratch is not None:
+        scratch = max(scratch*SAFETY_FACTOR, MIN_SCRATCH_BYTES)
+
+    return {
+        'wall_seconds': wall,
+        'mem_bytes': mem,
+        'scratch_bytes': scratch,
+    }
+
+
+def get_image_shape(conf):
+    """
+    get (nrows, ncols) from the config, or None
+    """
+    image = conf.get('image', {})
+    try:
+        return int(image['ysize']), int(image['xsize'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def get_nobjects(conf):
+    """
+    get the number of objects per image from the config, or None if it
+    is not a fixed number
+    """
+    image = conf.get('image', {})
+    nobjects = image.get('nobjects', None)
+    if isinstance(nobjects, int):
+        return nobjects
+
+    try:
+        return int(image['nx_tiles'])*int(image['ny_tiles'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def write_plan(run, plan):
+    """
+    write the plan to the run directory
+    """
+    import yaml
+
+    fname = files.get_plan_file(run)
+    dir = os.path.dirname(fname)
+    if not os.path.exists(dir):
+        os.makedirs(dir)
+
+    print("writing:",fname)
+    with open(fname, 'w') as fobj:
+        yaml.safe_dump(plan, fobj, default_flow_style=False)
+
+
+def read_plan(run):
+    """
+    read the plan for the run, or None if there is none
+    """
+    fname = files.get_plan_file(run)
+    if not os.path.exists(fname):
+        return None
+
+    return files.read_yaml(fname)
+
+
+def print_plan(plan):
+    """
+    print a table of the estimates
+    """
+    print("run %s: %d files, shape %s, %s objects" % (
+        plan['run'], plan['nfiles'], plan['shape'], plan['nobjects'],
+    ))
+
+    print("%-10s %10s %10s %10s %10s %10s" % (
+        'stage', 'wall(s)', 'cpu(s)', 'mem(MB)', 'scratch(MB)', 'output(MB)',
+    ))
+    for stage in STAGES + ['pipeline']:
+        est = plan['stages'][stage]
+        print("%-10s %10s %10s %10s %10s %10s" % (
+            stage,
+            _fmt(est.get('wall_seconds')),
+            _fmt(est.get('cpu_seconds')),
+            _fmt(est.get('max_rss_bytes'), 1024.0**2),
+            _fmt(est.get('scratch_bytes'), 1024.0**2),
+            _fmt(est.get('output_bytes'), 1024.0**2),
+        ))
+
+    total = plan['total']
+    if 'cpu_hours' in total:
+        print("total: %.1f cpu hours, %.1f GB output" % (
+            total['cpu_hours'], total['output_bytes']/1024.0**3,
+        ))
+
+
+def get_dir_size(dir):
+    total = 0
+    for root, dirs, fnames in os.walk(dir):
+        for fname in fnames:
+            path = os.path.join(root, fname)
+            if not os.path.islink(path):
+                total += os.path.getsize(path)
+    return total
+
+
+def _fmt(val, unit=1.0):
+    if val is None:
+        return '-'
+    return '%.1f' % (val/unit)
@@ -0,0 +1,161 @@
+"""
+diagnostic plots
+
+These are rendered on demand from the small data files written by
+nbrsim-reduce, rather than during processing.  biggles is only imported
+when a plot is actually made.
+"""
+from __future__ import print_function
+import os
+import numpy
+
+from . import files
+
+SIZEMAG_DTYPE = [
+    ('mag','f4'),
+    ('T','f4'),
+    ('star_flag','i2'),
+]
+
+
+def get_sizemag_data(data):
+    """
+    extract the data needed for the size-magnitude diagram
+
+    parameters
+    ----------
+    data: array with fields
+        The findstars output, with fields mag, sigma0 and star_flag
+
+    returns
+    -------
+    array with fields mag, T, star_flag
+    """
+    output = numpy.zeros(data.size, dtype=SIZEMAG_DTYPE)
+    output['mag'] = data['mag']
+    output['T'] = 2*data['sigma0']**2
+    output['star_flag'] = data['star_flag']
+    return output
+
+
+def plot_sizemag(data, filename):
+    """
+    plot T versus magnitude, highlighting the stars
+
+    parameters
+    ----------
+    data: array with fields
+        Array with fields mag, T and star_flag, as returned by
+        get_sizemag_data
+    filename: string
+        The file to write
+    """
+    import biggles
+
+    key=biggles.PlotKey(0.1, 0.9, halign='left')
+
+    plt = biggles.FramedPlot(
+        xlabel='mag',
+        ylabel='T',
+        aspect_ratio=1.0/1.618,
+        xrange=[16,26],
+        yrange=[0,2],
+        key=key,
+    )
+
+    wstar,=numpy.where(data['star_flag'] == 1)
+
+    T = data['T']
+    pts = biggles.Points(
+        data['mag'],
+        T,
+        type='dot',
+        label='all'
+    )
+
+    spts = biggles.Points(
+        data['mag'][wstar],
+        T[wstar],
+        type='circle',
+        size=1.0,
+        color='steelblue',
+        label='star'
+    )
+
+    plt.add(pts,spts)
+
+    print("writing sizemag diagram:",filename)
+    plt.write(filename)
+
+
+def make_sizemag_plot(run, index):
+    """
+    make the size-magnitude plot for the specified index, from the
+    data written by nbrsim-reduce
+
+    returns
+    -------
+    The path to the plot, or None if the data file is missing
+    """
+    import fitsio
+
+    fname = files.get_sizemag_file(run, index)
+    if not os.path.exists(fname):
+        print("missing sizemag data:",fname)
+        return None
+
+    data = fitsio.read(fname)
+    plot_file = files.get_sizemag_plot_file(run, index)
+
+    if files.is_packed(run):
+        import tempfile
+
+        # write locally and put the plot in the pack
+        local_file = os.path.join(
+            tempfile.gettempdir(),
+            '%d-%s' % (os.getpid(), os.path.basename(plot_file)),
+        )
+        plot_sizemag(data, local_file)
+        files.store_file(local_file, plot_file, remove=True)
+    else:
+        plot_sizemag(data, plot_file)
+
+    return plot_file
+
+
+def make_plots(run, indices, nproc=1):
+    """
+    make the plots for the specified indices
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    indices: sequence of ints
+        The indices to plot
+    nproc: int, optional
+        Number of processes to use
+
+    returns
+    -------
+    list of plot files that were written
+    """
+
+    args = [(run, index) for index in indices]
+
+    if nproc > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(nproc)
+        try:
+            plot_files = pool.map(_make_sizemag_plot_wrapper, args)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        plot_files = [_make_sizemag_plot_wrapper(arg) for arg in args]
+
+    return [f for f in plot_files if f is not None]
+
+
+def _make_sizemag_plot_wrapper(arg):
+    return make_sizemag_plot(*arg)
@@ -0,0 +1,200 @@
+"""
+cache of rendered psf images
+
+The psf for a run comes entirely from the psf and image.wcs blocks of the
+galsim config, so every index gets the same image.  We render it once,
+store it in the run directory keyed by a hash of those blocks, and keep a
+copy in memory for the life of the process.
+"""
+from __future__ import print_function
+import os
+import numpy
+
+from . import files
+from .config import get_config_digest
+from .moments import get_moments
+
+# in-memory cache keyed by the psf key
+_cache = {}
+
+
+def get_psf_key(galsim_conf):
+    """
+    get the key for the psf, a hash of the psf and wcs config
+
+    parameters
+    ----------
+    galsim_conf: dict
+        The galsim config for the run
+    """
+    conf = {
+        'psf': galsim_conf['psf'],
+        'wcs': galsim_conf['image']['wcs'],
+    }
+    return get_config_digest(conf)
+
+
+def get_psf(run, galsim_conf):
+    """
+    get the rendered psf image and its centroid and sigma
+
+    The image is taken from the in-memory cache, then from the cache file
+    in the run directory, and is only drawn with galsim if neither
+    exists.
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    galsim_conf: dict
+        The galsim config for the run
+
+    returns
+    -------
+    dict with entries
+        image: the psf image, read only
+        cen: the [row, col] centroid
+        sigma: sqrt(T/2) from unweighted moments
+    """
+
+    key = get_psf_key(galsim_conf)
+
+    psf = _cache.get(key)
+    if psf is not None:
+        return psf
+
+    fname = files.get_psf_cache_file(run, key)
+    if os.path.exists(fname):
+        psf = read_psf(fname)
+    else:
+        psf = make_psf(galsim_conf)
+        write_psf(fname, psf)
+
+    psf['image'].flags.writeable = False
+    _cache[key] = psf
+    return psf
+
+
+def make_psf(galsim_conf):
+    """
+    draw the psf using galsim and measure its moments
+
+    parameters
+    ----------
+    galsim_conf: dict
+        The galsim config for the run
+
+    returns
+    -------
+    dict with entries image, cen, sigma
+    """
+    import galsim
+
+    pconf = galsim_conf['psf']
+    wcsconf = galsim_conf['image']['wcs']
+
+    type=pconf['type']
+    if type == 'Moffat':
+        psf = galsim.Moffat(
+            beta=pconf['beta'],
+            fwhm=pconf['fwhm'],
+        )
+    elif type == 'Gaussian':
+        psf = galsim.Gaussian(
+            fwhm=pconf['fwhm'],
+        )
+    else:
+        raise ValueError("bad psf type: '%s'" % type)
+
+    if 'ellip' in pconf:
+        psf = psf.shear(
+            g1=pconf['ellip']['g1'],
+            g2=pconf['ellip']['g2'],
+        )
+
+    print("psf:",psf)
+
+    wcs = galsim.JacobianWCS(
+        dudx = wcsconf['dudx'],
+        dudy = wcsconf['dudy'],
+        dvdx = wcsconf['dvdx'],
+        dvdy = wcsconf['dvdy'],
+    )
+
+    image = psf.drawImage(
+        wcs = wcs,
+    ).array
+
+    return make_psf_dict(image)
+
+
+def make_psf_dict(image):
+    """
+    measure the moments of the psf image and package them with the image
+    """
+    moms = get_moments(image)[0]
+
+    return {
+        'image': image,
+        'cen': moms['cen'].copy(),
+        'sigma': numpy.sqrt(moms['T']/2.0),
+    }
+
+
+def read_psf(fname):
+    """
+    read a psf cache file
+    """
+    import fitsio
+
+    print("reading psf:",fname)
+    image, hdr = fitsio.read(fname, header=True)
+
+    return {
+        'image': image,
+        'cen': numpy.array([hdr['cen_row'], hdr['cen_col']]),
+        'sigma': hdr['sigma'],
+    }
+
+
+def write_psf(fname, psf):
+    """
+    write a psf cache file
+
+    We write to a temporary file and rename, so other jobs never read a
+    partial file.  Failure to write is not an error.
+    """
+    import fitsio
+
+    dir = os.path.dirname(fname)
+    tmpname = '%s.tmp%d' % (fname, os.getpid())
+
+    hdr = [
+        {'name':'cen_row', 'value':psf['cen'][0]},
+        {'name':'cen_col', 'value':psf['cen'][1]},
+        {'name':'sigma', 'value':psf['sigma']},
+    ]
+
+    print("writing psf:",fname)
+    try:
+        if not os.path.exists(dir):
+            try:
+                os.makedirs(dir)
+            except OSError:
+                # another job may have made it
+                if not os.path.exists(dir):
+                    raise
+
+        fitsio.write(tmpname, psf['image'], header=hdr, clobber=True)
+        os.rename(tmpname, fname)
+    except (IOError, OSError) as err:
+        print("could not write psf cache %s: %s" % (fname, err))
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+
+
+def clear_cache():
+    """
+    clear the in-memory cache
+    """
+    _cache.clear()
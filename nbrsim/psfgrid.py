@@ -0,0 +1,291 @@
+"""
+spatially varying psfs evaluated on a grid
+
+Evaluating a psf model for every object is expensive.  Instead the model is
+drawn at the nodes of a grid across the image, and the psf at an arbitrary
+location is taken from the nearest node or interpolated between nodes.
+Nodes are drawn when first needed and kept for reuse.
+"""
+from __future__ import print_function
+import numpy
+
+from .moments import get_moments
+
+DEFAULT_GRID_SHAPE = (8, 8)
+
+
+class PSFGrid(object):
+    """
+    provide psf images from a grid of precomputed images
+
+    This has the same interface as medsmaker.PSFMaker, for use with the
+    MEDS writer, plus methods to get images for many locations at once
+
+    parameters
+    ----------
+    draw_func: callable
+        Called as draw_func(row, col) to draw the psf at the zero-offset
+        location.  All images must have the same shape.
+    image_shape: sequence
+        The (nrow, ncol) shape of the image
+    grid_shape: sequence, optional
+        Number of grid nodes in the row and column directions.
+        Default (8, 8)
+    interp: string, optional
+        'bilinear' to interpolate between the nearest four nodes,
+        or 'nearest' to use the nearest node.  Default 'bilinear'
+    """
+    def __init__(self, draw_func, image_shape,
+                 grid_shape=DEFAULT_GRID_SHAPE, interp='bilinear'):
+
+        if interp not in ['bilinear','nearest']:
+            raise ValueError("bad interp: '%s'" % interp)
+
+        self.draw_func = draw_func
+        self.image_shape = tuple(image_shape)
+        self.grid_shape = tuple(grid_shape)
+        self.interp = interp
+
+        # nodes at the centers of grid cells
+        self.node_rows = self._get_node_positions(
+            self.image_shape[0], self.grid_shape[0],
+        )
+        self.node_cols = self._get_node_positions(
+            self.image_shape[1], self.grid_shape[1],
+        )
+
+        self._images = None
+        self._cens = numpy.zeros(self.grid_shape + (2,))
+        self._sigmas = numpy.zeros(self.grid_shape)
+        self._drawn = numpy.zeros(self.grid_shape, dtype=bool)
+
+    def get_shape(self, *args, **kw):
+        """
+        get the shape of the psf images
+        """
+        self._draw_nodes(numpy.array([0]), numpy.array([0]))
+        return self._images.shape[2:]
+
+    def get_rec(self, row, col):
+        """
+        get the psf image at the specified location
+
+        For nearest node interpolation this is a read-only view of the
+        node image rather than a copy
+        """
+        if self.interp == 'nearest':
+            irow, icol = self._get_nearest_node(row, col)
+            return self._images[irow, icol]
+
+        return self.get_recs(row, col)[0]
+
+    def get_cen(self, row, col):
+        """
+        get the [row, col] centroid of the psf image at the specified
+        location
+        """
+        if self.interp == 'nearest':
+            irow, icol = self._get_nearest_node(row, col)
+            return self._cens[irow, icol]
+
+        return self.get_cens(row, col)[0]
+
+    def get_sigma(self, row, col):
+        """
+        get the psf size sqrt(T/2) at the specified location
+        """
+        return self.get_sigmas(row, col)[0]
+
+    def get_recs(self, rows, cols):
+        """
+        get psf images for many locations
+
+        parameters
+        ----------
+        rows, cols: arrays
+            zero-offset locations in the image
+
+        returns
+        -------
+        array of shape (n, psf_nrow, psf_ncol)
+        """
+        return self._interpolate(rows, cols, 'images')
+
+    def get_cens(self, rows, cols):
+        """
+        get psf centroids for many locations, shape (n, 2)
+        """
+        return self._interpolate(rows, cols, 'cens')
+
+    def get_sigmas(self, rows, cols):
+        """
+        get psf sizes sqrt(T/2) for many locations
+        """
+        return self._interpolate(rows, cols, 'sigmas')
+
+    def _get_nearest_node(self, row, col):
+        """
+        get the indices of the nearest node to a single location,
+        making sure it is drawn
+        """
+        irow = self._get_nearest(numpy.atleast_1d(row), self.node_rows)
+        icol = self._get_nearest(numpy.atleast_1d(col), self.node_cols)
+        self._draw_nodes(irow, icol)
+        return irow[0], icol[0]
+
+    def _interpolate(self, rows, cols, name):
+        """
+        get the data for each location from the grid
+        """
+        rows = numpy.atleast_1d(rows)
+        cols = numpy.atleast_1d(cols)
+
+        if self.interp == 'nearest':
+            irow = self._get_nearest(rows, self.node_rows)
+            icol = self._get_nearest(cols, self.node_cols)
+
+            self._draw_nodes(irow, icol)
+            data = self._get_data(name)
+            return data[irow, icol]
+
+        irow, rfrac = self._get_lower(rows, self.node_rows)
+        icol, cfrac = self._get_lower(cols, self.node_cols)
+
+        irow1 = (irow + 1).clip(max=self.grid_shape[0]-1)
+        icol1 = (icol + 1).clip(max=self.grid_shape[1]-1)
+
+        self._draw_nodes(
+            numpy.concatenate([irow, irow, irow1, irow1]),
+            numpy.concatenate([icol, icol1, icol, icol1]),
+        )
+        data = self._get_data(name)
+
+        # broadcast the weights over any extra dimensions of the data
+        extra = (numpy.newaxis,)*(data.ndim-2)
+        rfrac = rfrac[(slice(None),) + extra]
+        cfrac = cfrac[(slice(None),) + extra]
+
+        return (
+            (1-rfrac)*(1-cfrac)*data[irow, icol]
+            + (1-rfrac)*cfrac*data[irow, icol1]
+            + rfrac*(1-cfrac)*data[irow1, icol]
+            + rfrac*cfrac*data[irow1, icol1]
+        )
+
+    def _get_data(self, name):
+        if name == 'images':
+            return self._images
+        elif name == 'cens':
+            return self._cens
+        else:
+            return self._sigmas
+
+    def _draw_nodes(self, irow, icol):
+        """
+        draw any of the requested nodes that are not yet drawn
+        """
+        need = numpy.zeros(self.grid_shape, dtype=bool)
+        need[irow, icol] = True
+        need &= ~self._drawn
+
+        wrow, wcol = numpy.where(need)
+        if wrow.size == 0:
+            return
+
+        images = [
+            self.draw_func(self.node_rows[ir], self.node_cols[ic])
+            for ir, ic in zip(wrow, wcol)
+        ]
+        images = numpy.array(images, dtype='f8')
+
+        if self._images is None:
+            self._images = numpy.zeros(
+                self.grid_shape + images.shape[1:],
+            )
+        elif images.shape[1:] != self._images.shape[2:]:
+            raise ValueError("psf images have different shapes: "
+                             "%s %s" % (images.shape[1:], self._images.shape[2:]))
+
+        moms = get_moments(images)
+
+        # node data are handed out as views, so they are only writeable
+        # while we fill them
+        for arr in [self._images, self._cens, self._sigmas]:
+            arr.flags.writeable = True
+
+        self._images[wrow, wcol] = images
+        self._cens[wrow, wcol] = moms['cen']
+        self._sigmas[wrow, wcol] = numpy.sqrt(moms['T']/2.0)
+        self._drawn[wrow, wcol] = True
+
+        for arr in [self._images, self._cens, self._sigmas]:
+            arr.flags.writeable = False
+
+    def _get_node_positions(self, npix, nnode):
+        return (numpy.arange(nnode) + 0.5)*npix/float(nnode) - 0.5
+
+    def _get_nearest(self, pos, nodes):
+        """
+        index of the nearest node
+        """
+        spacing = nodes[1]-nodes[0] if nodes.size > 1 else 1.0
+        ind = numpy.rint((pos - nodes[0])/spacing).astype('i8')
+        return ind.clip(min=0, max=nodes.size-1)
+
+    def _get_lower(self, pos, nodes):
+        """
+        index of the node below each position, and the fractional distance
+        to the next node.  Positions beyond the outer nodes take the
+        value of the outer node
+        """
+        if nodes.size == 1:
+            return numpy.zeros(pos.size, dtype='i8'), numpy.zeros(pos.size)
+
+        spacing = nodes[1]-nodes[0]
+        fpos = ((pos - nodes[0])/spacing).clip(min=0, max=nodes.size-1)
+
+        ind = numpy.floor(fpos).astype('i8').clip(max=nodes.size-2)
+        return ind, fpos - ind
+
+
+def get_psfex_draw_func(fname):
+    """
+    get a function to draw a psfex model
+
+    parameters
+    ----------
+    fname: string
+        The psfex .psf file
+    """
+    import psfex
+
+    print("loading psfex model:",fname)
+    pex = psfex.PSFEx(fname)
+
+    def draw_func(row, col):
+        return pex.get_rec(row, col)
+
+    return draw_func
+
+
+def get_piff_draw_func(fname, stamp_size=25):
+    """
+    get a function to draw a piff model
+
+    parameters
+    ----------
+    fname: string
+        The piff output file
+    stamp_size: int, optional
+        Size of the drawn images
+    """
+    import piff
+
+    print("loading piff model:",fname)
+    psf = piff.read(fname)
+
+    def draw_func(row, col):
+        # piff uses 1-offset positions
+        return psf.draw(x=col+1, y=row+1, stamp_size=stamp_size).array
+
+    return draw_func
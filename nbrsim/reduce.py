@@ -0,0 +1,1024 @@
+"""
+hacked up version of Mike Jarvis' code for processing
+DES data. This code is a mess and needs to be cleaned up.
+
+This is used by nbrsim-reduce, and by the fused pipeline which runs
+process_image on an image that is already in the work directory.
+"""
+# Run PSFEx for a set of exposures, including making any necessarily input files.
+
+from __future__ import print_function
+import os
+import traceback
+import astropy.io.fits as pyfits
+import numpy
+import copy
+import time
+import fitsio
+
+import nbrsim
+from . import files
+from . import nodecache
+from . import compression
+from .stages import StageGraph
+from .stageout import StageOut, stage_out_file
+from .scratch import Scratch, estimate_footprint, get_image_shape_from_file
+
+# How many stars are too few or too many?
+FEW_STARS = 20
+MANY_STARS_FRAC = 0.5
+# How high is a high FWHM?  3.6 arcsec / 0.26 arcsec/pixel = 13.8 pixels
+HIGH_FWHM = 13.8
+
+# flag values
+NO_STARS_FLAG = 1
+TOO_FEW_STARS_FLAG = 2
+TOO_MANY_STARS_FLAG = 4
+TOO_HIGH_FWHM_FLAG = 8
+FINDSTARS_FAILURE = 16
+PSFEX_FAILURE = 32
+ERROR_FLAG = 64
+
+CATBACK='sxcat'
+
+class NoStarsException(Exception):
+    pass
+
+
+def get_parser():
+    import argparse
+    
+    parser = argparse.ArgumentParser(description='Run PSFEx on a set of runs/exposures')
+
+    parser.add_argument('image',help='the image to process')
+
+    # Directory arguments
+    parser.add_argument('--work', default=None,
+                        help=('location of intermediate outputs.  Default is '
+                              'chosen from the scratch directories by space'))
+    parser.add_argument('--tag', default=None,
+                        help='A version tag to add to the directory name')
+    parser.add_argument('--clear_output', default=False, action='store_const', const=True,
+                        help='should the output directory be cleared before writing new files?')
+
+
+    parser.add_argument('--noweight', default=False, action='store_const', const=True,
+                        help='do not try to use a weight image.')
+
+
+    # Options
+    parser.add_argument('--rm_files', default=1, type=int,
+                        help='remove unpacked files after finished')
+
+    parser.add_argument('--run_psfex', default=1, type=int,
+                        help='run psfex on files')
+    parser.add_argument('--run_piff', default=0, type=int,
+                        help='run piff on files')
+
+    parser.add_argument('--mag_cut', default=-1, type=float,
+                        help='remove the top mags using mag_auto')
+    parser.add_argument('--nbright_stars', default=10, type=int,
+                        help='use median of this many brightest stars for min mag')
+    parser.add_argument('--max_mag', default=-1, type=float,
+                        help='only use stars brighter than this mag')
+    parser.add_argument('--reserve', default=0, type=float,
+                        help='Reserve some fraction of the good stars for testing')
+
+    parser.add_argument('--matchrad', default=8, type=float,
+                        help='match radius in pixels')
+
+    parser.add_argument('--nproc', default=1, type=int,
+                        help='number of independent stages to run at once')
+
+    parser.add_argument('--native_stars', default=0, type=int,
+                        help='select stars in process rather than running findstars')
+    parser.add_argument('--psf_diagnostics', default=0, type=int,
+                        help='compare moments of stars and the psf model')
+    parser.add_argument('--plots', default=0, type=int,
+                        help='make diagnostic plots now rather than with nbrsim-plots')
+
+    return parser
+
+def parse_args(argv=None):
+    """
+    parse the command line, or the input list of arguments
+    """
+    parser = get_parser()
+    args = parser.parse_args(argv)
+
+    if args.run_piff:
+        args.run_psfex = False
+    return args
+
+def parse_file_name(file_name):
+    """Parse the file name to get the directory, the root name, and the chip number
+    """
+    # find out if the file is fpacked by the extension
+    base_file = os.path.split(file_name)[1]
+
+    # find the base filename
+    if os.path.splitext(base_file)[1] == '.fz':
+        base_file=os.path.splitext(base_file)[0]
+    
+    if os.path.splitext(base_file)[1] != '.fits':
+        raise ValueError("Invalid file name "+file)
+    root = os.path.splitext(base_file)[0]
+
+    return root
+
+def read_image_header(img_file):
+    """Read some information from the image header.
+
+    Currently this is just the SATURATE and FWHM values.
+
+    Returns sat, fwhm
+    """
+    hdu = 0
+
+    with pyfits.open(img_file,memmap=False) as pyf:
+        sat = -1
+        fwhm = 4.
+        try:
+            sat = pyf[hdu].header['SATURATE']
+            fwhm = pyf[hdu].header['FWHM']
+        except:
+            print("Cannot read header information from " + img_file)
+            #raise RuntimeError("Cannot read header information from " + img_file)
+    return sat, fwhm
+ 
+
+def run_sextractor(wdir, root, img_file, sat, fwhm, noweight):
+    """Run sextractor, but only if the output file does not exist yet.
+    """
+
+    print('\n' + '-'*70)
+    print('   running sextractor')
+
+    sx_exe = files.get_sx_exe()
+
+    sx_config = files.get_sx_config()
+    sx_params = files.get_sx_params()
+    sx_filter = files.get_sx_filter()
+    sx_nnw = files.get_sx_nnw()
+
+    cat_file = os.path.join(wdir,root.replace('-image','-%s' % CATBACK) + '.fits')
+    seg_file = os.path.join(wdir,root.replace('-image','-%s' % 'seg') + '.fits')
+
+    cat_cmd = [
+        "{sx_exe}",
+        "{img_file}[0]",
+        "-c {sx_config}",
+        "-CATALOG_NAME {cat_file}",
+        "-CATALOG_TYPE FITS_LDAC",
+        "-PARAMETERS_NAME {sx_params}",
+        "-FILTER_NAME {sx_filter}",
+        "-STARNNW_NAME {sx_nnw}",
+        "-DETECT_MINAREA 3",
+        "-CHECKIMAGE_TYPE SEGMENTATION",
+        "-CHECKIMAGE_NAME {seg_file}",
+    ]
+
+    if not noweight:
+        cat_cmd += [
+            "-WEIGHT_TYPE MAP_WEIGHT",
+            "-WEIGHT_IMAGE {img_file}[2]",
+        ]
+    if fwhm != 0:
+        cat_cmd += ["-SEEING_FWHM {fwhm}"]
+
+    if sat != -1:
+        cat_cmd += ["-SATUR_LEVEL {sat}"]
+
+    cat_cmd = "  \\\n    ".join(cat_cmd)
+    #cat_cmd = r"""
+    #{sx_exe} \
+    #        {img_file}[0] \
+    #        -c {sx_config} \
+    #        -CATALOG_NAME {cat_file} \
+    #        -CATALOG_TYPE FITS_LDAC \
+    #        -PARAMETERS_NAME {sx_params} \
+    #        -FILTER_NAME {sx_filter} \
+    #        -STARNNW_NAME {sx_nnw} \
+    #        -DETECT_MINAREA 3 \
+    #        -CHECKIMAGE_TYPE SEGMENTATION \
+    #        -CHECKIMAGE_NAME {seg_file}
+    #"""
+    cat_cmd = cat_cmd.format(
+        sx_exe=sx_exe,
+        img_file=img_file,
+        sx_config=sx_config,
+        cat_file=cat_file,
+        sx_params=sx_params,
+        sx_filter=sx_filter,
+        sx_nnw=sx_nnw,
+        seg_file=seg_file,
+        fwhm=fwhm,
+        sat=sat,
+    )
+
+
+    print(cat_cmd)
+    os.system(cat_cmd)
+
+    fpack_cmd = compression.get_fpack_command('seg', seg_file)
+    print(fpack_cmd)
+    os.system(fpack_cmd)
+    fz_seg_file = seg_file+'.fz'
+
+
+
+    return cat_file, fz_seg_file
+
+def match2truth(args, cat_file, sx=None, truth_file=None):
+    """
+    match the sextractor catalog to the truth, returning the match file
+    and the matched data
+    """
+
+    if truth_file is None:
+        truth_file=args.image.replace('-image.fits.fz','-truth.fits')
+        assert truth_file != args.image
+
+    match_file=cat_file.replace('sxcat.fits','match.fits')
+
+    assert match_file != cat_file
+
+    if sx is None:
+        sx = read_sxcat(cat_file)
+    truth = fitsio.read(truth_file)
+
+    radius=8 # pixels
+    matchdata = nbrsim.util.match_truth(
+        sx,
+        truth,
+        radius=args.matchrad,
+    )
+
+    print("writing:",match_file)
+    fitsio.write(match_file,  matchdata, clobber=True)
+    return match_file, matchdata
+
+
+def run_findstars(wdir, root, cat_file):
+    """
+    Run findstars, and return a new updated catalog file to use.
+    """
+
+    print('\n' + '-'*70)
+    fs_exe = files.get_findstars_exe()
+
+
+    fs_config = files.get_wl_config() + ' +'+files.get_findstars_config()
+
+    findstars_file = wdir+'/'+root.replace('-image','-findstars.fits')
+
+    # run find stars
+    print('   running findstars')
+    findstars_cmd = r"""
+    {fs_exe} \
+            {fs_config} \
+            root={root} \
+            cat_file={cat_file} \
+            stars_file={findstars_file} \
+            input_prefix={wdir}/
+    """
+    findstars_cmd = findstars_cmd.format(
+        fs_exe=fs_exe,
+        fs_config=fs_config,
+        root=root,
+        findstars_file=findstars_file,
+        wdir=wdir,
+        cat_file=cat_file,
+    )
+    print(findstars_cmd)
+    os.system(findstars_cmd)
+
+    if not os.path.exists(findstars_file):
+        print('   Error running findstars.  Rerun with verbose=2.')
+        findstars_cmd = '{fs_exe} {fs_config} root={root} cat_ext=-{catback}.fits stars_file={findstars_file} input_prefix={wdir}/ verbose=2 debug_ext=_fs.debug'.format(
+            fs_exe=fs_exe, fs_config=fs_config, root=root, findstars_file=findstars_file, 
+            wdir=wdir,
+            catback=CATBACK,
+        )
+        print(findstars_cmd)
+        os.system(findstars_cmd)
+        print('   The debug file is',root + '_fs.debug')
+        if not os.path.exists(findstars_file):
+            return None, None, None, None
+
+    # Make a mask based on which objects findstars decided are stars.
+    with pyfits.open(findstars_file,memmap=False) as pyf:
+        mask = pyf[1].data['star_flag']==1
+    nstars = numpy.count_nonzero(mask)
+    ntot = len(mask)
+    print('   found %d stars'%nstars)
+    if nstars == 0:
+        # Can't really do any of the rest of this, so skip out to the end.
+        raise NoStarsException()
+
+    new_cat_file = write_psfex_input(cat_file, mask)
+
+    return findstars_file, new_cat_file, nstars, ntot
+
+def run_native_stars(wdir, root, cat_file, sx):
+    """
+    Select stars in process from the sextractor catalog, as an
+    alternative to the findstars executable.  The output has the
+    findstars columns we use, including star_flag.
+    """
+
+    print('\n' + '-'*70)
+    print('   selecting stars')
+
+    findstars_file = wdir+'/'+root.replace('-image','-findstars.fits')
+
+    data = nbrsim.stars.select_stars(sx)
+
+    print('   writing:',findstars_file)
+    fitsio.write(findstars_file, data, clobber=True)
+
+    mask = data['star_flag']==1
+    nstars = numpy.count_nonzero(mask)
+    ntot = len(mask)
+    print('   found %d stars'%nstars)
+    if nstars == 0:
+        raise NoStarsException()
+
+    new_cat_file = write_psfex_input(cat_file, mask)
+
+    return findstars_file, new_cat_file, nstars, ntot
+
+def write_psfex_input(cat_file, mask):
+    """
+    write the objects in the mask to a new catalog to use as input
+    to psfex, returning the new file name
+    """
+
+    # Read the information from the initial catalog file, including the bogus first two hdus.
+    with pyfits.open(cat_file,memmap=False) as pyf:
+        # Need to make copy of these to not fail
+        hdu1 = copy.copy(pyf[0])
+        hdu2 = copy.copy(pyf[1])
+        data = pyf[2].data[mask]
+
+        # create new catalog file with only these entries
+        hdu3 = pyfits.BinTableHDU(data)
+        hdu3.name = 'LDAC_OBJECTS'
+        hdu_list = pyfits.HDUList([hdu1, hdu2, hdu3])
+        new_cat_file = cat_file.replace(CATBACK,'%s-psfex-input' % CATBACK)
+        hdu_list.writeto(new_cat_file,clobber=True)
+
+    return new_cat_file
+
+def read_sxcat(cat_file):
+    """
+    read the objects from the sextractor catalog
+    """
+    return fitsio.read(cat_file, ext=2, lower=True)
+
+def remove_bad_stars(wdir, root, cat_file, tbdata,
+                     mag_cut, nbright_stars, max_mag,
+                     reserve, fwhm):
+    """Remove stars that are considered bad for some reason.
+
+    Currently these reasons include:
+    - Magnitude indicates that the star is significantly contaminated by the brighter/fatter
+      effect.
+    - Star falls in or near the tape bumps.
+    """
+
+    # get the brightest 10 stars that have flags=0 and take the median just in case some
+    # strange magnitudes were selected
+    with pyfits.open(cat_file,memmap=False) as pyf:
+        data = copy.copy(pyf[2].data)
+
+    # Start with a basic FLAGS==0 mask:
+    flags_mask = data['FLAGS']==0
+    print('   nstars with FLAGS==0 = ',numpy.count_nonzero(flags_mask))
+    data = data[flags_mask]
+
+    # Start with the current name.  We will update it below.
+    new_cat_file = cat_file
+
+    if mag_cut > 0:
+        mags = numpy.sort(data['MAG_AUTO'])
+        min_star = numpy.median(mags[0:nbright_stars])
+        print('   min mag = ',mags[0])
+        print('   median of brightest %d is '%nbright_stars, min_star)
+
+        mag_mask = data['MAG_AUTO'] > (min_star+mag_cut)
+        print('   select stars dimmer than',min_star+mag_cut)
+        print('   which includes %d stars'%numpy.count_nonzero(mag_mask))
+
+        data = data[mag_mask]
+        print('   after exclude bright: len(data) = ',len(data))
+        new_cat_file = new_cat_file.replace(CATBACK,'%s-magcut_%0.1f' % (CATBACK,mag_cut))
+
+    if max_mag > 0:
+        mag_mask = (data['MAG_AUTO'] < max_mag)
+        print('   also select stars brighter than',max_mag)
+        print('   which now includes %d stars'%numpy.count_nonzero(mag_mask))
+
+        data = data[mag_mask]
+        print('   after exclude faint: len(data) = ',len(data))
+        new_cat_file = new_cat_file.replace(CATBACK,'%s-maxmag-%0.1f' % (CATBACK,max_mag))
+
+    if reserve:
+        print('   reserve ',reserve)
+        n = len(data)
+        perm = numpy.random.permutation(n)
+        n1 = int(reserve * n)
+        print('   initial ids = ',data['NUMBER'])
+        reserve_data = data[perm[:n1]]
+        data = data[perm[n1:]]
+        print('   reserve_data ids = ',reserve_data['NUMBER'])
+        print('   final ids = ',data['NUMBER'])
+        print('   after reserve: len(data) = ',len(data))
+        new_cat_file = new_cat_file.replace(CATBACK,'%s-reserve_%0.2f' % (CATBACK,reserve))
+
+        reserve_file = os.path.join(wdir,root+'_reserve.fits')
+        cols = []
+        dtypes = []
+        for name in ['NUMBER', 'FLAGS', 'XWIN_IMAGE', 'YWIN_IMAGE', 'BACKGROUND', 
+                     'ALPHAWIN_J2000', 'DELTAWIN_J2000', 'FLUX_RADIUS']:
+            cols.append(reserve_data[name])
+            dtypes.append((name, reserve_data[name].dtype))
+        print('cols = ',cols)
+        print('dtypes = ',dtypes)
+        reserve_data = numpy.array(list(zip(*cols)), dtype=dtypes)
+        with fitsio.FITS(reserve_file,'rw',clobber=True) as f:
+            f.write_table(reserve_data)
+
+    # create new catalog file with only these entries
+    with pyfits.open(cat_file,memmap=False) as pyf:
+        hdu1 = copy.copy(pyf[0])
+        hdu2 = copy.copy(pyf[1])
+        hdu3 = pyfits.BinTableHDU(data)
+        hdu3.name = 'LDAC_OBJECTS'
+        hdu_list = pyfits.HDUList([hdu1, hdu2, hdu3])
+        # Apparently pyf still needs to be open when this command occurs in order to 
+        # be able to handle the hdu1 and hdu2 objects correctly.
+        # Hence, we don't read those earlier when we read data.
+        hdu_list.writeto(new_cat_file,clobber=True)
+
+    return new_cat_file, len(data)
+
+
+def get_fwhm(cat_file):
+    """Get the fwhm from the SExtractor FLUX_RADIUS estimates.
+    """
+
+    # get the brightest 10 stars that have flags=0 and take the median just in case some
+    # strange magnitudes were selected
+    with pyfits.open(cat_file,memmap=False) as pyf:
+        data = pyf[2].data
+        fwhm = 2. * data['FLUX_RADIUS']  # 2 * flux_radius is approx fwhm
+    stats = ( numpy.min(fwhm), numpy.max(fwhm),
+              numpy.mean(fwhm), numpy.median(fwhm) )
+    return stats
+
+
+def run_psfex(wdir, root, cat_file, psf_file, used_file, xml_file, resid_file):
+    """Run PSFEx
+
+    Returns True if successful, False if there was a catastrophic failure and no output 
+    file was written.
+    """
+
+    print('\n' + '-'*70)
+
+    psfex_exe = files.get_psfex_exe()
+    psfex_config = files.get_psfex_config()
+
+    if os.path.lexists(psf_file):
+        print('   deleting existing',psf_file)
+        os.unlink(psf_file)
+    print('   running psfex')
+    psf_cmd = r"""
+    {psfex_exe} \
+            {cat_file} \
+            -c {config} \
+            -OUTCAT_TYPE FITS_LDAC \
+            -OUTCAT_NAME {used_file} \
+            -XML_NAME {xml_file}
+    """
+    psf_cmd = psf_cmd.format(
+        psfex_exe=psfex_exe,
+        cat_file=cat_file,
+        config=psfex_config,
+        used_file=used_file,
+        xml_file=xml_file,
+    )
+    print(psf_cmd)
+    os.system(psf_cmd)
+
+    # PSFEx generates its output filename from the input catalog name.  If this doesn't match
+    # our target name, then rename it.
+    actual_psf_file = cat_file.replace('.fits','.psf')
+
+    if not os.path.exists(actual_psf_file):
+        print('   Error running PSFEx.  No ouput file was written.')
+        return False
+
+    if psf_file != actual_psf_file:
+        os.rename(actual_psf_file, psf_file)
+    return True
+
+
+def run_piff(wdir, root, img_file, cat_file, psf_file):
+    """Run Piffify
+
+    Returns True if successful, False if there was a catastrophic failure and no output 
+    file was written.
+    """
+
+    print('\n' + '-'*70)
+    piff_exe = files.get_piff_exe()
+    piff_config = files.get_piff_config()
+
+    if os.path.lexists(psf_file):
+        print('   deleting existing',psf_file)
+        os.unlink(psf_file)
+    print('   running piff')
+    psf_cmd = '{piff_exe} {config} input.images={images} input.cats={cat_file} output.dir={wdir} output.file_name={psf_file}'.format(
+            piff_exe=piff_exe, config=piff_config, images=img_file, cat_file=cat_file,
+            wdir=wdir, psf_file=psf_file)
+    print(psf_cmd)
+    os.system(psf_cmd)
+
+    if not os.path.exists(psf_file):
+        print('   Error running Piff.  No ouput file was written.')
+        return False
+
+    return True
+
+def copy_file_to_dir(fname, odir):
+    """
+    copy the file to the directory, verifying the copy before it
+    appears under its final name
+    """
+    return stage_out_file(fname, odir)
+
+
+def clear_output(odir):
+    if os.path.exists(odir):
+        for f in os.listdir(odir):
+            try:
+                os.remove(os.path.join(odir, f))
+            except OSError as e:
+                print("Ignore OSError from remove(odir/f):")
+                print(e)
+                pass
+
+def funpack_file(fname):
+    newfname=fname.replace(".fz","")
+    assert newfname != fname
+
+    cmd="funpack %s" % fname
+    os.system(cmd)
+
+    return newfname
+
+def findstars_stage(wdir, root, cat_file, stage_flags, sx=None):
+    """
+    run findstars and check the number of stars found
+
+    If the sextractor catalog sx is sent, stars are selected in process
+    rather than using the findstars executable
+
+    flags are appended to the input stage_flags list
+    """
+    if sx is not None:
+        findstars_file, psf_input_file, nstars, ntot = run_native_stars(
+            wdir,
+            root,
+            cat_file,
+            sx,
+        )
+    else:
+        findstars_file, psf_input_file, nstars, ntot = run_findstars(
+            wdir,
+            root,
+            cat_file,
+        )
+    if psf_input_file == None:
+        print('     -- flag for findstars failure')
+        stage_flags.append(FINDSTARS_FAILURE)
+        raise NoStarsException()
+
+    # Check if there are few or many staras.
+    if nstars < FEW_STARS:
+        print('     -- flag for too few stars: ',nstars)
+        stage_flags.append(TOO_FEW_STARS_FLAG)
+    if nstars > MANY_STARS_FRAC * ntot:
+        print('     -- flag for too many stars: %d/%d'%(nstars,ntot))
+        stage_flags.append(TOO_MANY_STARS_FLAG)
+
+    return findstars_file, psf_input_file
+
+def sizemag_stage(findstars_file, cat_file, odir, stager, make_plot):
+    """
+    write the data for the size-magnitude diagram and copy it to the
+    output directory.  The plot itself is only made if requested;
+    otherwise use nbrsim-plots later
+    """
+    data=fitsio.read(findstars_file, lower=True)
+    data=nbrsim.plotting.get_sizemag_data(data)
+
+    sizemag_file=cat_file.replace('sxcat.fits','sizemag.fits')
+    print("writing:",sizemag_file)
+    fitsio.write(sizemag_file, data, clobber=True)
+    stager.put(sizemag_file, odir)
+
+    if make_plot:
+        epsname=cat_file.replace('sxcat.fits','sizemag.eps')
+        nbrsim.plotting.plot_sizemag(data, epsname)
+        if not files.store_file(epsname, os.path.join(odir, os.path.basename(epsname))):
+            stager.put(epsname, odir)
+
+def check_fwhm(psf_input_file, fwhm, stage_flags):
+    """
+    Get the median fwhm of the given stars and compare to expectations
+
+    flags are appended to the input stage_flags list
+    """
+    star_fwhm = get_fwhm(psf_input_file)
+    print('   fwhm of stars = ',star_fwhm)
+    print('   cf. header fwhm = ',fwhm)
+    if star_fwhm[3] > HIGH_FWHM:
+        print('     -- flag for too high fwhm')
+        stage_flags.append(TOO_HIGH_FWHM_FLAG)
+    if star_fwhm[3] > 1.5 * fwhm:
+        print('     -- flag for too high fwhm compared to fwhm from fits header')
+        stage_flags.append(TOO_HIGH_FWHM_FLAG)
+
+def psfex_stage(wdir, root, odir, psf_input_file,
+                psf_file, used_file, xml_file, stage_flags, stager):
+    """
+    run psfex and move the result to the output directory
+    """
+    # PSFEx does this weird thing where it takes the names of the resid file,
+    # strips off the .fits ending, and replaces it with _ + cat_file
+    resid_file1 = os.path.join(wdir,'resid.fits')
+    print('resid_file1 = ',resid_file1)
+    cat_fname = os.path.basename(psf_input_file)
+    print('cat_fname = ',cat_fname)
+    resid_file2 = os.path.join(wdir,'resid_'+cat_fname)
+    print('resid_file2 = ',resid_file2)
+    success = run_psfex(wdir, root, psf_input_file, psf_file, used_file, xml_file,
+                        resid_file1)
+    if success:
+        stager.put(psf_file, odir)
+    else:
+        stage_flags.append(PSFEX_FAILURE)
+
+def piff_stage(wdir, root, odir, img_file, psf_input_file,
+               psf_file, stage_flags, stager):
+    """
+    run piff and move the result to the output directory
+    """
+    cat_fname = os.path.basename(psf_input_file)
+    print('cat_fname = ',cat_fname)
+    resid_file2 = os.path.join(wdir,'resid_'+cat_fname)
+    print('resid_file2 = ',resid_file2)
+    success = run_piff(wdir, root, img_file, psf_input_file, psf_file)
+    if success:
+        stager.put(psf_file, odir)
+    else:
+        stage_flags.append(PSFEX_FAILURE)
+
+def psf_diagnostics_stage(sx, findstars_file, psf_file, diag_file,
+                          use_piff, odir, stager):
+    """
+    compare adaptive moments of the star vignets to those of the psf
+    model evaluated at the star locations, and write the residuals
+    """
+
+    if not os.path.exists(psf_file):
+        print('   no psf file, skipping psf diagnostics')
+        return
+
+    fsdata = fitsio.read(findstars_file, lower=True)
+    stars = sx[fsdata['star_flag'] == 1]
+
+    rows = stars['ywin_image'] - 1
+    cols = stars['xwin_image'] - 1
+
+    # start the adaptive moments near the star size
+    weight_sigma = numpy.median(stars['flux_radius'])*nbrsim.stars.HALF_LIGHT_TO_SIGMA
+
+    print('   measuring moments for %d stars' % stars.size)
+    star_moms = nbrsim.moments.get_vignet_moments(
+        stars,
+        weight_sigma=weight_sigma,
+    )
+
+    model_stamps = draw_psf_models(psf_file, rows, cols, use_piff)
+    model_moms = nbrsim.moments.get_moments(
+        model_stamps,
+        weight_sigma=weight_sigma,
+    )
+
+    resid, stats = nbrsim.moments.compare_moments(star_moms, model_moms)
+    print('   psf residuals for %(nuse)d stars' % stats)
+    for name in ['dT_frac','de1','de2']:
+        print('       %s: %g +/- %g' % (name, stats[name], stats[name+'_err']))
+
+    dt = [('number','i4'), ('row','f8'), ('col','f8')] + resid.dtype.descr
+    output = numpy.zeros(resid.size, dtype=dt)
+    for name in resid.dtype.names:
+        output[name] = resid[name]
+    output['number'] = stars['number']
+    output['row'] = rows
+    output['col'] = cols
+
+    print('   writing:',diag_file)
+    fitsio.write(diag_file, output, clobber=True)
+    stager.put(diag_file, odir)
+
+def draw_psf_models(psf_file, rows, cols, use_piff):
+    """
+    draw the psfex or piff model at the input locations, returning a
+    stack of images
+    """
+    if use_piff:
+        import piff
+        psf = piff.read(psf_file)
+        stamps = [
+            psf.draw(x=col+1, y=row+1).array
+            for row, col in zip(rows, cols)
+        ]
+    else:
+        import psfex
+        psf = psfex.PSFEx(psf_file)
+        stamps = [
+            psf.get_rec(row, col)
+            for row, col in zip(rows, cols)
+        ]
+
+    return numpy.array(stamps)
+
+def get_work_dir(work):
+    """
+    expand the work directory and make it if it does not exist yet
+    """
+    work = os.path.expanduser(work)
+    work = os.path.expandvars(work)
+    work = os.path.abspath(work)
+    print('work dir = ',work)
+    try:
+        if not os.path.exists(work):
+            os.makedirs(work)
+    except OSError as e:
+        print("Ignore OSError from makedirs(work):")
+        print(e)
+        pass
+
+    return work
+
+def process_image(args, img_file, wdir, odir, stager,
+                  truth_file=None, stage_intermediate=True):
+    """
+    run sextractor on the uncompressed image in the work directory,
+    followed by the stages that depend on its outputs
+
+    parameters
+    ----------
+    args: namespace
+        As returned by parse_args
+    img_file: string
+        The uncompressed image, in wdir
+    wdir: string
+        The work directory
+    odir: string
+        Outputs are staged out to this directory
+    stager: StageOut
+        Used to stage out the outputs
+    truth_file: string, optional
+        The truth catalog.  Default is next to args.image
+    stage_intermediate: bool, optional
+        If False, only stage out the final products: the match catalog,
+        psf model and diagnostics, leaving the sextractor catalog, the
+        seg map and the findstars output in the work directory
+
+    returns
+    -------
+    dict with entries
+        flag: the processing flags
+        cat_file, seg_file, psf_file: the outputs in wdir
+        match_file: the match catalog in wdir
+        match: the matched catalog, or None if matching failed
+    """
+
+    flag = 0
+    output = {
+        'cat_file': None,
+        'seg_file': None,
+        'psf_file': None,
+        'match_file': None,
+        'match': None,
+    }
+
+    root = parse_file_name(img_file)
+
+    print('   root:',root)
+
+
+    try:
+
+        # extract the saturation level, this is how desdm runs sextractor
+        # we need the fwhm for class star
+        # Also need the fwhm for doing the tape bumps.
+        sat, fwhm = read_image_header(img_file)
+        print('   fwhm = ',fwhm)
+
+        cat_file, seg_file = run_sextractor(wdir, root, img_file, sat, fwhm, args.noweight)
+        output['cat_file'] = cat_file
+        output['seg_file'] = seg_file
+
+        # everything below depends only on the sextractor outputs, so
+        # independent steps can run at the same time.  Stages record
+        # their flags in this list rather than modifying flag directly
+        stage_flags = []
+
+        psf_file = os.path.join(wdir,root.replace('-image','-psfcat') + '.psf')
+        used_file = os.path.join(wdir,root+'-psfcat.used.fits')
+        reserve_file = os.path.join(wdir,root+'-reserve.fits')
+        xml_file = os.path.join(wdir,root+'-psfcat.xml')
+        diag_file = os.path.join(wdir,root.replace('-image','-psfdiag') + '.fits')
+        output['psf_file'] = psf_file
+
+        graph = StageGraph(nproc=args.nproc)
+
+        if stage_intermediate:
+            graph.add(
+                'copy_sxcat',
+                lambda res: stager.put(cat_file, odir),
+            )
+            graph.add(
+                'copy_seg',
+                lambda res: stager.put(seg_file, odir),
+            )
+        graph.add(
+            'read_sxcat',
+            lambda res: read_sxcat(cat_file),
+        )
+        graph.add(
+            'match',
+            lambda res: match2truth(
+                args, cat_file, sx=res['read_sxcat'], truth_file=truth_file,
+            ),
+            depends=['read_sxcat'],
+        )
+        graph.add(
+            'copy_match',
+            lambda res: stager.put(res['match'][0], odir),
+            depends=['match'],
+        )
+        if args.native_stars:
+            graph.add(
+                'findstars',
+                lambda res: findstars_stage(
+                    wdir, root, cat_file, stage_flags, sx=res['read_sxcat'],
+                ),
+                depends=['read_sxcat'],
+            )
+        else:
+            graph.add(
+                'findstars',
+                lambda res: findstars_stage(wdir, root, cat_file, stage_flags),
+            )
+        if stage_intermediate:
+            graph.add(
+                'copy_findstars',
+                lambda res: stager.put(res['findstars'][0], odir),
+                depends=['findstars'],
+            )
+        graph.add(
+            'sizemag',
+            lambda res: sizemag_stage(
+                res['findstars'][0], cat_file, odir, stager, args.plots,
+            ),
+            depends=['findstars'],
+        )
+
+        if args.run_psfex or args.run_piff or args.mag_cut>0:
+            graph.add(
+                'check_fwhm',
+                lambda res: check_fwhm(res['findstars'][1], fwhm, stage_flags),
+                depends=['findstars'],
+            )
+
+        if args.run_psfex:
+            graph.add(
+                'psfex',
+                lambda res: psfex_stage(
+                    wdir, root, odir, res['findstars'][1],
+                    psf_file, used_file, xml_file, stage_flags, stager,
+                ),
+                depends=['findstars'],
+            )
+
+        if args.run_piff:
+            graph.add(
+                'piff',
+                lambda res: piff_stage(
+                    wdir, root, odir, img_file, res['findstars'][1],
+                    psf_file, stage_flags, stager,
+                ),
+                depends=['findstars'],
+            )
+
+        if args.psf_diagnostics and (args.run_psfex or args.run_piff):
+            psf_stage = 'piff' if args.run_piff else 'psfex'
+            graph.add(
+                'psf_diagnostics',
+                lambda res: psf_diagnostics_stage(
+                    res['read_sxcat'], res['findstars'][0],
+                    psf_file, diag_file, args.run_piff, odir, stager,
+                ),
+                depends=['read_sxcat', 'findstars', psf_stage],
+            )
+
+        try:
+            results = graph.run()
+        finally:
+            for stage_flag in stage_flags:
+                flag |= stage_flag
+
+        output['match_file'], output['match'] = results['match']
+
+    except NoStarsException:
+        print('No stars.  Log this in the blacklist and continue.')
+        flag |= NO_STARS_FLAG
+    except Exception as e:
+        print('Caught exception: ',e)
+        traceback.print_exc()
+        print('Log this in the blacklist and continue.')
+        flag |= ERROR_FLAG
+
+    output['flag'] = flag
+    return output
+
+def main():
+    args = parse_args()
+
+    print('Processing:',args.image)
+    odir = os.path.dirname(args.image)
+
+    # read the configs from the node cache if there is one
+    run, index = files.parse_image_file(args.image)
+    if run is not None:
+        nodecache.activate(run)
+
+    if args.clear_output:
+        clear_output(odir)
+
+    try:
+        os.makedirs(odir)
+    except:
+        if not os.path.exists(odir): raise
+    print('odir = ',odir)
+
+    # reserve room for the compressed and uncompressed image and the
+    # sextractor outputs
+    dirs = None
+    if args.work is not None:
+        dirs = [get_work_dir(args.work)]
+
+    nbytes = estimate_footprint('reduce', get_image_shape_from_file(args.image))
+    scratch = Scratch(
+        'reduce',
+        nbytes=nbytes,
+        dirs=dirs,
+        keep=not args.rm_files,
+    )
+    wdir = scratch.create()
+    print('wdir = ',wdir)
+
+    # outputs are copied to odir in the background while later
+    # stages run
+    stager = StageOut()
+    succeeded = False
+
+    try:
+        fz_img_file = copy_file_to_dir(args.image, wdir)
+        img_file = funpack_file(fz_img_file)
+
+        process_image(args, img_file, wdir, odir, stager)
+        succeeded = True
+    finally:
+        # all copies must be finished before we remove the work dir.  A
+        # failed copy is only raised if it would not hide the exception
+        # that stopped the job
+        try:
+            stager.close()
+        except Exception as e:
+            print('Caught exception during stage out: ',e)
+            traceback.print_exc()
+            if succeeded:
+                raise
+        finally:
+            scratch.release()
+
+    print('done')
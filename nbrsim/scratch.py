@@ -0,0 +1,541 @@
+"""
+node-local scratch space
+
+Each stage asks for a scratch directory sized for what it will write.
+The directory is made on the first candidate file system with room for
+it, preferring tmpfs when the footprint is small enough to fit in
+memory, and the space is recorded in a ledger shared by all jobs on the
+node, so concurrent jobs do not count the same free space twice.
+
+Directories are removed when the stage finishes, at exit, or on
+SIGTERM.  Directories left by jobs that were killed outright are found
+through the ledger, since their process no longer exists, and removed
+the next time any job asks for space.
+
+The candidate directories are taken from the NBRSIM_SCRATCH_DIRS
+environment variable, a colon separated list, and default to /dev/shm,
+$TMPDIR and /tmp.  $TMPDIR is skipped when it is itself a scratch
+directory, as set by the batch jobs.
+
+The ledger is kept at a fixed path on the node, $NBRSIM_SCRATCH_LEDGER
+or by default /tmp/nbrsim-scratch-{uid}.json, so that it does not follow
+$TMPDIR into the scratch directory of a job.
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import errno
+import atexit
+import shutil
+import signal
+import socket
+import tempfile
+
+# reservations are increased by this factor
+SAFETY_FACTOR = 1.2
+
+# only use this fraction of the free space on tmpfs, which is memory
+TMPFS_FRACTION = 0.5
+
+# bytes per pixel for the image, badpix and weight planes written by galsim
+IMAGE_BYTES_PER_PIXEL = 3*4
+
+# the compressed image is usually less than half the size
+FZ_FRACTION = 0.5
+
+# total area of the MEDS cutouts relative to the image
+MEDS_AREA_FACTOR = 2.0
+
+# image, weight, seg and bmask
+MEDS_NTYPES = 4
+
+TMPFS_TYPES = ['tmpfs', 'ramfs']
+
+# node-local directory that does not depend on $TMPDIR
+NODE_TMP_DIR = '/tmp'
+
+# prefix of the scratch directories made by reserve()
+DIR_PREFIX = 'nbrsim-'
+
+# active scratch directories for this process, for cleanup on exit
+_ACTIVE = {}
+_HANDLERS_INSTALLED = False
+
+
+class Scratch(object):
+    """
+    a scratch directory with reserved space
+
+    parameters
+    ----------
+    name: string
+        Name for the directory, e.g. the stage
+    nbytes: int, optional
+        Expected size of the files written.  If not sent, no space is
+        reserved and the first usable candidate is chosen
+    dirs: list of strings, optional
+        Candidate base directories, default from get_scratch_dirs()
+    use_tmpfs: bool, optional
+        If False, skip tmpfs candidates
+    pid: int, optional
+        Process that owns the directory; when it no longer exists the
+        directory can be removed.  Default this process
+    keep: bool, optional
+        If True, do not remove the directory when it is released
+
+    example
+    -------
+    with Scratch('reduce', nbytes=2e9) as wdir:
+        ...
+    """
+    def __init__(self, name, nbytes=None, dirs=None, use_tmpfs=True,
+                 pid=None, keep=False):
+        self.name = name
+        self.nbytes = nbytes
+        self.dirs = dirs
+        self.use_tmpfs = use_tmpfs
+        self.pid = pid if pid is not None else os.getpid()
+        self.keep = keep
+        self.path = None
+
+        # only the process that made the directory removes it, not
+        # forked children
+        self._owner = os.getpid()
+
+    def __enter__(self):
+        return self.create()
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.release()
+
+    def create(self):
+        """
+        choose a base directory, reserve the space and make the directory
+
+        returns
+        -------
+        The path to the directory
+        """
+        if self.path is not None:
+            return self.path
+
+        dirs = self.dirs
+        if dirs is None:
+            dirs = get_scratch_dirs()
+
+        self.path = reserve(
+            self.name,
+            dirs,
+            nbytes=self.nbytes,
+            use_tmpfs=self.use_tmpfs,
+            pid=self.pid,
+        )
+
+        _install_handlers()
+        _ACTIVE[self.path] = self
+        return self.path
+
+    def release(self):
+        """
+        remove the directory and release the space
+        """
+        if self.path is None or os.getpid() != self._owner:
+            return
+
+        path = self.path
+        self.path = None
+        _ACTIVE.pop(path, None)
+
+        release(path, remove=not self.keep)
+
+
+def reserve(name, dirs, nbytes=None, use_tmpfs=True, pid=None):
+    """
+    make a scratch directory on the first candidate with room for it
+
+    parameters
+    ----------
+    name: string
+        Name for the directory
+    dirs: list of strings
+        Candidate base directories
+    nbytes: int, optional
+        Bytes to reserve
+    use_tmpfs: bool, optional
+        If False, skip tmpfs candidates
+    pid: int, optional
+        Owning process, default this process
+
+    returns
+    -------
+    The path to the new directory
+    """
+    if pid is None:
+        pid = os.getpid()
+
+    reason = []
+    with Ledger() as ledger:
+        ledger.prune()
+
+        for base in dirs:
+            base = os.path.abspath(os.path.expandvars(os.path.expanduser(base)))
+            if not _make_base(base):
+                reason.append('%s: not writable' % base)
+                continue
+
+            tmpfs = is_tmpfs(base)
+            if tmpfs and not use_tmpfs:
+                continue
+
+            if nbytes is not None:
+                need = int(nbytes*SAFETY_FACTOR)
+                free = get_free_bytes(base, ledger, tmpfs=tmpfs)
+                if free < need:
+                    reason.append(
+                        '%s: need %s, %s free' % (base, _fmt(need), _fmt(free))
+                    )
+                    continue
+            else:
+                need = 0
+
+            path = tempfile.mkdtemp(prefix='%s%s-' % (DIR_PREFIX, name), dir=base)
+            ledger.add(path, need, pid, name)
+
+            print("scratch dir: %s (%s reserved%s)" % (
+                path, _fmt(need), ', tmpfs' if tmpfs else '',
+            ))
+            return path
+
+    raise RuntimeError(
+        "no scratch space for %s: %s" % (name, '; '.join(reason))
+    )
+
+
+def release(path, remove=True):
+    """
+    remove a scratch directory and its reservation
+    """
+    if remove and os.path.exists(path):
+        print("removing scratch dir:",path)
+        shutil.rmtree(path, ignore_errors=True)
+
+    with Ledger() as ledger:
+        ledger.remove(path)
+
+
+def clean():
+    """
+    remove scratch directories whose owning process no longer exists
+
+    returns
+    -------
+    list of removed directories
+    """
+    with Ledger() as ledger:
+        return ledger.prune()
+
+
+def get_scratch_dirs(use_tmpfs=True):
+    """
+    get the candidate base directories for scratch space
+    """
+    dirs = os.environ.get('NBRSIM_SCRATCH_DIRS', None)
+    if dirs is not None:
+        dirs = [d for d in dirs.split(':') if d != '']
+    else:
+        dirs = []
+        if use_tmpfs and os.path.isdir('/dev/shm'):
+            dirs.append('/dev/shm')
+        # the batch jobs point TMPDIR at their own scratch directory,
+        # which must not hold the scratch directories of the stages
+        tmpdir = os.environ.get('TMPDIR', None)
+        if tmpdir is not None and not _is_scratch_dir(tmpdir):
+            dirs.append(tmpdir)
+        dirs.append(NODE_TMP_DIR)
+
+    unique = []
+    for d in dirs:
+        if d not in unique:
+            unique.append(d)
+    return unique
+
+
+def get_free_bytes(base, ledger, tmpfs=False):
+    """
+    free bytes on the file system holding base, less the space reserved
+    by other jobs and not yet written
+    """
+    st = os.statvfs(base)
+    free = st.f_bavail*st.f_frsize
+    if tmpfs:
+        free = int(free*TMPFS_FRACTION)
+
+    return free - ledger.get_outstanding(os.stat(base).st_dev)
+
+
+def estimate_footprint(stage, shape):
+    """
+    estimate the bytes written in scratch by a stage
+
+    parameters
+    ----------
+    stage: string
+        'galsim', 'reduce', 'meds' or 'pipeline'
+    shape: (nrows, ncols)
+        The image shape, or None if not known
+
+    returns
+    -------
+    bytes, or None if the shape is not known
+    """
+    if shape is None:
+        return None
+
+    npix = int(shape[0])*int(shape[1])
+    image = npix*IMAGE_BYTES_PER_PIXEL
+    fz = int(image*FZ_FRACTION)
+
+    # a 4 byte seg map, with the catalogs and psf a small fraction
+    reduce = fz + image + int(npix*4*1.1)
+
+    # memory-mapped planes plus the uncompressed file
+    meds = npix*4*MEDS_NTYPES + int(npix*4*MEDS_NTYPES*MEDS_AREA_FACTOR)
+
+    if stage == 'galsim':
+        return image + fz
+    elif stage == 'reduce':
+        return reduce
+    elif stage == 'meds':
+        return meds
+    elif stage == 'pipeline':
+        return reduce
+    else:
+        raise ValueError("bad stage: '%s'" % stage)
+
+
+def get_image_shape(run):
+    """
+    get the (nrows, ncols) of the images from the galsim config, or None
+    if they are not set there
+    """
+    from . import files
+    conf = files.read_config(run)
+
+    image = conf.get('image', {})
+    try:
+        return int(image['ysize']), int(image['xsize'])
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def get_image_shape_from_file(fname, ext=None):
+    """
+    get the (nrows, ncols) of an image, compressed or not, from its header
+    """
+    import fitsio
+
+    if ext is None:
+        ext = 1 if fname.endswith('.fz') else 0
+
+    h = fitsio.read_header(fname, ext=ext)
+    if 'ZNAXIS1' in h:
+        return h['ZNAXIS2'], h['ZNAXIS1']
+    return h['NAXIS2'], h['NAXIS1']
+
+
+def get_ledger_file():
+    """
+    the ledger is shared by all jobs of this user on the node, so its
+    path must not depend on $TMPDIR
+    """
+    fname = os.environ.get('NBRSIM_SCRATCH_LEDGER', None)
+    if fname is not None:
+        return fname
+
+    return os.path.join(
+        NODE_TMP_DIR,
+        'nbrsim-scratch-%d.json' % os.getuid(),
+    )
+
+
+class Ledger(object):
+    """
+    the reservations on this node, read and written under a lock
+    """
+    def __init__(self):
+        self.fname = get_ledger_file()
+        self.host = socket.gethostname()
+
+    def __enter__(self):
+        import fcntl
+
+        self.lock = open(self.fname + '.lock', 'a')
+        fcntl.flock(self.lock.fileno(), fcntl.LOCK_EX)
+
+        self.entries = {}
+        if os.path.exists(self.fname):
+            try:
+                with open(self.fname) as fobj:
+                    self.entries = json.load(fobj)
+            except ValueError:
+                print("ignoring corrupt scratch ledger:",self.fname)
+
+        self._modified = False
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        import fcntl
+        try:
+            if self._modified:
+                self._write()
+        finally:
+            fcntl.flock(self.lock.fileno(), fcntl.LOCK_UN)
+            self.lock.close()
+
+    def add(self, path, nbytes, pid, name):
+        self.entries[path] = {
+            'nbytes': nbytes,
+            'dev': os.stat(path).st_dev,
+            'pid': pid,
+            'host': self.host,
+            'name': name,
+            'time': time.time(),
+        }
+        self._modified = True
+
+    def remove(self, path):
+        if path in self.entries:
+            del self.entries[path]
+            self._modified = True
+
+    def prune(self):
+        """
+        remove directories owned by processes that no longer exist
+        """
+        removed = []
+        for path, entry in list(self.entries.items()):
+            if entry['host'] != self.host:
+                continue
+
+            if not os.path.exists(path) or not _pid_exists(entry['pid']):
+                if os.path.exists(path):
+                    print("removing stale scratch dir:",path)
+                    shutil.rmtree(path, ignore_errors=True)
+                    removed.append(path)
+                self.remove(path)
+
+        return removed
+
+    def get_outstanding(self, dev):
+        """
+        bytes reserved on the device but not yet written
+        """
+        total = 0
+        for path, entry in self.entries.items():
+            if entry['dev'] == dev:
+                total += max(entry['nbytes'] - get_disk_usage(path), 0)
+        return total
+
+    def _write(self):
+        tmpname = '%s.tmp%d' % (self.fname, os.getpid())
+        with open(tmpname, 'w') as fobj:
+            json.dump(self.entries, fobj)
+        os.rename(tmpname, self.fname)
+
+
+def get_disk_usage(path):
+    """
+    bytes used by the files under path
+    """
+    total = 0
+    for root, dirs, fnames in os.walk(path):
+        for fname in fnames:
+            try:
+                st = os.lstat(os.path.join(root, fname))
+            except OSError:
+                continue
+            total += st.st_blocks*512
+    return total
+
+
+def is_tmpfs(path):
+    """
+    check if the path is on a memory file system
+    """
+    path = os.path.realpath(path)
+
+    best, fstype = '', None
+    try:
+        with open('/proc/mounts') as fobj:
+            for line in fobj:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mnt = fields[1]
+                if path == mnt or path.startswith(mnt.rstrip('/') + '/'):
+                    if len(mnt) > len(best):
+                        best, fstype = mnt, fields[2]
+    except (IOError, OSError):
+        return False
+
+    return fstype in TMPFS_TYPES
+
+
+def _is_scratch_dir(path):
+    return os.path.basename(os.path.normpath(path)).startswith(DIR_PREFIX)
+
+
+def _make_base(base):
+    try:
+        if not os.path.exists(base):
+            os.makedirs(base)
+    except OSError:
+        pass
+    return os.path.isdir(base) and os.access(base, os.W_OK)
+
+
+def _pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as err:
+        return err.errno == errno.EPERM
+    return True
+
+
+def _fmt(nbytes):
+    return '%.2fG' % (nbytes/1024.0**3)
+
+
+def _release_all():
+    for scratch in list(_ACTIVE.values()):
+        try:
+            scratch.release()
+        except Exception as err:
+            print("failed to release scratch dir:",err)
+
+
+def _handle_sigterm(signum, frame):
+    _release_all()
+    sys.exit(128 + signum)
+
+
+def _install_handlers():
+    """
+    remove scratch directories at exit and on SIGTERM, as sent by the
+    batch system when a job is killed
+    """
+    global _HANDLERS_INSTALLED
+    if _HANDLERS_INSTALLED:
+        return
+
+    atexit.register(_release_all)
+    try:
+        if signal.getsignal(signal.SIGTERM) in (signal.SIG_DFL, None):
+            signal.signal(signal.SIGTERM, _handle_sigterm)
+    except ValueError:
+        # not the main thread
+        pass
+
+    _HANDLERS_INSTALLED = True
@@ -6,6 +6,25 @@ except:
 import os
 
 from . import files
+from . import nodecache
+from . import planner
+from . import verify
+
+# independent reduce stages run concurrently using this many cores
+REDUCE_NPROC=2
+
+# products made by each stage.  With --missing, a stage is rerun if the
+# first product does not exist or nbrsim-verify found any of them bad
+STAGE_PRODUCTS = {
+    'galsim': ['image'],
+    'reduce': ['psfex', 'seg', 'sxcat', 'match'],
+    'meds': ['meds'],
+    'pipeline': ['meds', 'image', 'match', 'psfex'],
+}
+
+# lsf requests when there is no plan for the run
+DEFAULT_WALLTIME='12:00'
+DEFAULT_SCRATCH_GB=2
 
 class ScriptWriter(dict):
     """
@@ -20,16 +39,32 @@ class ScriptWriter(dict):
     extra_commands: string
         Extra shell commands to run, e.g. for setting up
         your environment
+    galsim_nper: int
+        Number of images to render in each galsim job.  Galsim
+        startup and config processing is paid once per job, so use more
+        than one for runs with small images.
+    fused: bool
+        If True, write a single job per index that runs all stages with
+        nbrsim-pipeline, instead of separate galsim, reduce and meds jobs
     """
 
-    def __init__(self, run, system, missing=False, extra_commands=''):
+    def __init__(self, run, system, missing=False, extra_commands='',
+                 galsim_nper=1, fused=False):
         self['run'] = run
         self['extra_commands'] = extra_commands
         self['system'] = system
+        self['galsim_nper'] = galsim_nper
+        self['fused'] = fused
         
         self.missing=missing
 
+        # results from nbrsim-verify, used to find bad products
+        self.verified = None
+        if missing:
+            self.verified = verify.read_results(run)
+
         self._load_config()
+        self._load_plan()
 
         self['njobs']=self.conf['output']['nfiles']
 
@@ -37,8 +72,11 @@ class ScriptWriter(dict):
 
     def write_scripts(self):
         """
-        write the basic bash scripts and queue submission scripts
+        write the basic bash scripts and queue submission scripts, and
+        the manifest for the node cache
         """
+        nodecache.write_manifest(self['run'])
+
         for i in xrange(self['njobs']):
             if self['system'] == 'wq':
                 self._write_wq(i)
@@ -52,40 +90,89 @@ class ScriptWriter(dict):
             else:
                 raise RuntimeError("bad system: '%s'" % self['system'])
 
-            self._write_galsim_script(i)
+            if self['fused']:
+                self._write_pipeline_script(i)
+                continue
+
+            if self._is_galsim_job(i):
+                self._write_galsim_script(i)
             self._write_reduce_script(i)
             self._write_meds_script(i)
 
-    def _write_galsim_script(self, index):
+    def _write_pipeline_script(self, index):
         """
-        write the basic bash script
+        write the basic bash script for the fused pipeline
         """
-        self['jobnum'] = index + 1
-        # temporary
 
+        self['index'] = index
+        self['reduce_nproc'] = REDUCE_NPROC
+        text=_pipeline_script_template % self
 
-        self['output_dir'] = files.get_output_dir(
-            self['run'],
-            index,
-        )
+        script_fname=files.get_pipeline_script_file(self['run'], index)
+        print("writing:",script_fname)
+        files.write_file(script_fname, text)
+
+    def _write_galsim_script(self, index):
+        """
+        write the basic bash script, rendering the images for the group
+        of indices starting with this one
+        """
+        indices = self._get_galsim_indices(index)
+        self['start'] = indices[0]
+        self['end'] = indices[-1]+1
 
-        self['image'] = files.get_image_file(
-            self['run'],
-            index,
-        )
-        self['image_nocompress'] = os.path.basename(
-            files.get_image_file(
-                self['run'],
-                index,
-                ext='fits',
-            )
-        )
         text=_galsim_script_template % self
 
         script_fname=files.get_galsim_script_file(self['run'], index)
         print("writing:",script_fname)
-        with open(script_fname, 'w') as fobj:
-            fobj.write(text)
+        files.write_file(script_fname, text)
+
+    def _is_galsim_job(self, index):
+        """
+        galsim jobs are written for the first index in each group
+        """
+        return index % self['galsim_nper'] == 0
+
+    def _get_galsim_indices(self, index):
+        """
+        the indices rendered by the galsim job starting at this index
+        """
+        end = min(index + self['galsim_nper'], self['njobs'])
+        return list(xrange(index, end))
+
+    def _galsim_done(self, index):
+        """
+        check if all images for the galsim job exist
+        """
+        for i in self._get_galsim_indices(index):
+            if not self._stage_done('galsim', i):
+                return False
+        return True
+
+    def _stage_done(self, stage, index):
+        """
+        check if the products of the stage exist, and none was found bad
+        by nbrsim-verify since it was written
+        """
+        products = STAGE_PRODUCTS[stage]
+
+        fname = verify.get_product_file(self['run'], index, products[0])
+        if not os.path.exists(fname):
+            return False
+
+        for product in products:
+            status = verify.get_status(self.verified, index, product)
+            if status != verify.BAD:
+                continue
+
+            fname = verify.get_product_file(self['run'], index, product)
+            if not os.path.exists(fname):
+                return False
+            checked = verify.get_check_time(self.verified, index, product)
+            if os.path.getmtime(fname) <= checked:
+                return False
+
+        return True
 
     def _write_reduce_script(self, index):
         """
@@ -94,13 +181,14 @@ class ScriptWriter(dict):
         self['jobnum'] = index + 1
         # temporary
 
+        self['index'] = index
         self['image'] = files.get_image_file(self['run'], index)
+        self['reduce_nproc'] = REDUCE_NPROC
         text=_reduce_script_template % self
 
         script_fname=files.get_reduce_script_file(self['run'], index)
         print("writing:",script_fname)
-        with open(script_fname, 'w') as fobj:
-            fobj.write(text)
+        files.write_file(script_fname, text)
 
     def _write_meds_script(self, index):
         """
@@ -112,17 +200,26 @@ class ScriptWriter(dict):
 
         script_fname=files.get_meds_script_file(self['run'], index)
         print("writing:",script_fname)
-        with open(script_fname, 'w') as fobj:
-            fobj.write(text)
+        files.write_file(script_fname, text)
 
 
     def _write_wq(self, index):
-        self._write_galsim_wq(index)
+        if self['fused']:
+            self._write_pipeline_wq(index)
+            return
+
+        if self._is_galsim_job(index):
+            self._write_galsim_wq(index)
         self._write_reduce_wq(index)
         self._write_meds_wq(index)
 
     def _write_lsf(self, index):
-        self._write_galsim_lsf(index)
+        if self['fused']:
+            self._write_pipeline_lsf(index)
+            return
+
+        if self._is_galsim_job(index):
+            self._write_galsim_lsf(index)
         self._write_reduce_lsf(index)
         self._write_meds_lsf(index)
 
@@ -141,8 +238,7 @@ class ScriptWriter(dict):
         if self.missing:
             wq_fname = wq_fname.replace('.yaml','-missing.yaml')
 
-            imfile = files.get_image_file(self['run'], index)
-            if os.path.exists(imfile):
+            if self._galsim_done(index):
                 if os.path.exists(wq_fname):
                     os.remove(wq_fname)
                 return
@@ -151,8 +247,10 @@ class ScriptWriter(dict):
         job_name = job_name.replace('.yaml','')
 
         self['job_name'] = job_name
-        self['logfile'] = files.get_galsim_log_file(self['run'], index)
-        self['script']=files.get_galsim_script_file(self['run'], index)
+        self._set_job_files(
+            files.get_galsim_script_file(self['run'], index),
+            files.get_galsim_log_file(self['run'], index),
+        )
         text = _wq_template  % self
 
         print("writing:",wq_fname)
@@ -174,8 +272,7 @@ class ScriptWriter(dict):
         if self.missing:
             lsf_fname = lsf_fname.replace('.lsf','-missing.lsf')
 
-            imfile = files.get_image_file(self['run'], index)
-            if os.path.exists(imfile):
+            if self._galsim_done(index):
                 if os.path.exists(lsf_fname):
                     os.remove(lsf_fname)
                 return
@@ -184,10 +281,13 @@ class ScriptWriter(dict):
         job_name = job_name.replace('.lsf','')
 
         self['job_name'] = job_name
-        self['logfile'] = files.get_galsim_log_file(self['run'], index)
-        self['script']=files.get_galsim_script_file(self['run'], index)
+        self._set_job_files(
+            files.get_galsim_script_file(self['run'], index),
+            files.get_galsim_log_file(self['run'], index),
+        )
         self['ncores']=2
         self['extra_requirements'] = '#BSUB -R "span[hosts=1]"'
+        self._set_resources('galsim', nper=len(self._get_galsim_indices(index)))
 
         text = _lsf_template  % self
 
@@ -211,8 +311,7 @@ class ScriptWriter(dict):
         if self.missing:
             wq_fname = wq_fname.replace('.yaml','-missing.yaml')
 
-            psfex_file = files.get_psfex_file(self['run'], index)
-            if os.path.exists(psfex_file):
+            if self._stage_done('reduce', index):
                 if os.path.exists(wq_fname):
                     os.remove(wq_fname)
                 return
@@ -221,8 +320,10 @@ class ScriptWriter(dict):
         job_name = job_name.replace('.yaml','')
 
         self['job_name'] = job_name
-        self['logfile'] = files.get_reduce_log_file(self['run'], index)
-        self['script']=files.get_reduce_script_file(self['run'], index)
+        self._set_job_files(
+            files.get_reduce_script_file(self['run'], index),
+            files.get_reduce_log_file(self['run'], index),
+        )
         text = _wq_template  % self
 
         print("writing:",wq_fname)
@@ -243,10 +344,7 @@ class ScriptWriter(dict):
         if self.missing:
             lsf_fname = lsf_fname.replace('.lsf','-missing.lsf')
 
-            psfex_file = files.get_psfex_file(self['run'], index)
-            #seg_file = files.get_seg_file(self['run'], index)
-
-            if os.path.exists(psfex_file):
+            if self._stage_done('reduce', index):
                 if os.path.exists(lsf_fname):
                     os.remove(lsf_fname)
                 return
@@ -255,11 +353,13 @@ class ScriptWriter(dict):
         job_name = job_name.replace('.lsf','')
 
         self['job_name'] = job_name
-        self['logfile'] = files.get_reduce_log_file(self['run'], index)
-        self['script']=files.get_reduce_script_file(self['run'], index)
-        self['ncores']=1
-        self['extra_requirements'] = ''
-
+        self._set_job_files(
+            files.get_reduce_script_file(self['run'], index),
+            files.get_reduce_log_file(self['run'], index),
+        )
+        self['ncores']=REDUCE_NPROC
+        self['extra_requirements'] = '#BSUB -R "span[hosts=1]"'
+        self._set_resources('reduce')
 
         text = _lsf_template  % self
 
@@ -282,8 +382,7 @@ class ScriptWriter(dict):
         if self.missing:
             wq_fname = wq_fname.replace('.yaml','-missing.yaml')
 
-            meds_file = files.get_meds_file(self['run'], index)
-            if os.path.exists(meds_file):
+            if self._stage_done('meds', index):
                 if os.path.exists(wq_fname):
                     os.remove(wq_fname)
                 return
@@ -292,8 +391,10 @@ class ScriptWriter(dict):
         job_name = job_name.replace('.yaml','')
 
         self['job_name'] = job_name
-        self['logfile']  = files.get_meds_log_file(self['run'], index)
-        self['script']   =files.get_meds_script_file(self['run'], index)
+        self._set_job_files(
+            files.get_meds_script_file(self['run'], index),
+            files.get_meds_log_file(self['run'], index),
+        )
         text = _wq_template  % self
 
         print("writing:",wq_fname)
@@ -315,8 +416,7 @@ class ScriptWriter(dict):
         if self.missing:
             lsf_fname = lsf_fname.replace('.lsf','-missing.lsf')
 
-            meds_file = files.get_meds_file(self['run'], index)
-            if os.path.exists(meds_file):
+            if self._stage_done('meds', index):
                 if os.path.exists(lsf_fname):
                     os.remove(lsf_fname)
                 return
@@ -325,10 +425,13 @@ class ScriptWriter(dict):
         job_name = job_name.replace('.lsf','')
 
         self['job_name'] = job_name
-        self['logfile']  = files.get_meds_log_file(self['run'], index)
-        self['script']   =files.get_meds_script_file(self['run'], index)
+        self._set_job_files(
+            files.get_meds_script_file(self['run'], index),
+            files.get_meds_log_file(self['run'], index),
+        )
         self['ncores']=1
         self['extra_requirements'] = ''
+        self._set_resources('meds')
 
         text = _lsf_template  % self
 
@@ -337,6 +440,132 @@ class ScriptWriter(dict):
             fobj.write(text)
 
 
+    def _write_pipeline_wq(self, index):
+        """
+        write the wq submission script
+        """
+
+        wq_dir = files.get_wq_dir(self['run'])
+        if not os.path.exists(wq_dir):
+            os.makedirs(wq_dir)
+
+        wq_fname=files.get_pipeline_wq_file(self['run'], index)
+
+        if self.missing:
+            wq_fname = wq_fname.replace('.yaml','-missing.yaml')
+
+            if self._stage_done('pipeline', index):
+                if os.path.exists(wq_fname):
+                    os.remove(wq_fname)
+                return
+
+        job_name = os.path.basename(wq_fname)
+        job_name = job_name.replace('.yaml','')
+
+        self['job_name'] = job_name
+        self._set_job_files(
+            files.get_pipeline_script_file(self['run'], index),
+            files.get_pipeline_log_file(self['run'], index),
+        )
+        text = _wq_template  % self
+
+        print("writing:",wq_fname)
+        with open(wq_fname,'w') as fobj:
+            fobj.write(text)
+
+
+    def _write_pipeline_lsf(self, index):
+        """
+        write the lsf submission script
+        """
+
+        lsf_dir = files.get_lsf_dir(self['run'])
+        if not os.path.exists(lsf_dir):
+            os.makedirs(lsf_dir)
+
+        lsf_fname=files.get_pipeline_lsf_file(self['run'], index)
+
+        if self.missing:
+            lsf_fname = lsf_fname.replace('.lsf','-missing.lsf')
+
+            if self._stage_done('pipeline', index):
+                if os.path.exists(lsf_fname):
+                    os.remove(lsf_fname)
+                return
+
+        job_name = os.path.basename(lsf_fname)
+        job_name = job_name.replace('.lsf','')
+
+        self['job_name'] = job_name
+        self._set_job_files(
+            files.get_pipeline_script_file(self['run'], index),
+            files.get_pipeline_log_file(self['run'], index),
+        )
+        self['ncores']=REDUCE_NPROC
+        self['extra_requirements'] = '#BSUB -R "span[hosts=1]"'
+        self._set_resources('pipeline')
+
+        text = _lsf_template  % self
+
+        print("writing:",lsf_fname)
+        with open(lsf_fname,'w') as fobj:
+            fobj.write(text)
+
+
+    def _set_job_files(self, script, logfile):
+        """
+        set the script run by the job and the log file it writes.  For
+        packed runs the job extracts the script from the pack into its
+        scratch directory, and packs the log when done
+        """
+        self['logfile'] = logfile
+
+        if self['packed']:
+            script_name = os.path.basename(script)
+            self['get_script'] = 'nbrsim-pack extract %s %s --dir "$tmpdir"' % (
+                self['run'], script_name,
+            )
+            self['script'] = '"$tmpdir/%s"' % script_name
+            self['store_log'] = 'nbrsim-pack add %s "$tmp_logfile"' % self['run']
+        else:
+            self['get_script'] = ''
+            self['script'] = script
+            self['store_log'] = 'mv -vf "$tmp_logfile" "$logfile"'
+
+    def _set_resources(self, stage, nper=1):
+        """
+        set the time, scratch and memory requests for the stage from the
+        plan made by nbrsim-plan, or the defaults if there is none
+        """
+        self['walltime'] = DEFAULT_WALLTIME
+        self['scratch_gb'] = DEFAULT_SCRATCH_GB
+        self['mem_requirements'] = ''
+
+        if self.plan is None:
+            return
+
+        req = planner.get_requests(self.plan, stage, nper=nper)
+
+        if req['wall_seconds'] is not None:
+            minutes = int(req['wall_seconds']/60.0 + 0.999)
+            self['walltime'] = '%d:%02d' % (minutes // 60, minutes % 60)
+
+        if req['scratch_bytes'] is not None:
+            self['scratch_gb'] = int(req['scratch_bytes']/1024.0**3 + 0.999)
+
+        if req['mem_bytes'] is not None:
+            # the memory request is per slot, and the job has ncores slots
+            mem_mb = int(req['mem_bytes']/self['ncores']/1024.0**2 + 0.999)
+            self['mem_requirements'] = '#BSUB -R "rusage[mem=%d]"' % mem_mb
+
+    def _load_plan(self):
+        """
+        load the resource estimates for the run, if nbrsim-plan was run
+        """
+        self.plan = planner.read_plan(self['run'])
+        if self.plan is not None:
+            print("using plan:",files.get_plan_file(self['run']))
+
     def _makedirs(self):
         """
         make all the directories needed
@@ -369,8 +598,18 @@ class ScriptWriter(dict):
         """
         self['config_file']=files.get_config_file(self['run'])
 
+        # make sure the run dir exists so the pre-parsed config
+        # is saved there for the jobs
+        rundir=files.get_rundir(self['run'])
+        if not os.path.exists(rundir):
+            print("making dir:",rundir)
+            os.makedirs(rundir)
+
         self.conf = files.read_config(self['run'])
 
+        # small files go in the pack, see nbrsim.pack
+        self['packed'] = files.is_packed(self['run'])
+
 
 # image creation
 #
@@ -379,48 +618,12 @@ _galsim_script_template = r"""#!/bin/bash
 
 export OMP_NUM_THREADS=1
 
-# final output directory
-odir="%(output_dir)s"
-
-# final image location
-image="%(image)s"
-
-# the uncompressed file written by galsim
-image_nocompress="%(image_nocompress)s"
-
-# the galsim configuration file
-config="%(config_file)s"
-
-# this identifies which file galsim is writing
-njobs=%(njobs)d
-jobnum=%(jobnum)d
-
-# on SLAC worker nodes, this will be something like
-# /scratch/esheldon/${LSB_JOBID}
-# when running from the .lsf file, this directory
-# gets cleaned up
-
-pushd "$TMPDIR"
-
-# over-ride to use local path. Note over-ride of
-# config variables must come after the config
-# file argument
-galsim                                   \
-    -n $njobs                            \
-    -j $jobnum                           \
-    "$config"                            \
-    output.dir="./"                      \
-    output.file_name="$image_nocompress"
-
-fpack -qz 4.0 -t 10240,1 "$image_nocompress"
-
-bname=$(basename $image)
-mv -fv "$bname" "$odir/"
-mv -fv *truth.fits "$odir/"
-
-rm -v "$image_nocompress"
-
-popd
+# render indices %(start)d:%(end)d (end not included) in one process.  Images
+# are written to a scratch directory sized for them, compressed, and staged
+# out to their output directories along with the truth catalogs.  Copies are
+# verified and renamed into place, so a failed copy never leaves a truncated
+# file in the output directory
+nbrsim-galsim %(run)s --indices %(start)d:%(end)d
 """
 
 
@@ -431,7 +634,10 @@ popd
 _reduce_script_template = """#!/bin/bash
 # set up environment before running this script
 
-nbrsim-reduce %(image)s
+nbrsim-reduce --nproc %(reduce_nproc)d %(image)s
+
+# add the match catalog to the run-level catalog
+nbrsim-make-catalog %(run)s --indices %(index)d
 """
 
 
@@ -446,6 +652,25 @@ nbrsim-make-meds %(run)s %(index)d
 """
 
 
+#
+# all stages for an index in one job
+#
+
+_pipeline_script_template = """#!/bin/bash
+# set up environment before running this script
+
+export OMP_NUM_THREADS=1
+
+# simulate, detect, match and make the MEDS file.  Intermediate files
+# stay in node-local scratch; only the image, truth, match catalog, psf
+# model and MEDS file are copied to the output directory
+nbrsim-pipeline %(run)s %(index)d --reduce_args "--nproc %(reduce_nproc)d"
+
+# add the match catalog to the run-level catalog
+nbrsim-make-catalog %(run)s --indices %(index)d
+"""
+
+
 #
 # templates for job submission files
 #
@@ -454,14 +679,21 @@ _wq_template = """#!/bin/bash
 command: |
     %(extra_commands)s
 
-    export tmpdir=$TMPDIR
+    # the stages make their own scratch directories; this one holds the log
+    export tmpdir=$(nbrsim-scratch create %(job_name)s --pid $$ --no_tmpfs)
+    if [ -z "$tmpdir" ]; then
+        echo "could not make scratch directory"
+        exit 1
+    fi
+    trap 'cd /; nbrsim-scratch release "$tmpdir"' EXIT
 
     logfile="%(logfile)s"
     tmp_logfile="$(basename $logfile)"
     tmp_logfile="$tmpdir/$tmp_logfile"
+    %(get_script)s
     /usr/bin/time bash %(script)s &> "$tmp_logfile"
 
-    mv -vf "$tmp_logfile" "$logfile"
+    %(store_log)s
 
 job_name: "%(job_name)s"
 """
@@ -470,29 +702,36 @@ _lsf_template = """#!/bin/bash
 #BSUB -J %(job_name)s
 #BSUB -n %(ncores)d
 #BSUB -oo ./%(job_name)s.oe
-#BSUB -W 12:00
-#BSUB -R "linux64 && rhel60 && scratch > 2"
+#BSUB -W %(walltime)s
+#BSUB -R "linux64 && rhel60 && scratch > %(scratch_gb)d"
+%(mem_requirements)s
 %(extra_requirements)s
 
 echo "working on host: $(hostname)"
 uptime
 
-export tmpdir="/scratch/esheldon/${LSB_JOBID}"
+# the stages make their own scratch directories, choosing among
+# $NBRSIM_SCRATCH_DIRS by space; this one holds the log.  It is removed
+# on exit, and by the next job on the node if this one is killed
+export tmpdir=$(nbrsim-scratch create %(job_name)s --pid $$ --no_tmpfs)
+if [ -z "$tmpdir" ]; then
+    echo "could not make scratch directory"
+    exit 1
+fi
+trap 'cd /; nbrsim-scratch release "$tmpdir"' EXIT
 export TMPDIR="$tmpdir"
 
-mkdir -p ${tmpdir}
 echo "cd $tmpdir"
 cd $tmpdir
 
 logfile="%(logfile)s"
 tmp_logfile="$(basename $logfile)"
 tmp_logfile="$tmpdir/$tmp_logfile"
+%(get_script)s
 
 /usr/bin/time bash %(script)s &> "$tmp_logfile"
 
-mv -vf "$tmp_logfile" "$logfile"
-
-rm -r $tmpdir
+%(store_log)s
 """
 
 
@@ -0,0 +1,274 @@
+"""
+verified stage-out of files to the shared file system
+
+Files are copied to a temporary name in the destination directory,
+verified against the size and checksum of the source, and then renamed
+atomically, so a partially copied file never appears under its final
+name.
+"""
+from __future__ import print_function
+import os
+import shutil
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# files smaller than this are grouped into batches
+SMALL_FILE_SIZE = 1024*1024
+
+# a batch of small files is submitted when it reaches this many bytes
+# or this many files
+BATCH_SIZE = 16*1024*1024
+BATCH_NFILES = 20
+
+# a partial batch is submitted this many seconds after its first file was
+# added, so small files are copied in the background even when there are
+# too few to fill a batch
+BATCH_DELAY = 2.0
+
+BUFSIZE = 4*1024*1024
+
+
+class StageOut(object):
+    """
+    copy files to output directories in the background
+
+    parameters
+    ----------
+    nthreads: int
+        Number of copies to run at once
+    checksum: bool
+        If True, verify the md5 sum of the copied file as well as the size
+    batch_delay: float
+        Submit a partial batch of small files this many seconds after its
+        first file was added
+
+    example
+    -------
+    with StageOut() as stager:
+        stager.put(cat_file, odir)
+        ... do more work ...
+        stager.put(psf_file, odir, remove=True)
+
+    Exiting the context waits for all copies to finish and raises the
+    first error encountered.
+    """
+    def __init__(self, nthreads=2, checksum=True, batch_delay=BATCH_DELAY):
+        self.checksum = checksum
+        self.batch_delay = batch_delay
+        self._timer = None
+        self._closed = False
+        self._pool = ThreadPoolExecutor(max_workers=nthreads)
+        self._futures = []
+        self._batch = []
+        self._batch_size = 0
+        self._lock = threading.Lock()
+
+    def put(self, fname, odir, remove=False):
+        """
+        schedule a copy of the file into the output directory
+
+        parameters
+        ----------
+        fname: string
+            The file to copy
+        odir: string
+            The destination directory
+        remove: bool
+            If True remove the source file after a successful copy
+
+        returns
+        -------
+        The final path of the output file
+        """
+        oname = os.path.join(odir, os.path.basename(fname))
+        size = os.path.getsize(fname)
+
+        with self._lock:
+            if size < SMALL_FILE_SIZE:
+                self._batch.append( (fname, odir, remove) )
+                self._batch_size += size
+                if (self._batch_size >= BATCH_SIZE
+                        or len(self._batch) >= BATCH_NFILES):
+                    self._submit_batch()
+                elif self._timer is None:
+                    self._start_timer()
+            else:
+                self._submit( [(fname, odir, remove)] )
+
+        return oname
+
+    def flush(self):
+        """
+        submit any pending batch of small files
+        """
+        with self._lock:
+            if len(self._batch) > 0 and not self._closed:
+                self._submit_batch()
+
+    def wait(self):
+        """
+        wait for all copies to finish, raising the first error
+        encountered
+        """
+        self.flush()
+
+        with self._lock:
+            futures = self._futures
+            self._futures = []
+
+        first_error = None
+        for future in futures:
+            try:
+                future.result()
+            except Exception as err:
+                print("stage out failed: %s" % err)
+                if first_error is None:
+                    first_error = err
+
+        if first_error is not None:
+            raise first_error
+
+    def close(self):
+        """
+        wait for copies and shut down the thread pool
+        """
+        try:
+            self.wait()
+        finally:
+            with self._lock:
+                self._closed = True
+                self._cancel_timer()
+            self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+    def _submit_batch(self):
+        self._cancel_timer()
+        self._submit(self._batch)
+        self._batch = []
+        self._batch_size = 0
+
+    def _start_timer(self):
+        self._timer = threading.Timer(self.batch_delay, self._on_timer)
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _on_timer(self):
+        with self._lock:
+            self._timer = None
+            if len(self._batch) > 0 and not self._closed:
+                self._submit_batch()
+
+    def _submit(self, batch):
+        future = self._pool.submit(self._copy_batch, batch)
+        self._futures.append(future)
+
+    def _copy_batch(self, batch):
+        for fname, odir, remove in batch:
+            stage_out_file(
+                fname,
+                odir,
+                remove=remove,
+                checksum=self.checksum,
+            )
+
+
+def stage_out_file(fname, odir, remove=False, checksum=True):
+    """
+    copy a file into the output directory, verifying the copy before
+    renaming it to the final name
+
+    parameters
+    ----------
+    fname: string
+        The file to copy
+    odir: string
+        The destination directory
+    remove: bool
+        If True remove the source file after a successful copy
+    checksum: bool
+        If True, verify the md5 sum of the copied file as well as the size
+
+    returns
+    -------
+    The final path of the output file
+    """
+
+    bname = os.path.basename(fname)
+    oname = os.path.join(odir, bname)
+    tmpname = os.path.join(odir, '.%s.tmp%d' % (bname, os.getpid()))
+
+    print("copying %s -> %s" % (fname, oname))
+    try:
+        size, digest = _copy_with_digest(fname, tmpname)
+
+        osize = os.path.getsize(tmpname)
+        if osize != size:
+            raise IOError("size mismatch copying %s: "
+                          "%d != %d" % (fname, osize, size))
+
+        if checksum:
+            odigest = get_file_digest(tmpname)
+            if odigest != digest:
+                raise IOError("checksum mismatch copying %s" % fname)
+
+        shutil.copymode(fname, tmpname)
+        os.rename(tmpname, oname)
+
+    except:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+    if remove:
+        os.remove(fname)
+
+    return oname
+
+
+def get_file_digest(fname):
+    """
+    get the md5 hex digest of the file contents
+    """
+    md5 = hashlib.md5()
+    with open(fname, 'rb') as fobj:
+        while True:
+            data = fobj.read(BUFSIZE)
+            if not data:
+                break
+            md5.update(data)
+
+    return md5.hexdigest()
+
+
+def _copy_with_digest(fname, oname):
+    """
+    copy the file, returning the number of bytes and md5 hex digest of the
+    source
+    """
+    md5 = hashlib.md5()
+    size = 0
+    with open(fname, 'rb') as fobj:
+        with open(oname, 'wb') as ofobj:
+            while True:
+                data = fobj.read(BUFSIZE)
+                if not data:
+                    break
+                md5.update(data)
+                ofobj.write(data)
+                size += len(data)
+
+            ofobj.flush()
+            os.fsync(ofobj.fileno())
+
+    return size, md5.hexdigest()
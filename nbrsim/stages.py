@@ -0,0 +1,134 @@
+"""
+run a small graph of dependent stages, executing independent stages
+concurrently on a thread pool
+
+Most of our stages either shell out to an executable or copy files, so
+threads are sufficient to overlap them.
+"""
+from __future__ import print_function
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+
+class StageGraph(object):
+    """
+    a directed acyclic graph of named stages
+
+    parameters
+    ----------
+    nproc: int
+        Number of stages to run at once.  With nproc=1 the stages run in
+        the order they were added, as long as that order respects the
+        dependencies.
+
+    example
+    -------
+    graph = StageGraph(nproc=2)
+    graph.add('sx', run_sx)
+    graph.add('match', run_match, depends=['sx'])
+    graph.add('stars', run_stars, depends=['sx'])
+    results = graph.run()
+
+    Each stage function is called with a dict holding the results of the
+    stages it depends on, keyed by stage name.
+    """
+    def __init__(self, nproc=1):
+        self.nproc = nproc
+        self._names = []
+        self._funcs = {}
+        self._depends = {}
+
+    def add(self, name, func, depends=None):
+        """
+        add a stage
+
+        parameters
+        ----------
+        name: string
+            Unique name for the stage
+        func: callable
+            Called as func(results) where results holds the outputs
+            of the dependencies
+        depends: sequence of strings, optional
+            Names of stages that must finish before this one starts.
+            These must already have been added.
+        """
+        if name in self._funcs:
+            raise ValueError("stage '%s' already added" % name)
+
+        if depends is None:
+            depends = []
+
+        for dep in depends:
+            if dep not in self._funcs:
+                raise ValueError("stage '%s' depends on unknown "
+                                 "stage '%s'" % (name, dep))
+
+        self._names.append(name)
+        self._funcs[name] = func
+        self._depends[name] = list(depends)
+
+    def run(self):
+        """
+        run all stages, returning a dict of results keyed by stage name
+
+        If a stage raises an exception, stages that depend on it are
+        skipped, the stages already running are allowed to finish, and
+        the first exception is re-raised.
+        """
+
+        results = {}
+        done = set()
+        failed = set()
+        first_error = None
+
+        pending = list(self._names)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=self.nproc) as pool:
+            while pending or running:
+
+                for name in list(pending):
+                    deps = self._depends[name]
+                    if any(dep in failed for dep in deps):
+                        print("    skipping stage '%s'" % name)
+                        pending.remove(name)
+                        failed.add(name)
+                    elif (all(dep in done for dep in deps)
+                            and len(running) < self.nproc):
+                        pending.remove(name)
+                        depres = dict((dep, results[dep]) for dep in deps)
+                        future = pool.submit(
+                            self._run_stage, name, depres,
+                        )
+                        running[future] = name
+
+                if not running:
+                    # everything left depends on a failed stage
+                    continue
+
+                finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                        done.add(name)
+                    except Exception as err:
+                        failed.add(name)
+                        if first_error is None:
+                            first_error = err
+
+        if first_error is not None:
+            raise first_error
+
+        return results
+
+    def _run_stage(self, name, depres):
+        """
+        run a single stage with timing
+        """
+        tm0 = time.time()
+        print("    starting stage '%s'" % name)
+        res = self._funcs[name](depres)
+        print("    finished stage '%s' in %.1f seconds" % (name, time.time()-tm0))
+        return res
@@ -0,0 +1,308 @@
+"""
+in-process star selection from the sextractor catalog
+
+This is an alternative to running the external findstars executable.  It
+fits the stellar locus in the size-magnitude plane, following the stars_*
+parameters in the findstars config, using whole-array operations on the
+catalog columns.
+"""
+from __future__ import print_function
+import numpy
+
+from . import files
+
+# convert FLUX_RADIUS, the half light radius, to the sigma of a gaussian
+HALF_LIGHT_TO_SIGMA = 1.0/numpy.sqrt(2*numpy.log(2))
+
+# don't let the locus scatter in log(size) get arbitrarily small
+MIN_LOCUS_SCATTER = 0.01
+
+# minimum number of stars needed to fit the locus with a polynomial of
+# order stars_fitorder; with fewer we fit a constant size
+MIN_STARS_FOR_SLOPE = 10
+
+# defaults for parameters not set in the config, from findstars
+DEFAULTS = {
+    'cat_id_col': 'NUMBER',
+    'cat_x_col': 'XWIN_IMAGE',
+    'cat_y_col': 'YWIN_IMAGE',
+    'cat_sky_col': 'BACKGROUND',
+    'cat_flag_col': 'FLAGS',
+    'cat_mag_col': 'MAG_AUTO',
+    'cat_mag_err_col': 'MAGERR_AUTO',
+    'cat_size_col': 'FLUX_RADIUS',
+    'cat_sg_col': 'CLASS_STAR',
+
+    'stars_minsg': 0.9,
+    'stars_maxsg': 1.0,
+    'stars_minsgfrac': 0.05,
+    'stars_minsgmag': 17.0,
+    'stars_maxsgmag': 19.0,
+    'stars_minmag': 17.0,
+    'stars_maxmag': 21.0,
+    'stars_maxoutmag': 21.0,
+    'stars_startn1': 0.05,
+    'stars_ndivx': 1,
+    'stars_ndivy': 1,
+    'stars_starfrac': 0.3,
+    'stars_minsize': 0.2,
+    'stars_maxsize': 5.0,
+    'stars_fitorder': 2,
+    'stars_fitsigclip': 3.0,
+    'stars_maxrefititer': 5,
+}
+
+FINDSTARS_DTYPE = [
+    ('id','i4'),
+    ('x','f8'),
+    ('y','f8'),
+    ('sky','f8'),
+    ('mag','f4'),
+    ('mag_err','f4'),
+    ('sg','f4'),
+    ('sigma0','f8'),
+    ('star_flag','i4'),
+]
+
+
+def read_findstars_config(fnames=None):
+    """
+    read findstars style configuration files
+
+    The files are key = value pairs with # comments.  Later files
+    override earlier ones.
+
+    parameters
+    ----------
+    fnames: list of strings, optional
+        Default is the wl.config followed by the findstars.config
+        from the share directory, as used for the findstars executable
+
+    returns
+    -------
+    dict of config values, starting with the defaults
+    """
+
+    if fnames is None:
+        fnames = [files.get_wl_config(), files.get_findstars_config()]
+
+    conf = {}
+    conf.update(DEFAULTS)
+
+    for fname in fnames:
+        with open(fname) as fobj:
+            for line in fobj:
+                line = line.split('#')[0].strip()
+                if '=' not in line:
+                    continue
+
+                key, val = line.split('=', 1)
+                conf[key.strip()] = _convert_value(val.strip())
+
+    return conf
+
+
+class StarSelector(dict):
+    """
+    select stars by fitting the stellar locus in the size-magnitude plane
+
+    parameters
+    ----------
+    config: dict, optional
+        findstars style parameters.  Default is to read them using
+        read_findstars_config()
+    """
+    def __init__(self, config=None):
+        if config is None:
+            config = read_findstars_config()
+
+        self.update(DEFAULTS)
+        self.update(config)
+
+    def go(self, cat):
+        """
+        select stars from the catalog
+
+        parameters
+        ----------
+        cat: array with fields
+            The sextractor catalog, with upper or lower case column names
+
+        returns
+        -------
+        output: array
+            An array with the same fields we use from the findstars output,
+            including sigma0 and star_flag
+        """
+
+        output = self._get_output(cat)
+
+        mag = output['mag']
+        sg = output['sg']
+        logsize = numpy.log(output['sigma0'].clip(min=1.0e-6))
+
+        flags = self._get_col(cat, 'cat_flag_col')
+        good = (
+            (flags == 0)
+            & (output['sigma0'] >= self['stars_minsize'])
+            & (output['sigma0'] <= self['stars_maxsize'])
+            & (mag >= self['stars_minmag'])
+            & (mag <= self['stars_maxmag'])
+        )
+
+        cell = self._get_cells(output['x'], output['y'])
+
+        for icell in numpy.unique(cell):
+            incell = good & (cell == icell)
+
+            isstar = self._select_cell(mag, sg, logsize, incell)
+
+            w, = numpy.where(
+                isstar
+                & (mag <= self['stars_maxoutmag'])
+                & (sg <= self['stars_maxsg'])
+            )
+            output['star_flag'][w] = 1
+
+        return output
+
+    def _select_cell(self, mag, sg, logsize, good):
+        """
+        fit the locus for the objects in one subdivision of the image
+        """
+
+        isstar = numpy.zeros(mag.size, dtype=bool)
+        if good.sum() == 0:
+            return isstar
+
+        init = self._get_initial_stars(mag, sg, logsize, good)
+        if init.sum() == 0:
+            return isstar
+
+        # start from the median size, which is robust to galaxies in the
+        # initial sample, then refit with outliers clipped
+        coeffs = numpy.array([numpy.median(logsize[init])])
+
+        for i in range(int(self['stars_maxrefititer'])):
+            resid = logsize - numpy.polyval(coeffs, mag)
+
+            rinit = resid[init]
+            mad = numpy.median(numpy.abs(rinit - numpy.median(rinit)))
+            scatter = max(1.4826*mad, MIN_LOCUS_SCATTER)
+
+            isstar = good & (numpy.abs(resid) < self['stars_fitsigclip']*scatter)
+            if isstar.sum() == 0:
+                break
+
+            init = isstar
+            if init.sum() >= MIN_STARS_FOR_SLOPE:
+                order = int(self['stars_fitorder'])
+            else:
+                order = 0
+            coeffs = numpy.polyfit(mag[init], logsize[init], order)
+
+        return isstar
+
+    def _get_initial_stars(self, mag, sg, logsize, good):
+        """
+        initial selection using the star-galaxy separator if enough
+        objects pass, otherwise the smallest of the brightest objects
+        """
+
+        insgmag = (
+            good
+            & (mag >= self['stars_minsgmag'])
+            & (mag <= self['stars_maxsgmag'])
+        )
+        init = insgmag & (sg >= self['stars_minsg']) & (sg <= self['stars_maxsg'])
+
+        nsgmag = insgmag.sum()
+        if nsgmag > 0 and init.sum() >= self['stars_minsgfrac']*nsgmag:
+            return init
+
+        # fall back to taking the smallest of the brightest objects
+        w, = numpy.where(good)
+        nbright = max(int(self['stars_startn1']*w.size), 1)
+        bright = w[mag[w].argsort()[:nbright]]
+
+        nsmall = max(int(self['stars_starfrac']*bright.size), 1)
+        small = bright[logsize[bright].argsort()[:nsmall]]
+
+        init = numpy.zeros(mag.size, dtype=bool)
+        init[small] = True
+        return init
+
+    def _get_cells(self, x, y):
+        """
+        index of the subdivision holding each object
+        """
+        ndivx = int(self['stars_ndivx'])
+        ndivy = int(self['stars_ndivy'])
+
+        if ndivx <= 1 and ndivy <= 1:
+            return numpy.zeros(x.size, dtype='i4')
+
+        xbins = numpy.linspace(x.min(), x.max(), ndivx+1)[1:-1]
+        ybins = numpy.linspace(y.min(), y.max(), ndivy+1)[1:-1]
+
+        ix = numpy.digitize(x, xbins)
+        iy = numpy.digitize(y, ybins)
+        return iy*ndivx + ix
+
+    def _get_output(self, cat):
+        """
+        copy the columns we need into the output structure
+        """
+        output = numpy.zeros(cat.size, dtype=FINDSTARS_DTYPE)
+
+        output['id'] = self._get_col(cat, 'cat_id_col')
+        output['x'] = self._get_col(cat, 'cat_x_col')
+        output['y'] = self._get_col(cat, 'cat_y_col')
+        output['sky'] = self._get_col(cat, 'cat_sky_col')
+        output['mag'] = self._get_col(cat, 'cat_mag_col')
+        output['mag_err'] = self._get_col(cat, 'cat_mag_err_col')
+        output['sg'] = self._get_col(cat, 'cat_sg_col')
+        output['sigma0'] = \
+            self._get_col(cat, 'cat_size_col')*HALF_LIGHT_TO_SIGMA
+
+        return output
+
+    def _get_col(self, cat, key):
+        """
+        get the column, allowing for lower case names
+        """
+        name = self[key]
+        if name not in cat.dtype.names:
+            name = name.lower()
+        return cat[name]
+
+
+def select_stars(cat, config=None):
+    """
+    select stars from the sextractor catalog
+
+    parameters
+    ----------
+    cat: array with fields
+        The sextractor catalog
+    config: dict, optional
+        findstars style parameters.  Default is to read them using
+        read_findstars_config()
+
+    returns
+    -------
+    output: array
+        An array with the same fields we use from the findstars output,
+        including sigma0 and star_flag
+    """
+    selector = StarSelector(config=config)
+    return selector.go(cat)
+
+
+def _convert_value(val):
+    for converter in (int, float):
+        try:
+            return converter(val)
+        except ValueError:
+            pass
+    return val
@@ -1,7 +1,5 @@
 from __future__ import print_function
 import numpy
-import esutil as eu
-import fitsio
 
 from . import files
 
@@ -9,6 +7,7 @@ def match_truth(data, truth, radius=8):
     """
     match within the specified number of pixels
     """
+    import esutil as eu
 
     allow=1
     mdata, mtruth = close_match(
@@ -39,6 +38,26 @@ def match_truth(data, truth, radius=8):
 
     return newdata
 
+def parse_indices(text):
+    """
+    parse a specification of indices
+
+    parameters
+    ----------
+    text: string
+        Either a range start:end, which like a python slice does
+        not include end, or a comma separated list of indices
+
+    returns
+    -------
+    list of indices
+    """
+    if ':' in text:
+        start, end = text.split(':')
+        return list(range(int(start), int(end)))
+    else:
+        return [int(i) for i in text.split(',')]
+
 def close_match(t1,s1,t2,s2,ep,allow,verbose=False):
     """
     Find the nearest neighbors between two arrays of x/y
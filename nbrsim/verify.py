@@ -0,0 +1,441 @@
+"""
+verify the FITS products of a run
+
+Products are copied into place only after the copy is verified, but a
+job killed while writing, or a file damaged later, leaves a product that
+exists but cannot be read.  Here each product is checked by walking its
+headers: every header must be complete, and the data sizes given by the
+headers must account for the length of the file exactly.  Optionally the
+CHECKSUM and DATASUM keywords are verified as well, which means reading
+all the data.
+
+The headers are parsed directly rather than with fitsio, so only the
+header blocks are read unless checksums are requested.
+
+The results are written to the run directory, and nbrsim-make-scripts
+--missing uses them to resubmit the jobs for bad products.
+"""
+from __future__ import print_function
+import os
+import json
+import time
+import numpy
+
+from . import files
+
+BLOCK_SIZE = 2880
+CARD_SIZE = 80
+
+# read this many bytes at a time when summing data
+CHECKSUM_CHUNK = 64*BLOCK_SIZE*128
+
+PRODUCTS = ['image', 'seg', 'sxcat', 'match', 'psfex', 'meds']
+
+# status values
+OK = 'ok'
+MISSING = 'missing'
+BAD = 'bad'
+
+
+def get_product_file(run, index, product):
+    """
+    get the path to a product for an index
+    """
+    if product == 'image':
+        return files.get_image_file(run, index)
+    elif product == 'seg':
+        return files.get_seg_file(run, index)
+    elif product == 'sxcat':
+        return files.get_sxcat_file(run, index)
+    elif product == 'match':
+        return files.get_sxcat_match_file(run, index)
+    elif product == 'psfex':
+        return files.get_psfex_file(run, index)
+    elif product == 'meds':
+        return files.get_meds_file(run, index)
+    else:
+        raise ValueError("bad product '%s', expected one of %s" % (product, PRODUCTS))
+
+
+def check_fits_file(fname, checksum=False):
+    """
+    check the structure of a FITS file
+
+    parameters
+    ----------
+    fname: string
+        The file to check
+    checksum: bool, optional
+        If True, also verify the CHECKSUM and DATASUM keywords of each
+        HDU that has them
+
+    returns
+    -------
+    (ok, message), where message describes the first problem found
+    """
+    size = os.path.getsize(fname)
+    if size == 0:
+        return False, 'empty file'
+    if size % BLOCK_SIZE != 0:
+        return False, 'size %d is not a multiple of %d' % (size, BLOCK_SIZE)
+
+    with open(fname, 'rb') as fobj:
+        offset = 0
+        ihdu = 0
+        while offset < size:
+            try:
+                header, header_size, header_sum = read_header(fobj, checksum=checksum)
+            except ValueError as err:
+                return False, 'hdu %d: %s' % (ihdu, err)
+
+            if ihdu == 0 and 'SIMPLE' not in header:
+                return False, 'missing SIMPLE keyword'
+            if ihdu > 0 and 'XTENSION' not in header:
+                return False, 'hdu %d: missing XTENSION keyword' % ihdu
+
+            try:
+                data_size = get_data_size(header)
+            except (KeyError, ValueError) as err:
+                return False, 'hdu %d: bad header: %s' % (ihdu, err)
+
+            padded = _pad(data_size)
+            data_start = offset + header_size
+            if data_start + padded > size:
+                return False, 'hdu %d: truncated, data ends at %d, file size %d' % (
+                    ihdu, data_start + padded, size,
+                )
+
+            if checksum:
+                ok, message = check_hdu_sums(fobj, header, header_sum, padded)
+                if not ok:
+                    return False, 'hdu %d: %s' % (ihdu, message)
+            else:
+                fobj.seek(data_start + padded)
+
+            offset = data_start + padded
+            ihdu += 1
+
+    return True, '%d hdus' % ihdu
+
+
+def read_header(fobj, checksum=False):
+    """
+    read a header from the current position, leaving the file at the
+    start of the data
+
+    returns
+    -------
+    (header, nbytes, sum), where header is a dict of the keyword values
+    as strings, and sum is the 32 bit ones' complement sum of the header
+    blocks if checksum is True
+    """
+    header = {}
+    nbytes = 0
+    total = 0
+
+    while True:
+        block = fobj.read(BLOCK_SIZE)
+        if len(block) < BLOCK_SIZE:
+            raise ValueError('truncated header')
+        nbytes += BLOCK_SIZE
+
+        if checksum:
+            total = _add_sums(total, _block_sum(block))
+
+        for i in range(0, BLOCK_SIZE, CARD_SIZE):
+            card = block[i:i+CARD_SIZE].decode('ascii', 'replace')
+            key = card[:8].strip()
+
+            if key == 'END':
+                return header, nbytes, total
+
+            if card[8:10] == '= ' and key not in header:
+                header[key] = _get_card_value(card)
+
+        if nbytes > 1000*BLOCK_SIZE:
+            raise ValueError('no END card')
+
+
+def get_data_size(header):
+    """
+    size of the data in bytes, without padding
+    """
+    bitpix = int(header['BITPIX'])
+    naxis = int(header['NAXIS'])
+    if naxis == 0:
+        return 0
+
+    npix = 1
+    for i in range(1, naxis + 1):
+        npix *= int(header['NAXIS%d' % i])
+
+    pcount = int(header.get('PCOUNT', 0))
+    gcount = int(header.get('GCOUNT', 1))
+
+    # random groups have NAXIS1 = 0
+    if 'GROUPS' in header and int(header.get('NAXIS1', 1)) == 0:
+        npix = 1
+        for i in range(2, naxis + 1):
+            npix *= int(header['NAXIS%d' % i])
+
+    return abs(bitpix)//8*gcount*(pcount + npix)
+
+
+def check_hdu_sums(fobj, header, header_sum, padded):
+    """
+    verify DATASUM and CHECKSUM, if present, reading the data from the
+    current position
+    """
+    data_sum = 0
+    remaining = padded
+    while remaining > 0:
+        chunk = fobj.read(min(CHECKSUM_CHUNK, remaining))
+        if len(chunk) == 0:
+            return False, 'truncated data'
+        data_sum = _add_sums(data_sum, _block_sum(chunk))
+        remaining -= len(chunk)
+
+    if 'DATASUM' in header:
+        expected = header['DATASUM'].strip()
+        if expected != '' and int(expected) != data_sum:
+            return False, 'DATASUM mismatch, %s != %d' % (expected, data_sum)
+
+    if 'CHECKSUM' in header:
+        total = _add_sums(header_sum, data_sum)
+        if total != 0xffffffff:
+            return False, 'CHECKSUM mismatch'
+
+    return True, ''
+
+
+def verify_index(run, index, products=None, checksum=False):
+    """
+    verify the products for an index
+
+    returns
+    -------
+    dict keyed by product, with entries (status, message, time), where
+    time is when the check started
+    """
+    if products is None:
+        products = PRODUCTS
+
+    results = {}
+    for product in products:
+        checked = time.time()
+
+        fname = get_product_file(run, index, product)
+        if not os.path.exists(fname):
+            results[product] = (MISSING, '', checked)
+            continue
+
+        try:
+            ok, message = check_fits_file(fname, checksum=checksum)
+        except (IOError, OSError) as err:
+            ok, message = False, str(err)
+
+        results[product] = (OK if ok else BAD, message, checked)
+
+    return results
+
+
+def verify_run(run, indices=None, products=None, nproc=1, checksum=False,
+               remove_bad=False):
+    """
+    verify the products for all indices of a run
+
+    parameters
+    ----------
+    run: string
+        The run identifier
+    indices: sequence of ints, optional
+        Indices to check, default all in the run
+    products: list of strings, optional
+        Products to check, default PRODUCTS
+    nproc: int, optional
+        Number of processes
+    checksum: bool, optional
+        If True, also verify CHECKSUM and DATASUM
+    remove_bad: bool, optional
+        If True, remove bad files, so they are remade
+
+    returns
+    -------
+    dict keyed by index, with the results from verify_index
+    """
+    import multiprocessing
+
+    if indices is None:
+        conf = files.read_config(run)
+        indices = list(range(conf['output']['nfiles']))
+    if products is None:
+        products = PRODUCTS
+
+    tm0 = time.time()
+    args = [(run, index, products, checksum) for index in indices]
+
+    results = {}
+    if nproc > 1:
+        ctx = multiprocessing.get_context('fork')
+        pool = ctx.Pool(nproc)
+        try:
+            for index, res in pool.imap_unordered(_verify_index_wrapper, args, chunksize=16):
+                results[index] = res
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for a in args:
+            index, res = _verify_index_wrapper(a)
+            results[index] = res
+
+    for index in sorted(results):
+        for product, (status, message, checked) in sorted(results[index].items()):
+            if status == BAD:
+                fname = get_product_file(run, index, product)
+                print("bad: %s: %s" % (fname, message))
+                if remove_bad:
+                    print("removing:",fname)
+                    os.remove(fname)
+
+    print("checked %d indices in %.1f s" % (len(results), time.time() - tm0))
+    return results
+
+
+def _verify_index_wrapper(args):
+    run, index, products, checksum = args
+    return index, verify_index(run, index, products=products, checksum=checksum)
+
+
+def get_nbad(results):
+    """
+    get the number of bad products in the results from verify_run
+    """
+    return sum(
+        1 for res in results.values()
+        for r in res.values() if r[0] == BAD
+    )
+
+
+def print_summary(results, products):
+    """
+    print the number of good, missing and bad files for each product
+    """
+    print("%-8s %8s %8s %8s" % ('product', OK, MISSING, BAD))
+    for product in products:
+        counts = {OK: 0, MISSING: 0, BAD: 0}
+        for res in results.values():
+            if product in res:
+                counts[res[product][0]] += 1
+        print("%-8s %8d %8d %8d" % (product, counts[OK], counts[MISSING], counts[BAD]))
+
+
+def write_results(run, results, products, checksum):
+    """
+    write the results to the run directory, merging with previous
+    results for other indices.  Each product entry keeps the time it was
+    checked, since a merge may leave entries from earlier runs
+    """
+    fname = files.get_verify_file(run)
+
+    data = read_results(run)
+    if data is None:
+        data = {'results': {}}
+
+    data['time'] = time.time()
+    data['checksum'] = checksum
+    for index, res in results.items():
+        entry = data['results'].setdefault(str(index), {})
+        for product, (status, message, checked) in res.items():
+            entry[product] = [status, message, checked]
+
+    tmpname = '%s.tmp%d' % (fname, os.getpid())
+    print("writing:",fname)
+    with open(tmpname, 'w') as fobj:
+        json.dump(data, fobj)
+    os.rename(tmpname, fname)
+
+
+def read_results(run):
+    """
+    read the verification results for the run, or None if there are none
+    """
+    fname = files.get_verify_file(run)
+    if not os.path.exists(fname):
+        return None
+
+    with open(fname) as fobj:
+        return json.load(fobj)
+
+
+def get_status(data, index, product):
+    """
+    get the recorded status of a product, or None if it was not checked
+    """
+    if data is None:
+        return None
+
+    entry = data['results'].get(str(index), {})
+    if product not in entry:
+        return None
+    return entry[product][0]
+
+
+def get_check_time(data, index, product):
+    """
+    get the time a product was checked, or None if it was not checked.
+    Results written before the time was kept per product use the time
+    of the whole check
+    """
+    if data is None:
+        return None
+
+    entry = data['results'].get(str(index), {})
+    if product not in entry:
+        return None
+    if len(entry[product]) > 2:
+        return entry[product][2]
+    return data['time']
+
+
+def _get_card_value(card):
+    """
+    get the value of a card as a string, without quotes or comment
+    """
+    value = card[10:]
+    stripped = value.lstrip()
+    if stripped.startswith("'"):
+        end = stripped.find("'", 1)
+        # doubled quotes are escaped quotes
+        while end != -1 and stripped[end+1:end+2] == "'":
+            end = stripped.find("'", end+2)
+        if end == -1:
+            return stripped[1:].rstrip()
+        return stripped[1:end].rstrip()
+
+    return value.split('/')[0].strip()
+
+
+def _pad(nbytes):
+    return (nbytes + BLOCK_SIZE - 1)//BLOCK_SIZE*BLOCK_SIZE
+
+
+def _block_sum(data):
+    """
+    32 bit ones' complement sum of big-endian words
+    """
+    words = numpy.frombuffer(data, dtype='>u4')
+    # hi and lo halves, so the sums cannot overflow
+    hi = int((words >> 16).sum(dtype='u8'))
+    lo = int((words & 0xffff).sum(dtype='u8'))
+    return _fold((hi << 16) + lo)
+
+
+def _add_sums(a, b):
+    return _fold(a + b)
+
+
+def _fold(total):
+    while total >> 32:
+        total = (total & 0xffffffff) + (total >> 32)
+    return total
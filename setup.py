@@ -8,6 +8,17 @@ scripts=[
     'nbrsim-make-scripts',
     'nbrsim-reduce',
     'nbrsim-make-meds',
+    'nbrsim-stage-out',
+    'nbrsim-plots',
+    'nbrsim-benchmark',
+    'nbrsim-make-catalog',
+    'nbrsim-aggregate',
+    'nbrsim-galsim',
+    'nbrsim-pipeline',
+    'nbrsim-scratch',
+    'nbrsim-plan',
+    'nbrsim-verify',
+    'nbrsim-pack',
 ]
 
 scripts=[os.path.join('bin',s) for s in scripts]
@@ -0,0 +1,114 @@
+import numpy
+
+from nbrsim.aggregate import (
+    ShearAccumulator,
+    TreeReducer,
+    get_max_dist,
+    get_neighbor_distance,
+)
+
+DIST_BINS = [0.0, 5.0, 10.0, numpy.inf]
+
+
+def _make_data(rng, n, nshear):
+    shear_index = rng.randint(0, nshear, size=n)
+    dist = rng.uniform(0.0, 20.0, size=n)
+
+    values = rng.normal(size=(n, 4))
+    values[:, 2:] = 0.02*shear_index[:, numpy.newaxis]
+    values[:, :2] += 0.9*values[:, 2:]
+    return shear_index, dist, values
+
+
+def _check_same(acc, expected):
+    assert numpy.array_equal(acc.counts, expected.counts)
+    assert numpy.allclose(acc.get_variances(), expected.get_variances())
+
+    summary = acc.get_summary()
+    esummary = expected.get_summary()
+    assert numpy.array_equal(summary['nobj'], esummary['nobj'])
+    assert numpy.allclose(summary['R'], esummary['R'])
+    assert numpy.allclose(summary['c'], esummary['c'])
+
+
+def test_merge_matches_single_accumulator():
+    rng = numpy.random.RandomState(8712)
+    shear_index, dist, values = _make_data(rng, 5000, nshear=6)
+
+    expected = ShearAccumulator(dist_bins=DIST_BINS)
+    expected.add(shear_index, dist, values)
+
+    # the second half has fewer shear indices, so merging has to grow
+    # the arrays
+    w1, = numpy.where(numpy.arange(shear_index.size) < 3000)
+    w2, = numpy.where((numpy.arange(shear_index.size) >= 3000) & (shear_index < 4))
+    w3, = numpy.where((numpy.arange(shear_index.size) >= 3000) & (shear_index >= 4))
+
+    acc1 = ShearAccumulator(dist_bins=DIST_BINS)
+    acc1.add(shear_index[w1], dist[w1], values[w1])
+    acc2 = ShearAccumulator(dist_bins=DIST_BINS)
+    acc2.add(shear_index[w2], dist[w2], values[w2])
+    acc3 = ShearAccumulator(dist_bins=DIST_BINS)
+    acc3.add(shear_index[w3], dist[w3], values[w3])
+
+    merged = acc2.copy().merge(acc1).merge(acc3)
+    _check_same(merged, expected)
+
+
+def test_tree_reducer_matches_single_accumulator():
+    rng = numpy.random.RandomState(331)
+    shear_index, dist, values = _make_data(rng, 4000, nshear=4)
+
+    expected = ShearAccumulator(dist_bins=DIST_BINS)
+    expected.add(shear_index, dist, values)
+
+    reducer = TreeReducer()
+    for chunk in numpy.array_split(numpy.arange(shear_index.size), 13):
+        acc = ShearAccumulator(dist_bins=DIST_BINS)
+        acc.add(shear_index[chunk], dist[chunk], values[chunk])
+        reducer.add(acc)
+
+    # only about log2(n) partial results are kept
+    assert len(reducer.levels) <= 4
+
+    _check_same(reducer.get_result(), expected)
+
+
+def _brute_neighbor_distance(x, y):
+    d2 = (x[:, numpy.newaxis] - x)**2 + (y[:, numpy.newaxis] - y)**2
+    d2[numpy.arange(x.size), numpy.arange(x.size)] = numpy.inf
+    return numpy.sqrt(d2.min(axis=1))
+
+
+def test_neighbor_distance_matches_brute_force():
+    rng = numpy.random.RandomState(311)
+
+    # a sparse field with a dense clump, and a pair exactly max_dist apart
+    x = numpy.concatenate([
+        rng.uniform(0, 500, size=800),
+        rng.normal(250, 3, size=200),
+        [1000.0, 1010.0],
+    ])
+    y = numpy.concatenate([
+        rng.uniform(0, 500, size=800),
+        rng.normal(250, 3, size=200),
+        [1000.0, 1000.0],
+    ])
+
+    max_dist = get_max_dist(DIST_BINS)
+    assert max_dist == 10.0
+
+    dist = get_neighbor_distance(x, y, max_dist)
+    expected = _brute_neighbor_distance(x, y)
+
+    near = expected < max_dist
+    assert numpy.allclose(dist[near], expected[near])
+    assert numpy.all(dist[~near] == max_dist)
+
+    bins = numpy.array(DIST_BINS)
+    assert numpy.array_equal(
+        numpy.searchsorted(bins, dist, side='right'),
+        numpy.searchsorted(bins, expected, side='right'),
+    )
+
+    assert numpy.all(numpy.isinf(get_neighbor_distance(x[:1], y[:1], max_dist)))
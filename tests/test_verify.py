@@ -0,0 +1,67 @@
+import os
+import sys
+import subprocess
+
+import numpy
+import fitsio
+
+from nbrsim import files, verify
+
+RUN = 'test-verify'
+BIN = os.path.join(os.path.dirname(__file__), '..', 'bin', 'nbrsim-verify')
+
+
+def _setup_run(tmpdir, monkeypatch, nindex):
+    monkeypatch.setenv('NBRSIM_DIR', str(tmpdir.join('data')))
+    monkeypatch.setenv('NBRSIM_CONFIG_DIR', str(tmpdir.join('config')))
+    os.makedirs(files.get_rundir(RUN))
+
+    for index in range(nindex):
+        fname = files.get_meds_file(RUN, index)
+        os.makedirs(os.path.dirname(fname))
+        with fitsio.FITS(fname, 'rw', clobber=True) as fits:
+            fits.write(numpy.zeros((10, 10), dtype='f4'))
+            fits.write(numpy.zeros(5, dtype=[('x', 'f8')]))
+
+
+def _run_verify():
+    env = dict(os.environ)
+    pkg_dir = os.path.join(os.path.dirname(__file__), '..')
+    env['PYTHONPATH'] = os.pathsep.join(
+        [pkg_dir] + [p for p in [env.get('PYTHONPATH')] if p]
+    )
+    cmd = [sys.executable, BIN, RUN, '--indices', '0:2', '--products', 'meds']
+    return subprocess.call(cmd, env=env)
+
+
+def test_verify_run(tmpdir, monkeypatch):
+    _setup_run(tmpdir, monkeypatch, 2)
+
+    results = verify.verify_run(RUN, indices=[0, 1], products=['meds'])
+    assert [results[i]['meds'][0] for i in (0, 1)] == [verify.OK, verify.OK]
+    assert verify.get_nbad(results) == 0
+
+    # truncate the last block of one file
+    fname = files.get_meds_file(RUN, 1)
+    with open(fname, 'r+b') as fobj:
+        fobj.truncate(os.path.getsize(fname) - verify.BLOCK_SIZE)
+
+    results = verify.verify_run(RUN, indices=[0, 1], products=['meds'])
+    assert results[1]['meds'][0] == verify.BAD
+    assert verify.get_nbad(results) == 1
+
+
+def test_verify_exit_code(tmpdir, monkeypatch):
+    _setup_run(tmpdir, monkeypatch, 2)
+    assert _run_verify() == 0
+
+    data = verify.read_results(RUN)
+    assert verify.get_status(data, 1, 'meds') == verify.OK
+
+    fname = files.get_meds_file(RUN, 1)
+    with open(fname, 'r+b') as fobj:
+        fobj.truncate(os.path.getsize(fname) - verify.BLOCK_SIZE)
+
+    assert _run_verify() == 1
+    data = verify.read_results(RUN)
+    assert verify.get_status(data, 1, 'meds') == verify.BAD